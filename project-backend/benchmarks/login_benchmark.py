@@ -0,0 +1,48 @@
+"""
+Benchmark of login against the number of registered users
+
+Registers synthetic users straight into the database and reports the median time of
+matching an email and password. Login goes through the email index and hashes the
+password once, so the latency stays flat as users are added. Run from project-backend:
+
+    python -m benchmarks.login_benchmark --users 100 10000 100000
+"""
+import argparse
+import time
+
+from src import data
+from src.other import clear_v1
+
+
+def add_users(count):
+    """Add users to data.db until it holds count of them, without a request per user"""
+    for i in range(len(data.db['users']), count):
+        data.User(f'user{i}@example.com', 'password', 'First', 'Last', f'firstlast{i}').add_to_db()
+    data.changes.clear()
+
+
+def median_login_time(count, rounds=200):
+    """The median time of matching the email and password of the users in turn"""
+    times = list()
+    for i in range(rounds):
+        email = f'user{i * count // rounds}@example.com'
+        start = time.perf_counter()
+        data.User.check_email_password_match(email, 'password')
+        times.append(time.perf_counter() - start)
+    return sorted(times)[rounds // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, nargs='+', default=[100, 10000, 100000])
+    args = parser.parse_args()
+
+    clear_v1()
+    print(f'{"users":<10}{"login (us)":>12}')
+    for count in sorted(args.users):
+        add_users(count)
+        print(f'{count:<10}{median_login_time(count) * 1e6:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Microbenchmark of matching a query against a single message
+
+Compares the per-message cost of the match search_v2 used to run, re.search with the
+escaped query string for every message, against the matcher of search.compile_query,
+for plain queries and for queries with regex metacharacters. Run from project-backend:
+
+    python -m benchmarks.match_benchmark --messages 100000
+"""
+import argparse
+import random
+import re
+import time
+
+from src import search
+from benchmarks.search_benchmark import VOCABULARY
+
+QUERIES = {
+    'plain': ['hello', 'ab cd', 'zzzz', 'the quick brown fox', 'café'],
+    'regex': ['h.llo', '^ab', 'cd$', '(ab|cd) ef', 'x+y'],
+}
+
+
+def messages(num_messages):
+    """Random messages of three to fifteen words"""
+    rand = random.Random(0)
+    words = [''.join(rand.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rand.randint(2, 9)))
+             for _ in range(VOCABULARY)]
+    return [' '.join(rand.choices(words, k=rand.randint(3, 15))) for _ in range(num_messages)]
+
+
+def before(query_str, contents):
+    """The match as search_v2 used to run it"""
+    pattern = query_str.encode('unicode_escape').decode()
+    return sum(1 for content in contents if re.search(pattern, content))
+
+
+def after(query_str, contents):
+    """The match through the matcher compiled once for the request"""
+    matches = search.compile_query(query_str)
+    return sum(1 for content in contents if matches(content))
+
+
+def per_message(match, query_strs, contents):
+    """Nanoseconds spent per message and query"""
+    start = time.perf_counter()
+    for query_str in query_strs:
+        match(query_str, contents)
+    return (time.perf_counter() - start) / (len(query_strs) * len(contents)) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    contents = messages(args.messages)
+    print(f'{"queries":<10}{"before (ns)":>14}{"after (ns)":>14}{"speedup":>10}')
+    for kind, query_strs in QUERIES.items():
+        for query_str in query_strs:
+            assert before(query_str, contents) == after(query_str, contents), query_str
+        slow = per_message(before, query_strs, contents)
+        fast = per_message(after, query_strs, contents)
+        print(f'{kind:<10}{slow:>14.1f}{fast:>14.1f}{slow / fast:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
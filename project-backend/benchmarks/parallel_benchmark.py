@@ -0,0 +1,52 @@
+"""
+Benchmark of the parallel search of the queries the indexes cannot narrow
+
+Matches regex queries against synthetic messages in the request thread and split across
+process pools of growing size with search.parallel_match, and reports the speedup. The
+speedup is bounded by the number of cores. Run from project-backend:
+
+    python -m benchmarks.parallel_benchmark --messages 1000000 --workers 2 4 8
+"""
+import argparse
+import os
+import time
+
+from src import search
+from benchmarks.match_benchmark import messages
+
+QUERIES = ['h.llo', '(ab|cd)+ ef', r'\b\w{8}\b \w{8}$', 'x+y+z', '^[aeiou]{3}']
+
+
+def serial(query_str, contents, workers):
+    return search.match_chunk(query_str, contents)
+
+
+def timed(match, contents, workers):
+    """Seconds spent matching every query, after a first run warming the pool up"""
+    match(QUERIES[0], contents, workers)
+    start = time.perf_counter()
+    for query_str in QUERIES:
+        match(query_str, contents, workers)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8])
+    args = parser.parse_args()
+
+    contents = messages(args.messages)
+    print(f'{args.messages} messages, {os.cpu_count()} cores')
+    baseline = timed(serial, contents, 1)
+    print(f'{"workers":<10}{"time (s)":>10}{"speedup":>10}')
+    print(f'{"serial":<10}{baseline:>10.2f}{1:>9.1f}x')
+    for workers in args.workers:
+        for query_str in QUERIES:
+            assert search.parallel_match(query_str, contents, workers) == serial(query_str, contents, 1)
+        elapsed = timed(search.parallel_match, contents, workers)
+        print(f'{workers:<10}{elapsed:>10.2f}{baseline / elapsed:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of the candidate lookup of the search indexes
+
+Indexes synthetic messages with the word and trigram indexes of src/search.py and reports
+the time taken to narrow a query down to its candidates. Run from project-backend:
+
+    python -m benchmarks.search_benchmark --messages 1000000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from src import search
+
+VOCABULARY = 5000
+
+
+def build_indexes(num_messages):
+    """
+
+    Returns:
+        Tuple (list of the message contents, list of the filled indexes)
+
+    """
+    rand = random.Random(0)
+    words = [''.join(rand.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rand.randint(2, 9)))
+             for _ in range(VOCABULARY)]
+    contents = [' '.join(rand.choices(words, k=rand.randint(3, 15))) for _ in range(num_messages)]
+    content_indexes = [search.TermIndex(), search.TrigramIndex()]
+    for content_index in content_indexes:
+        for message_id, content in enumerate(contents):
+            content_index.add(message_id, content)
+    return contents, content_indexes
+
+
+def queries(contents, count):
+    """Substrings of random messages, from a few characters to whole messages"""
+    rand = random.Random(1)
+    result = list()
+    for _ in range(count):
+        content = rand.choice(contents)
+        start = rand.randrange(len(content))
+        result.append(content[start:start + rand.choice((3, 5, 8, 12, 20, 1000))])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    contents, content_indexes = build_indexes(args.messages)
+    print(f'{args.messages} messages indexed in {time.perf_counter() - start:.1f}s')
+    times = list()
+    for query_str in queries(contents, args.queries):
+        start = time.perf_counter()
+        search.candidates(query_str, content_indexes)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    print(f'{"queries":<10}{"median (ms)":>14}{"p99 (ms)":>12}{"max (ms)":>12}')
+    print(f'{len(times):<10}{statistics.median(times) * 1e3:>14.3f}'
+          f'{times[len(times) * 99 // 100] * 1e3:>12.3f}{times[-1] * 1e3:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
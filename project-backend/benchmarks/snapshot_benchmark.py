@@ -0,0 +1,98 @@
+"""
+Benchmark of the binary snapshot format against pickle
+
+Builds a synthetic database and reports the file size, dump time and load time of both
+formats. Run from project-backend:
+
+    python -m benchmarks.snapshot_benchmark --users 10000 --messages 1000000
+"""
+import argparse
+import os
+import pickle
+import random
+import tempfile
+import time
+
+from src import data
+from src import snapshot
+from src.other import clear_v1
+
+
+def build_db(num_users, num_messages, num_channels, num_dms):
+    """
+
+    Fill data.db with users, channels, dms and messages, and the stats series they grow
+
+    """
+    clear_v1()
+    rand = random.Random(0)
+    users = [data.User(f'user{i}@example.com', 'password', f'First{i}', f'Last{i}', f'firstlast{i}')
+             for i in range(num_users)]
+    data.db['users'] = users
+    conversations = list()
+    for _ in range(num_channels):
+        owner = rand.choice(users)
+        channel = data.Channel(owner.id, f'channel of {owner.handle}', is_public=True)
+        channel.member.extend(user.id for user in rand.sample(users, min(50, num_users)))
+        conversations.append(channel)
+        data.db['channels'].append(channel)
+    for _ in range(num_dms):
+        members = rand.sample(users, min(3, num_users))
+        dm = data.DirectMessage(', '.join(user.handle for user in members), members, members[0].id)
+        conversations.append(dm)
+        data.db['direct_messages'].append(dm)
+
+    now = int(time.time())
+    for i in range(num_messages):
+        owner = rand.choice(users)
+        message = data.Message(owner.id, f'message {i} from {owner.handle}: ' + 'lorem ipsum ' * rand.randint(1, 8))
+        message.time = now + i
+        if rand.random() < 0.1:
+            message.react_infos[0]['u_ids'].append(rand.choice(users).id)
+        rand.choice(conversations).messages.append(message)
+        sent = owner.user_stats['messages_sent']
+        sent.append({'num_messages_sent': sent[-1]['num_messages_sent'] + 1, 'time_stamp': now + i})
+        exist = data.db['dreams_stats']['messages_exist']
+        exist.append({'num_messages_exist': exist[-1]['num_messages_exist'] + 1, 'time_stamp': now + i})
+    data.changes.clear()
+    return data.db
+
+
+def measure(db, path, dump, load):
+    """
+
+    Returns:
+        Tuple (size in bytes, dump seconds, load seconds)
+
+    """
+    start = time.perf_counter()
+    with open(path, 'wb') as f:
+        dump(db, f)
+    dumped = time.perf_counter()
+    with open(path, 'rb') as f:
+        load(f)
+    loaded = time.perf_counter()
+    return os.path.getsize(path), dumped - start, loaded - dumped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--channels', type=int, default=200)
+    parser.add_argument('--dms', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        db = build_db(args.users, args.messages, args.channels, args.dms)
+        print(f'{args.users} users, {args.channels} channels, {args.dms} dms, {args.messages} messages')
+        print(f'{"format":<10}{"size (MB)":>12}{"dump (s)":>12}{"load (s)":>12}')
+        for name, dump, load in (('pickle', pickle.dump, pickle.load),
+                                 ('snapshot', snapshot.dump, snapshot.load)):
+            size, dump_time, load_time = measure(db, os.path.join(directory, name), dump, load)
+            print(f'{name:<10}{size / 1e6:>12.1f}{dump_time:>12.2f}{load_time:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
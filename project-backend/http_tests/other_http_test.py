@@ -218,6 +218,61 @@ class TestSearch:
                                                    'query_str': "dm message"}).text)
         assert len(ret_list['messages']) == 2
 
+    def test_pages(self, dm_dict, channel_list, login_list):
+        """
+        Test case that the search results are returned page by page, newest first
+
+        Args:
+            dm_dict: dict contain pre-create direct message
+            channel_list: list contain pre-create channels
+            login_list: list contain pre-login users
+
+        Returns:
+            N/A
+
+        """
+        expected = json.loads(requests.get(config.url + 'search/v2',
+                                           params={'token': login_list[1]['token'],
+                                                   'query_str': "pony"}).text)['messages']
+        expected = sorted(message['message_id'] for message in expected)[::-1]
+        matched = list()
+        cursor = None
+        while True:
+            params = {'token': login_list[1]['token'], 'query_str': "pony", 'limit': 1}
+            if cursor is not None:
+                params['cursor'] = cursor
+            page = requests.get(config.url + 'search/v2', params=params).json()
+            matched += [message['message_id'] for message in page['messages']]
+            cursor = page['cursor']
+            if cursor is None:
+                break
+        assert len(expected) > 1
+        assert matched == expected
+        resp = requests.get(config.url + 'search/v2',
+                            params={'token': login_list[1]['token'], 'query_str': "pony", 'limit': 0})
+        assert resp.status_code == InputError.code
+
+    def test_filters(self, dm_dict, channel_list, login_list):
+        """
+        Test case that the search is narrowed down to a sender and a channel
+
+        Args:
+            dm_dict: dict contain pre-create direct message
+            channel_list: list contain pre-create channels
+            login_list: list contain pre-login users
+
+        Returns:
+            N/A
+
+        """
+        params = {'token': login_list[1]['token'], 'query_str': "message",
+                  'u_id': login_list[1]['auth_user_id'], 'channel_id': channel_list[0]['channel_id']}
+        result = requests.get(config.url + 'search/v2', params=params).json()
+        assert [message['message'] for message in result['messages']] == ["pony2's message in pony's channel"]
+        params['channel_id'] = 'pony'
+        resp = requests.get(config.url + 'search/v2', params=params)
+        assert resp.status_code == InputError.code
+
     def test_too_long_query(self, channel_list, login_list):
         """
         Test case that the query string is too long
@@ -309,3 +364,39 @@ class TestNotification:
         result = json.loads(requests.get(config.url + 'notifications/get/v1',
                                          params={'token': login_list[3]['token']}).text)
         assert len(result['notifications']) == 2
+
+
+@pytest.mark.usefixtures("clear")
+class TestSessionStats:
+    """
+    Test cases for the session monitoring counts
+    """
+    def test_num_sessions(self, reg_list, login_list):
+        """Every register and login opens a session"""
+        result = requests.get(config.url + 'sessions/stats/v1', params={'token': reg_list[0]['token']}).json()
+        assert result['num_sessions'] == 8
+
+    def test_not_owner(self, reg_list):
+        """Only a Dreams owner can read the counts"""
+        resp = requests.get(config.url + 'sessions/stats/v1', params={'token': reg_list[1]['token']})
+        assert resp.status_code == AccessError.code
+
+
+@pytest.mark.usefixtures("clear")
+class TestSearchStats:
+    """
+    Test cases for the search cache counts
+    """
+    def test_hits(self, channel_list, login_list):
+        """A repeated search is a hit"""
+        token = login_list[0]['token']
+        before = requests.get(config.url + 'search/stats/v1', params={'token': token}).json()
+        for _ in range(2):
+            requests.get(config.url + 'search/v2', params={'token': token, 'query_str': "pony's channel"})
+        result = requests.get(config.url + 'search/stats/v1', params={'token': token}).json()
+        assert result['hits'] == before['hits'] + 1
+
+    def test_not_owner(self, reg_list):
+        """Only a Dreams owner can read the counts"""
+        resp = requests.get(config.url + 'search/stats/v1', params={'token': reg_list[1]['token']})
+        assert resp.status_code == AccessError.code
@@ -365,3 +365,41 @@ class TestUsersAll:
         })
         # should raise InputError, because the token is invalid
         assert resp.status_code == AccessError.code
+
+
+@pytest.mark.usefixtures("clear")
+class TestUserStats:
+    """
+
+    This class contains a series of tests
+    for the "user_stats" function.
+
+    """
+    def test_involvement_rate(self, users):
+        """
+
+        Test user/stats/v1 reports the involvement rate with the counters
+
+        """
+        requests.post(config.url + 'channels/create/v2', json={
+            'token': users[0]['token'],
+            'name': 'channel',
+            'is_public': True
+        })
+        resp = requests.get(config.url + 'user/stats/v1', params={
+            'token': users[0]['token']
+        })
+        user_stats = json.loads(resp.text)['user_stats']
+        assert user_stats['channels_joined'][-1]['num_channels_joined'] == 1
+        assert user_stats['involvement_rate'] == 1
+
+    def test_invalid_token(self, users):
+        """
+
+        Test user/stats/v1 when the token is invalid
+
+        """
+        resp = requests.get(config.url + 'user/stats/v1', params={
+            'token': -10,
+        })
+        assert resp.status_code == AccessError.code
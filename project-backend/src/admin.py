@@ -1,8 +1,9 @@
-from src.data import load_db, save_db, set_dream_stats
+from src.data import load_db, save_db, transaction, mark_dirty, set_dream_stats
 from src.data import User
 from src.user import user_profile_v2
 from src.error import InputError, AccessError
 
+@transaction
 def admin_user_remove_v1(token, u_id):
     """
 
@@ -42,6 +43,7 @@ def admin_user_remove_v1(token, u_id):
     # reset target's name
     target_user.name['name_fir'] = "Removed"
     target_user.name['name_last'] = "user"
+    mark_dirty('users', u_id)
     # re set target's message
     User.set_message_removeduser(u_id)
     # update database
@@ -50,6 +52,7 @@ def admin_user_remove_v1(token, u_id):
     return {}
 
 
+@transaction
 def admin_userpermission_change_v1(token, u_id, permission_id):
     """
 
@@ -90,6 +93,7 @@ def admin_userpermission_change_v1(token, u_id, permission_id):
     target_user = User.check_u_id_match(u_id)
     # set target's permission_id
     target_user.permission_id = permission_id
+    mark_dirty('users', u_id)
     # update database
     save_db()
     return {}
@@ -1,6 +1,7 @@
-from src.data import User, load_db, save_db, set_dream_stats
+from src.data import User, load_db, save_db, transaction, set_dream_stats
 
 
+@transaction
 def auth_login_v2(email, password):
     """
     Given a registered users' email and password and returns their `auth_user_id` value
@@ -35,6 +36,7 @@ def auth_login_v2(email, password):
     }
 
 
+@transaction
 def auth_register_v2(email, password, name_first, name_last):
     """
     Given a user's first and last name, email address, and password, create a new account for
@@ -85,6 +87,7 @@ def auth_register_v2(email, password, name_first, name_last):
     }
 
 
+@transaction
 def auth_logout_v1(token):
     """
     Given an active token, invalidates the token to log the user out. If a valid token is given, and the user is
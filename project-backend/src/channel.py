@@ -1,7 +1,9 @@
-from src.data import load_db, save_db, User, Channel, Message, set_dream_stats
+from src.data import load_db, save_db, transaction, read_transaction, mark_dirty
+from src.data import User, Channel, Message, set_dream_stats
 from src.error import InputError, AccessError
 
 
+@transaction
 def channel_addowner_v1(token, channel_id, u_id):
     """
     This function make user with user id u_id an owner of this channel
@@ -35,8 +37,9 @@ def channel_addowner_v1(token, channel_id, u_id):
         raise InputError
     # Append the user to become match channel's owner
     match_channel.owner.append(u_id)
+    mark_dirty('channels', match_channel.id)
     if u_id not in match_channel.member:
-        match_channel.member.append(u_id)
+        match_channel.add_member(u_id)
         user = User.check_u_id_match(u_id)
         user.set_user_stats('add_channel')
         set_dream_stats()
@@ -44,6 +47,7 @@ def channel_addowner_v1(token, channel_id, u_id):
     return {}
 
 
+@transaction
 def channel_removeowner_v1(token, channel_id, u_id):
     """
     This function remove user with user id u_id an owner of this channel
@@ -73,10 +77,12 @@ def channel_removeowner_v1(token, channel_id, u_id):
     if len(match_channel.owner) == 1:
         raise InputError
     match_channel.owner.remove(u_id)
+    mark_dirty('channels', match_channel.id)
     save_db()
     return {}
 
 
+@transaction
 def channel_leave_v1(token, channel_id):
     """
     Given a channel ID, the user removed as a member of this channel. Their messages should remain in the channel
@@ -102,9 +108,10 @@ def channel_leave_v1(token, channel_id):
         raise AccessError(description='The user cannot leave channel in standup period')
     if au_id not in match_channel.member:
         raise AccessError
-    match_channel.member.remove(au_id)
+    match_channel.remove_member(au_id)
     if au_id in match_channel.owner:
         match_channel.owner.remove(au_id)
+    mark_dirty('channels', match_channel.id)
     user = User.check_u_id_match(au_id)
     user.set_user_stats('leave_channel')
     set_dream_stats()
@@ -112,6 +119,7 @@ def channel_leave_v1(token, channel_id):
     return{}
 
 
+@transaction
 def channel_invite_v2(token, channel_id, u_id):
     """
     Author (with token) invites a user (with user id u_id)
@@ -160,6 +168,7 @@ def channel_invite_v2(token, channel_id, u_id):
     return {}
 
 
+@read_transaction
 def channel_details_v2(token, channel_id):
     """
     Given a Channel with ID channel_id that the authorised user is part of,
@@ -231,6 +240,7 @@ def channel_details_v2(token, channel_id):
     return channels_dict
 
 
+@transaction
 def channel_join_v2(token, channel_id):
     """
 
@@ -277,6 +287,7 @@ def channel_join_v2(token, channel_id):
     }
 
 
+@read_transaction
 def channel_messages_v2(token, channel_id, start):
     """
 
@@ -1,7 +1,8 @@
-from src.data import User, Channel, load_db, save_db, set_dream_stats
+from src.data import User, Channel, load_db, save_db, transaction, read_transaction, set_dream_stats
 from src.error import AccessError
 
 
+@transaction
 def channels_create_v2(token, name, is_public):
     """
     Creates a new channel with that name that is either a public or private channel
@@ -37,6 +38,7 @@ def channels_create_v2(token, name, is_public):
     }
 
 
+@read_transaction
 def channels_listall_v2(token):
     """
     Given a registered user's token,
@@ -72,6 +74,7 @@ def channels_listall_v2(token):
     return channels_list
 
 
+@read_transaction
 def channels_list_v2(token):
     """
     Provide a list of all channels (and their associated details) that the authorised user is
@@ -1,3 +1,43 @@
 port = 8080
 
 url = f"http://localhost:{port}/"
+
+# database: the storage engine, 'pickle', 'sqlite' or 'sharded', see src/storage.py
+storage_engine = 'pickle'
+# the snapshot file and the write-ahead log appended by every save of the pickle engine
+db_file = 'database.p'
+wal_file = 'database.wal'
+# the database file of the sqlite engine
+sqlite_file = 'database.sqlite3'
+# the directory of the metadata and segment files of the sharded engine
+shard_dir = 'database.shards'
+# the file locked by every request, it also holds the generation of the database
+lock_file = 'database.lock'
+# whether to journal changes in the write-ahead log instead of rewriting the snapshot
+wal_enabled = True
+# number of journal entries after which the snapshot is rebuilt
+checkpoint_interval = 100
+# rebuild the snapshot in a forked child process instead of during the request
+background_snapshot = True
+# keep the database in memory, only reload it when the files are changed by another process
+resident = True
+# seconds a token stays valid after login, None for no limit. Tokens do not expire unless a
+# deployment opts in, for example with 24 * 60 * 60
+session_ttl = None
+# seconds a token stays valid without being used, None for no limit, for example 60 * 60
+session_idle_timeout = None
+# seconds between two updates of the last use of a session, so not every request is saved
+session_touch_interval = 60
+# seconds between two runs of the reaper evicting the expired sessions
+session_reap_interval = 5 * 60
+# the page size of search_v2 when a cursor is given without a limit, and the largest limit
+search_default_limit = 50
+search_max_limit = 1000
+# processes the search of a query the indexes cannot narrow is split across, None for one
+# per core, 0 to search in the request thread, and the number of messages below which it is
+# not split. It is never split across more processes than there are cores, so on a single
+# core the search stays in the request thread
+search_workers = None
+search_parallel_threshold = 20000
+# number of search results kept for the users repeating their searches
+search_cache_size = 256
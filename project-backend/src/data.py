@@ -3,11 +3,16 @@ File of data structure and database
 """
 from src.error import InputError, AccessError
 from src.helper import generate_timestamp, check_tagged
+from src import config
+from src import storage
+from src import search
 import re
-import os
 import jwt
 import hashlib
-from pickle import dump, load
+import functools
+import heapq
+import itertools
+import threading
 
 SECRET = 'aero'
 
@@ -22,7 +27,7 @@ db = {
     'users': list(),
     'channels': list(),
     'direct_messages': list(),
-    'login_token': list(),
+    'sessions': dict(),
     'removed_users': list(),
     'dreams_stats': {
         'channels_exist': [{'num_channels_exist': 0, 'time_stamp': generate_timestamp()}],
@@ -32,41 +37,678 @@ db = {
     }
 }
 
+# sessions: the logged in tokens, key is the token and value is
+# {'u_id': Integer, 'issued': Integer timestamp, 'expires': Integer timestamp or None,
+#  'used': Integer timestamp of the last use, updated every config.session_touch_interval}
+
+# session_monitor: the sessions evicted by this process, for monitoring, see session_stats
+session_monitor = {
+    'num_evicted': 0,
+    'last_reap': generate_timestamp(),
+    'eviction_rate': float(),
+}
+
+# the filters of search_v2: the sender, the channel and the dm searched, and the earliest and
+# latest time the messages were sent at
+SEARCH_FILTERS = ('u_id', 'channel_id', 'dm_id', 'since', 'until')
+
+# result_cache: the messages matched by the last searches of the users, see
+# Message.search_messages. Its entries are dropped whenever db is replaced
+result_cache = search.ResultCache(config.search_cache_size)
+
+# changes: records modified since the last save_db, key is (table, id) and value is the
+# list of modified message ids in that channel or dm, None means the entity itself. The id
+# of a session is its token
+changes = dict()
+
+# touches: the last use of the sessions recorded by the reads of this process since the last
+# save_db, key is the token and value is the timestamp. A read must not modify the database
+# under the shared lock, so they are only saved with the next write or run of the reaper
+touches = dict()
+
+
+def mark_dirty(table='meta', key=None, message_id=None):
+    """
+
+    Record that an entry of the database has been modified, so save_db can journal it
+
+    Args:
+        table: String, 'users', 'channels', 'direct_messages', 'sessions' or 'meta'
+        key: Integer, the id of the modified user, channel or dm, String, the token of the
+             modified session
+        message_id: Integer, the id of the modified message in the channel or dm
+
+    Returns:
+        N/A
+
+    """
+    changes.setdefault((table, key), list()).append(message_id)
+
+
+# indexes: the objects of the indexed tables of db by id, key is the table name and value
+# is {id: object}. 'emails' and 'handles' map the email and the handle of every user in
+# db['users'] to the user, 'handle_suffix' maps a base handle to the lowest numeric suffix
+# which may still be free, see User.generate_handle. 'user_channels' and 'user_dms' map a
+# u_id to {id: object} of the channels and dms the user is a member of. They are rebuilt
+# whenever db is replaced, see get_index. 'messages' maps a message id to (table, id of the
+# channel or dm), built from the ids of the histories, which are known without paging them
+# in. 'positions' maps (table, id) of a channel or dm to {message id: position in its
+# history}, filled one conversation at a time, see Conversation.message_positions.
+# 'terms' and 'trigrams' are the search.TermIndex and search.TrigramIndex of the message
+# contents. They are only built on first use so loading the database does not page in every
+# history. 'senders' maps a u_id to the set of ids of the messages the user sent, and
+# 'times' is the search.TimeIndex of the messages, both serve the filters of search_v2.
+# 'versions' maps (table, id) of a channel or dm to the number of times a
+# message has been sent to, edited in or removed from it, see bump_version. 'counters' holds
+# the number of messages of the channels and dms and the number of users of db['users']
+# who are a member of a channel or a dm, see workspace_total
+INDEXED_TABLES = ('users', 'removed_users', 'channels', 'direct_messages')
+indexes = dict()
+
+
+def rebuild_indexes():
+    """
+
+    Rebuild the indexes from db, after it has been loaded or its tables have been cleared
+
+    """
+    indexes.clear()
+    indexes['db'] = db
+    for table in INDEXED_TABLES:
+        indexes[table] = {entity.id: entity for entity in db[table]}
+    indexes['emails'] = {user.email: user for user in db['users']}
+    indexes['handles'] = {user.handle: user for user in db['users']}
+    indexes['handle_suffix'] = dict()
+    indexes['versions'] = dict()
+    indexes['positions'] = dict()
+    result_cache.clear()
+    indexes['counters'] = {
+        'messages': sum(container.count_messages() for table in ('channels', 'direct_messages')
+                        for container in db[table]),
+        'active_users': sum(1 for user in db['users'] if user.is_active()),
+    }
+    indexes['user_channels'] = dict()
+    for channel in db['channels']:
+        for u_id in channel.member:
+            indexes['user_channels'].setdefault(u_id, dict())[channel.id] = channel
+    indexes['user_dms'] = dict()
+    for dm in db['direct_messages']:
+        for user in dm.users:
+            indexes['user_dms'].setdefault(user.id, dict())[dm.id] = dm
+
+
+def add_membership(index, u_id, conversation):
+    """
+
+    Record in a membership index that the user is a member of the channel or dm
+
+    Args:
+        index: String, 'user_channels' or 'user_dms'
+        u_id: Integer, the user's id
+        conversation: Object, the channel or dm
+
+    Returns:
+        N/A
+
+    """
+    get_index(index).setdefault(u_id, dict())[conversation.id] = conversation
+
+
+def remove_membership(index, u_id, conversation):
+    """
+
+    Remove the channel or dm from the memberships of the user in a membership index
+
+    Args:
+        index: String, 'user_channels' or 'user_dms'
+        u_id: Integer, the user's id
+        conversation: Object, the channel or dm
+
+    Returns:
+        N/A
+
+    """
+    memberships = get_index(index).get(u_id)
+    if memberships is not None:
+        memberships.pop(conversation.id, None)
+
+
+def get_memberships(index, u_id):
+    """
+
+    Get the channels or dms the user is a member of, in the order of db
+
+    Args:
+        index: String, 'user_channels' or 'user_dms'
+        u_id: Integer, the user's id
+
+    Returns:
+        List of the channel or dm objects
+
+    """
+    memberships = get_index(index).get(u_id, dict())
+    # ids are given in creation order, the order of the tables of db
+    return [memberships[key] for key in sorted(memberships)]
+
+
+def build_message_index():
+    """
+
+    Index the channel or dm of every message, from the ids of the histories so none of them
+    is paged in
+
+    Returns:
+        Dictionary, see indexes
+
+    """
+    message_index = dict()
+    for table in ('channels', 'direct_messages'):
+        for container in db[table]:
+            for message_id in container.message_ids():
+                message_index[message_id] = (table, container.id)
+    return message_index
+
+
+def build_content_index(content_index):
+    """
+
+    Index the content of every message of the channels and dms
+
+    Args:
+        content_index: search.TermIndex or search.TrigramIndex, the empty index
+
+    Returns:
+        The filled index
+
+    """
+    for table in ('channels', 'direct_messages'):
+        for container in db[table]:
+            for message in container.messages:
+                content_index.add(message.id, message.content)
+    return content_index
+
+
+def build_sender_index():
+    """
+
+    Index the messages of the channels and dms by the user who sent them
+
+    Returns:
+        Dictionary, see indexes
+
+    """
+    sender_index = dict()
+    for table in ('channels', 'direct_messages'):
+        for container in db[table]:
+            for message in container.messages:
+                sender_index.setdefault(message.owner_id, set()).add(message.id)
+    return sender_index
+
+
+def build_time_index():
+    """
+
+    Index the messages of the channels and dms by the time they were sent
+
+    Returns:
+        search.TimeIndex
+
+    """
+    time_index = search.TimeIndex()
+    time_index.entries = sorted((message.time, message.id) for table in ('channels', 'direct_messages')
+                                for container in db[table] for message in container.messages)
+    return time_index
+
+
+# the indexes which are built on first use, and the functions building them
+LAZY_INDEXES = {
+    'messages': build_message_index,
+    'senders': build_sender_index,
+    'times': build_time_index,
+    'terms': lambda: build_content_index(search.TermIndex()),
+    'trigrams': lambda: build_content_index(search.TrigramIndex()),
+}
+
+# the indexes of the message contents, updated whenever a message is sent, edited or removed
+CONTENT_INDEXES = ('terms', 'trigrams')
+
+
+def index_content(message_id, content):
+    """
+
+    Add a message to the content indexes which have been built
+
+    Args:
+        message_id: Integer, the message's id
+        content: String, the message
+
+    Returns:
+        N/A
+
+    """
+    for table in CONTENT_INDEXES:
+        content_index = built_index(table)
+        if content_index is not None:
+            content_index.add(message_id, content)
+
+
+def unindex_content(message_id, content):
+    """
+
+    Remove a message from the content indexes which have been built
+
+    Args:
+        message_id: Integer, the message's id
+        content: String, the message as it was indexed
+
+    Returns:
+        N/A
+
+    """
+    for table in CONTENT_INDEXES:
+        content_index = built_index(table)
+        if content_index is not None:
+            content_index.remove(message_id, content)
+
+
+def bump_version(conversation):
+    """
+
+    Record that the messages of a channel or dm have changed, the cached search results
+    tagged with its previous version are no longer used
+
+    Args:
+        conversation: Object, the channel or dm
+
+    Returns:
+        N/A
+
+    """
+    versions = get_index('versions')
+    key = (conversation.TABLE, conversation.id)
+    versions[key] = versions.get(key, 0) + 1
+
+
+def index_message(message):
+    """
+
+    Add a sent message to the sender, time and content indexes which have been built
+
+    Args:
+        message: Object, the message
+
+    Returns:
+        N/A
+
+    """
+    sender_index = built_index('senders')
+    if sender_index is not None:
+        sender_index.setdefault(message.owner_id, set()).add(message.id)
+    time_index = built_index('times')
+    if time_index is not None:
+        time_index.add(message.id, message.time)
+    index_content(message.id, message.content)
+
+
+def unindex_message(message):
+    """
+
+    Remove a message from the sender, time and content indexes which have been built
+
+    Args:
+        message: Object, the message
+
+    Returns:
+        N/A
+
+    """
+    sender_index = built_index('senders')
+    if sender_index is not None:
+        sent = sender_index.get(message.owner_id)
+        if sent is not None:
+            sent.discard(message.id)
+    time_index = built_index('times')
+    if time_index is not None:
+        time_index.remove(message.id, message.time)
+    unindex_content(message.id, message.content)
+
+
+def built_index(table):
+    """
+
+    Get an index which is built on first use, only if it has been built for the current db
+
+    Args:
+        table: String, 'messages', 'senders', 'times', 'terms' or 'trigrams'
+
+    Returns:
+        The index, None if it has not been built
+
+    """
+    if indexes.get('db') is not db:
+        return None
+    return indexes.get(table)
+
+
+def get_index(table):
+    """
+
+    Get the index of a table of db
+
+    Args:
+        table: String, 'users', 'removed_users', 'channels', 'direct_messages', 'emails',
+               'handles', 'handle_suffix', 'versions', 'positions', 'counters',
+               'user_channels', 'user_dms', 'messages', 'senders', 'times', 'terms' or
+               'trigrams'
+
+    Returns:
+        The index, a dictionary except for 'times', 'terms' and 'trigrams'
+
+    """
+    if indexes.get('db') is not db:
+        rebuild_indexes()
+    if table in LAZY_INDEXES and table not in indexes:
+        indexes[table] = LAZY_INDEXES[table]()
+    return indexes[table]
+
+
+def transaction(function):
+    """
+
+    Decorator of the functions which load and save the database. The database lock is
+    held for the whole call, so the requests of other threads and other worker processes
+    are serialised and none of them loses the updates of another
+
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with storage.lock:
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def read_transaction(function):
+    """
+
+    Decorator of the functions which only read the database. The database lock is held
+    shared, so the read requests of several worker processes run at the same time. A call
+    which turns out to modify the database is run again under the exclusive lock, its
+    changes are reloaded away first. The last use of a session is not such a change, see
+    touches
+
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            with storage.lock.read():
+                return function(*args, **kwargs)
+        except storage.SharedLockError:
+            with storage.lock:
+                return function(*args, **kwargs)
+    return wrapper
+
 
 def load_db():
     """
 
-    A function to load database from pickle file
+    A function to load database with the storage engine in config. In resident mode
+    the database stays in memory and is only reloaded when another writer has changed the
+    files, or when a failed request left unsaved changes behind. The unsaved touches of the
+    sessions are applied again to the loaded database. A request called by another one,
+    with the lock already held, keeps the database of its caller
 
     """
     global db
-    if os.access('database.p', os.R_OK) and os.path.getsize('database.p') > 0:
-        try:
-            with open('database.p', 'rb') as f:
-                db = load(f)
-        except EOFError:
-            return
+    if storage.lock.depth > 1:
+        return
+    if config.resident and not is_dirty() and not storage.is_changed():
+        return
+    loaded = storage.load()
+    changes.clear()
+    if loaded is None:
+        return
+    db = loaded
+    migrate_sessions()
+    apply_touches()
+    rebuild_indexes()
+
+
+def apply_touches():
+    """
+
+    Set the last use of the sessions touched since the last save_db, unless the loaded
+    database has a later one. The touches of evicted sessions are dropped
+
+    """
+    for token, used in list(touches.items()):
+        session = db['sessions'].get(token)
+        if session is None:
+            del touches[token]
+        elif session.get('used', session['issued']) < used:
+            session['used'] = used
+
+
+def migrate_sessions():
+    """
+
+    Move the tokens of a database saved with the login_token list into the session table
+
+    """
+    if 'login_token' not in db:
+        return
+    sessions = db.setdefault('sessions', dict())
+    for token in db.pop('login_token'):
+        if token not in sessions:
+            sessions[token] = new_session(decode_token(token)['u_id'])
+            mark_dirty('sessions', token)
+
+
+def new_session(u_id):
+    """
+
+    Create the session record of a token
+
+    Args:
+        u_id: Integer, the id of the logged in user
+
+    Returns:
+        Dictionary, see db['sessions']
+
+    """
+    now = generate_timestamp()
+    expires = None if config.session_ttl is None else now + config.session_ttl
+    return {'u_id': u_id, 'issued': now, 'expires': expires, 'used': now}
+
+
+def is_expired(session, now):
+    """
+
+    Check whether a session has passed its expiry or has been idle for too long
+
+    Args:
+        session: Dictionary, see db['sessions']
+        now: Integer, the current timestamp
+
+    Returns:
+        True if the session is no longer valid
+
+    """
+    if session['expires'] is not None and session['expires'] <= now:
+        return True
+    idle_timeout = config.session_idle_timeout
+    return idle_timeout is not None and session.get('used', session['issued']) + idle_timeout <= now
+
+
+def evict_sessions(tokens):
+    """
+
+    Remove the sessions of the tokens from db and count them as evicted
+
+    Args:
+        tokens: List, the tokens to evict
+
+    Returns:
+        N/A
+
+    """
+    sessions = db['sessions']
+    for token in tokens:
+        del sessions[token]
+        mark_dirty('sessions', token)
+    session_monitor['num_evicted'] += len(tokens)
+
+
+@transaction
+def reap_sessions():
+    """
+
+    Evict every expired session and save the touches of the sessions in one save, and
+    update the eviction rate
+
+    Returns:
+        Integer, the number of evicted sessions
+
+    """
+    load_db()
+    now = generate_timestamp()
+    expired = [token for token, session in db['sessions'].items() if is_expired(session, now)]
+    evict_sessions(expired)
+    for token in touches:
+        mark_dirty('sessions', token)
+    save_db()
+    elapsed = now - session_monitor['last_reap']
+    session_monitor['eviction_rate'] = len(expired) / elapsed if elapsed > 0 else float(len(expired))
+    session_monitor['last_reap'] = now
+    return len(expired)
+
+
+def start_session_reaper(interval=None):
+    """
+
+    Run reap_sessions in a daemon thread every config.session_reap_interval seconds
+
+    Args:
+        interval: Number, seconds between two runs, config.session_reap_interval if None
+
+    Returns:
+        threading.Event, set it to stop the reaper
+
+    """
+    if interval is None:
+        interval = config.session_reap_interval
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            reap_sessions()
+
+    threading.Thread(target=run, name='session-reaper', daemon=True).start()
+    return stop
+
+
+def session_stats():
+    """
+
+    The current number of sessions and the evictions of this process
+
+    Returns:
+        Dictionary
+        {
+        num_sessions: Integer, the number of logged in tokens
+        num_evicted: Integer, the number of sessions evicted since the start
+        eviction_rate: Float, the sessions evicted per second by the last reaper run
+        }
+
+    """
+    return {
+        'num_sessions': len(db['sessions']),
+        'num_evicted': session_monitor['num_evicted'],
+        'eviction_rate': session_monitor['eviction_rate'],
+    }
 
 
-def save_db():
+def search_stats():
     """
 
-    A function to save databse to a pickle file
+    How often the searches of this process were answered by the result cache
+
+    Returns:
+        Dictionary
+        {
+        num_entries: Integer, the number of cached searches
+        hits: Integer, the number of searches answered by the cache
+        misses: Integer, the number of searches which were not
+        hit_rate: Float, the share of the searches answered by the cache
+        }
+
+    """
+    return result_cache.stats()
+
+
+@functools.lru_cache(maxsize=4096)
+def decode_token(token):
+    """
+
+    Verify and decode a token, the payload of a token is only decoded once
+
+    Args:
+        token: String, the token
+
+    Returns:
+        Dictionary, the payload of the token
+
+    """
+    return jwt.decode(token, SECRET, algorithms=['HS256'])
+
+
+def is_dirty():
+    """
+
+    Check whether the database has been modified since it was last loaded or saved
+
+    Returns:
+        True if there is any change not been saved
+
+    """
+    return len(changes) > 0
+
+
+def save_db(checkpoint=False):
+    """
+
+    A function to save databse, only the changes are written by the storage engine unless
+    checkpoint is True. Nothing is written if the database is not modified, the touches of
+    the sessions are saved along with the other changes
 
     """
     global db
-    # if os.path.exists('database.p'):
-    #     os.remove('database.p')
-    with open('database.p', 'wb') as f:
-        dump(db, f)
+    if not is_dirty() and not checkpoint:
+        return
+    for token in touches:
+        mark_dirty('sessions', token)
+    touches.clear()
+    storage.save(db, changes, checkpoint)
+    changes.clear()
     return
 
 
 def get_dream_stats():
     return db['dreams_stats']
 
+def workspace_total():
+    """
+
+    The number of channels, dms and messages, the denominator of the involvement rates
+
+    Returns:
+        Integer
+
+    """
+    return len(db['channels']) + len(db['direct_messages']) + get_index('counters')['messages']
+
+
 def set_dream_stats(num=0, action=''):
-    User.update_all_user_stats()
+    mark_dirty()
     time = generate_timestamp()
 
     if action == 'add_channel':
@@ -94,15 +736,11 @@ def set_dream_stats(num=0, action=''):
         db['dreams_stats']['messages_exist'].append(
             {'num_messages_exist': prev_num - num, 'time_stamp': time})
 
-    num_join = 0
     num_user = len(db['users'])
-    for user in db['users']:
-        if user.user_stats['channels_joined'][-1]['num_channels_joined'] > 0 or user.user_stats['dms_joined'][-1]['num_dms_joined'] > 0:
-            num_join += 1
     if num_user == 0:
         utilization_rate = 0.0
     else:
-        utilization_rate = num_join / num_user
+        utilization_rate = get_index('counters')['active_users'] / num_user
     db['dreams_stats']['utilization_rate'] = utilization_rate
 
     return
@@ -129,6 +767,7 @@ class User:
         # auth_id: integer to verify login user
         # self.auth_id = self.id
         db['uid_root'] += 1
+        mark_dirty()
         # email: string
         self.email = email
         # password: string
@@ -149,7 +788,6 @@ class User:
             'channels_joined': [{'num_channels_joined': 0, 'time_stamp': generate_timestamp()}],
             'dms_joined': [{'num_dms_joined': 0, 'time_stamp': generate_timestamp()}],
             'messages_sent': [{'num_messages_sent': 0, 'time_stamp': generate_timestamp()}],
-            'involvement_rate': float()
         }
 
     def check_first_user(self):
@@ -158,11 +796,7 @@ class User:
         Check all the user's permission, if no Dream user exist, set the current user to Dream owner
 
         """
-        has_owner = False
-        for user in db['users']:
-            if user.permission_id == 1:
-                has_owner = True
-
+        has_owner = any(user.permission_id == 1 for user in db['users'])
         if not has_owner:
             self.permission_id = 1
 
@@ -181,8 +815,9 @@ class User:
         }
         program_root += 1
         token = jwt.encode(payload, SECRET, algorithm='HS256')
-        if token not in db['login_token']:
-            db['login_token'].append(token)
+        if token not in db['sessions']:
+            db['sessions'][token] = new_session(self.id)
+            mark_dirty('sessions', token)
         return token
 
     @staticmethod
@@ -216,8 +851,8 @@ class User:
             False if unsuccess
 
         """
-        if token in db['login_token']:
-            db['login_token'].remove(token)
+        if db['sessions'].pop(token, None) is not None:
+            mark_dirty('sessions', token)
             return True
         return False
 
@@ -286,9 +921,8 @@ class User:
             InputError: If the email is been used by other user
 
         """
-        for exist_user in db['users']:
-            if exist_user.email == email:
-                raise InputError
+        if email in get_index('emails'):
+            raise InputError
 
     @staticmethod
     def check_password_length(password):
@@ -344,19 +978,17 @@ class User:
         handle = name_first.lower() + name_last.lower()
         handle = re.sub(regx, '', handle)
         handle = handle[:20]
-        new_handle = handle
-        i = 0
-        while 1:
-            is_repeat = False
-            for exist_user in db["users"]:
-                if exist_user.handle == new_handle:
-                    is_repeat = True
-                    new_handle = handle + str(i)
-                    i += 1
-                    break
-            if not is_repeat:
-                break
-        return new_handle
+        handles = get_index('handles')
+        if handle not in handles:
+            return handle
+        # the first free one of handle0, handle1, ..., every suffix below the counter is
+        # known to be taken
+        suffix_counter = get_index('handle_suffix')
+        i = suffix_counter.get(handle, 0)
+        while handle + str(i) in handles:
+            i += 1
+        suffix_counter[handle] = i
+        return handle + str(i)
 
     @staticmethod
     def check_email_password_match(email, password):
@@ -368,57 +1000,134 @@ class User:
             password: String, the user's password
 
         Returns:
-            N/A
+            Object, the matched user
 
         Raises:
             InputError: When the email and password are not match
 
         """
-        for exist_user in db["users"]:
-            if exist_user.email == email and exist_user.password == User.encrypt_password(password):
-                return exist_user
-        raise InputError
+        exist_user = get_index('emails').get(email)
+        if exist_user is None or exist_user.password != User.encrypt_password(password):
+            raise InputError
+        return exist_user
 
     @staticmethod
     def token_to_id(token):
         """
 
+        Look up the user of a token in the session table
+
         Args:
-            token: Integer, auth_user_id
+            token: String, the user's token
 
         Returns:
             id: Integer, user's id
 
+        Raises:
+            AccessError: When the token is not logged in or has expired
+
         """
-        # for exist_user in db["users"]:
-        #     if exist_user.auth_id == token:
-        #         return exist_user.id
-        if token in db['login_token']:
-            preload = jwt.decode(token, SECRET, algorithms=['HS256'])
-            User.check_u_id_match(preload['u_id'])
-            return preload['u_id']
-        else:
+        session = db['sessions'].get(token)
+        if session is None:
+            raise AccessError
+        now = generate_timestamp()
+        # an expired session is left for the reaper, a failed request saves nothing
+        if is_expired(session, now):
             raise AccessError
+        if now - session.get('used', session['issued']) >= config.session_touch_interval:
+            session['used'] = now
+            touches[token] = now
+        User.check_u_id_match(session['u_id'])
+        return session['u_id']
 
     @staticmethod
     def build_tagged_list(tagged_users, handle_list):
+        handles = get_index('handles')
         for handle in handle_list:
-            for user in db['users']:
-                if user.handle == handle:
-                    tagged_users.append(user.id)
+            if handle in handles:
+                tagged_users.append(handles[handle].id)
         return
 
-    def add_to_db(self):
+    def add_to_db(self):
+        """
+        Add the current user to the database, if the user is the first user, let him become a
+        Dream owner
+
+        Returns:
+            N/A
+
+        """
+        # global db
+        db['users'].append(self)
+        get_index('users')[self.id] = self
+        get_index('emails')[self.email] = self
+        get_index('handles')[self.handle] = self
+        mark_dirty('users', self.id)
+
+    def set_email(self, email):
+        """
+
+        Change the email of the user and its entry in the email index
+
+        Args:
+            email: String, the new email
+
+        Returns:
+            N/A
+
+        """
+        emails = get_index('emails')
+        if emails.get(self.email) is self:
+            del emails[self.email]
+        self.email = email
+        emails[email] = self
+        mark_dirty('users', self.id)
+
+    def set_handle(self, handle):
+        """
+
+        Change the handle of the user and its entry in the handle index
+
+        Args:
+            handle: String, the new handle
+
+        Returns:
+            N/A
+
+        """
+        User.release_handle(self.handle, self)
+        self.handle = handle
+        get_index('handles')[handle] = self
+        mark_dirty('users', self.id)
+
+    @staticmethod
+    def release_handle(handle, user):
         """
-        Add the current user to the database, if the user is the first user, let him become a
-        Dream owner
+
+        Remove a handle of the user from the handle index, so it can be generated again
+
+        Args:
+            handle: String, the handle to release
+            user: Object, the user holding it
 
         Returns:
             N/A
 
         """
-        # global db
-        db['users'].append(self)
+        handles = get_index('handles')
+        if handles.get(handle) is not user:
+            return
+        del handles[handle]
+        # the handle may be base + suffix of any base it starts with, lower the counter
+        # of those bases so the suffix is tried again
+        suffix_counter = get_index('handle_suffix')
+        for split in range(len(handle) - 1, 0, -1):
+            suffix = handle[split:]
+            if not suffix.isdigit():
+                break
+            base = handle[:split]
+            if str(int(suffix)) == suffix and suffix_counter.get(base, 0) > int(suffix):
+                suffix_counter[base] = int(suffix)
 
     @staticmethod
     def check_u_id_match(u_id):
@@ -433,10 +1142,10 @@ class User:
         Raise:
             InputError: u_id does not refer to a valid user.
         """
-        for exist_user in db['users']:
-            if exist_user.id == u_id:
-                return exist_user
-        raise InputError
+        exist_user = get_index('users').get(u_id)
+        if exist_user is None:
+            raise InputError
+        return exist_user
 
     def transfer_to_user(self):
         """
@@ -457,6 +1166,21 @@ class User:
         user['profile_img_url'] = self.img_info['img_url']
         return user
 
+    def transfer_to_stats(self):
+        """
+        transfer the stats of the user into a dict, the involvement rate is computed as it
+        is read
+
+        Args:
+            N/A
+
+        Returns:
+            user_stats: dict
+        """
+        user_stats = dict(self.user_stats)
+        user_stats['involvement_rate'] = self.involvement_rate()
+        return user_stats
+
     @staticmethod
     def check_handle_valid(handle_str):
         """
@@ -473,9 +1197,8 @@ class User:
         """
         if len(handle_str) < 3 or len(handle_str) > 20:
             raise InputError
-        for exist_user in db['users']:
-            if exist_user.handle == handle_str:
-                raise InputError
+        if handle_str in get_index('handles'):
+            raise InputError
 
     @staticmethod
     def channel_tag_notification(user_id, au_handle, channel, message):
@@ -493,11 +1216,11 @@ class User:
 
         """
         note_message = f"{au_handle} tagged you in {channel.name}: {message}"
-        for _, user in enumerate(db['users']):
-            if user.id == user_id:
-                notification = Notification(channel.id, -1, note_message)
-                user.notifications.append(notification)
-                break
+        user = get_index('users').get(user_id)
+        if user is not None:
+            notification = Notification(channel.id, -1, note_message)
+            user.notifications.append(notification)
+            mark_dirty('users', user.id)
         return
 
     @staticmethod
@@ -515,11 +1238,11 @@ class User:
 
         """
         note_message = f"{au_handle} added you to {channel.name}"
-        for _, user in enumerate(db['users']):
-            if user.id == user_id:
-                notification = Notification(channel.id, -1, note_message)
-                user.notifications.append(notification)
-                break
+        user = get_index('users').get(user_id)
+        if user is not None:
+            notification = Notification(channel.id, -1, note_message)
+            user.notifications.append(notification)
+            mark_dirty('users', user.id)
         return
 
     @staticmethod
@@ -538,11 +1261,11 @@ class User:
 
         """
         note_message = f"{au_handle} tagged you in {dm.name}: {message}"
-        for _, user in enumerate(db['users']):
-            if user.id == user_id:
-                notification = Notification(-1, dm.id, note_message)
-                user.notifications.append(notification)
-                break
+        user = get_index('users').get(user_id)
+        if user is not None:
+            notification = Notification(-1, dm.id, note_message)
+            user.notifications.append(notification)
+            mark_dirty('users', user.id)
         return
 
     @staticmethod
@@ -560,11 +1283,11 @@ class User:
 
         """
         note_message = f"{au_handle} added you to {dm.name}"
-        for _, user in enumerate(db['users']):
-            if user.id == user_id:
-                notification = Notification(-1, dm.id, note_message)
-                user.notifications.append(notification)
-                break
+        user = get_index('users').get(user_id)
+        if user is not None:
+            notification = Notification(-1, dm.id, note_message)
+            user.notifications.append(notification)
+            mark_dirty('users', user.id)
         return
 
     @staticmethod
@@ -601,38 +1324,38 @@ class User:
         """
         target_user = User.check_u_id_match(u_id)
 
-        for channel_i in range(len(db['channels'])):
-            for message_i in range(len(db['channels'][channel_i].messages)):
-                if db['channels'][channel_i].messages[message_i].owner_id == u_id:
-                    db['channels'][channel_i].messages[message_i].content = "Removed user"
-
-        for dm_i in range(len(db['direct_messages'])):
-            for dm_message_i in db['direct_messages'][dm_i].messages:
-                if db['direct_messages'][dm_i].messages[dm_message_i].owner_id == u_id:
-                    db['direct_messages'][dm_i].messages[dm_message_i].content = "Removed user"
-
-        db['removed_users'].append(target_user)
-
         for channel in db['channels']:
-            for member_uid in channel.member:
-                if member_uid == u_id:
-                    channel.member.remove(member_uid)
-                    break
+            for message in channel.messages:
+                if message.owner_id == u_id:
+                    channel.set_content(message, "Removed user")
 
         for dm in db['direct_messages']:
-            for member_uid in dm.users:
-                if member_uid == u_id:
-                    dm.users.remove(member_uid)
-                    break
-
-        for token_id in db['login_token']:
-            if User.token_to_id(token_id) == u_id:
-                db['login_token'].remove(token_id)
+            for message in dm.messages:
+                if message.owner_id == u_id:
+                    dm.set_content(message, "Removed user")
 
-        for index in range(len(db['users'])):
-            if db['users'][index].id == u_id:
-                db['users'].pop(index)
-                break
+        db['removed_users'].append(target_user)
+        get_index('removed_users')[u_id] = target_user
+        mark_dirty('users', u_id)
+
+        for channel in get_memberships('user_channels', u_id):
+            channel.remove_member(u_id)
+
+        for dm in get_memberships('user_dms', u_id):
+            DirectMessage.dm_leave(u_id, dm.id)
+
+        sessions = db['sessions']
+        for token_id in [token_id for token_id, session in sessions.items() if session['u_id'] == u_id]:
+            del sessions[token_id]
+            mark_dirty('sessions', token_id)
+
+        db['users'].remove(target_user)
+        del get_index('users')[u_id]
+        if target_user.is_active():
+            get_index('counters')['active_users'] -= 1
+        if get_index('emails').get(target_user.email) is target_user:
+            del get_index('emails')[target_user.email]
+        User.release_handle(target_user.handle, target_user)
         return
 
     @staticmethod
@@ -649,13 +1372,11 @@ class User:
 
     @staticmethod
     def check_u_id_match_in_removed(u_id):
-        for removed_user in db['removed_users']:
-            if removed_user.id == u_id:
-                return removed_user
-        return None
+        return get_index('removed_users').get(u_id)
 
     def set_user_stats(self, action=''):
         time = generate_timestamp()
+        active = self.is_active()
         if action == 'join_channel':
             prev_num = self.user_stats['channels_joined'][-1]['num_channels_joined']
             self.user_stats['channels_joined'].append(
@@ -677,73 +1398,282 @@ class User:
             self.user_stats['messages_sent'].append(
                 {'num_messages_sent': prev_num + 1, 'time_stamp': time})
 
-        messages_exist = 0
-        for channel in db['channels']:
-            messages_exist += len(channel.messages)
-        for dm in db['direct_messages']:
-            messages_exist += len(dm.messages)
-        denominator = len(db['channels']) + len(db['direct_messages']) + messages_exist
-
-        if denominator == 0:
-            involvement_rate = 0.0
-            print(f'deno: {denominator}')
-        else:
-            numerator = self.user_stats['channels_joined'][-1]['num_channels_joined'] + \
-                        self.user_stats['dms_joined'][-1]['num_dms_joined'] + \
-                        self.user_stats['messages_sent'][-1]['num_messages_sent']
-            involvement_rate = numerator / denominator
-            print(f'num:{numerator}')
-            print(f'deno: {denominator}')
-
-        self.user_stats['involvement_rate'] = involvement_rate
+        if self.is_active() != active and get_index('users').get(self.id) is self:
+            get_index('counters')['active_users'] += -1 if active else 1
+        mark_dirty('users', self.id)
         return
 
-    @staticmethod
-    def update_all_user_stats():
-        for user in db['users']:
-            channels_exist = len(db['channels'])
-            dms_exist = len(db['direct_messages'])
-            messages_exist = 0
-            for channel in db['channels']:
-                messages_exist += len(channel.messages)
-            for dm in db['direct_messages']:
-                messages_exist += len(dm.messages)
-
-            numerator = (user.user_stats['channels_joined'][-1]['num_channels_joined'] +
-                         user.user_stats['dms_joined'][-1]['num_dms_joined'] +
-                         user.user_stats['messages_sent'][-1]['num_messages_sent'])
-            denominator = channels_exist + dms_exist + messages_exist
-
-            if denominator != 0:
-                new_involvement_rate = numerator / denominator
-                user.user_stats['involvement_rate'] = new_involvement_rate
-            else:
-                user.user_stats['involvement_rate'] = 0
+    def is_active(self):
+        """Whether the user is a member of a channel or a dm, as counted by the utilization rate"""
+        return (self.user_stats['channels_joined'][-1]['num_channels_joined'] > 0
+                or self.user_stats['dms_joined'][-1]['num_dms_joined'] > 0)
 
-        return
+    def involvement_rate(self):
+        """
+
+        Compute the involvement rate of the user from the user's counters, it is not stored
+        since it changes with every channel, dm and message of the workspace
+
+        Returns:
+            Float, the involvement rate
+
+        """
+        total = workspace_total()
+        numerator = (self.user_stats['channels_joined'][-1]['num_channels_joined'] +
+                     self.user_stats['dms_joined'][-1]['num_dms_joined'] +
+                     self.user_stats['messages_sent'][-1]['num_messages_sent'])
+        return numerator / total if total != 0 else 0
+
+
+class OrderedSet:
+    """
+    The members of a channel or dm, iterated in the order they were added, with constant
+    time membership tests and removals
+
+    Attributes:
+        _items: Dictionary, the members as keys in insertion order, the values are unused
+    """
+
+    def __init__(self, items=()):
+        self._items = dict.fromkeys(items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return f'OrderedSet({list(self._items)!r})'
+
+    def append(self, item):
+        """
+
+        Add an item after the others, nothing is done if it is already a member
+
+        """
+        self._items[item] = None
+
+    def extend(self, items):
+        for item in items:
+            self._items[item] = None
+
+    def remove(self, item):
+        """
+
+        Remove an item
+
+        Raises:
+            ValueError: When the item is not a member, like list.remove
+
+        """
+        if item not in self._items:
+            raise ValueError(f'{item!r} not in OrderedSet')
+        del self._items[item]
+
+
+class Conversation:
+    """
+    The base class of channel and dm, which own a message history. The history can be
+    paged out by the storage engine and is only loaded back on first access
+
+    Attributes:
+        TABLE: String, the key of db where the conversations are stored
+        MEMBERSHIP: Tuple, the attributes holding an OrderedSet of members
+    """
+
+    TABLE = str()
+    MEMBERSHIP = tuple()
+
+    @property
+    def messages(self):
+        """
+
+        The message history, paged in from the storage engine on first access
+
+        Returns:
+            List of message objects
+
+        """
+        if self._messages is None:
+            self._messages = storage.load_messages(self.TABLE, self.id)
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages):
+        self._messages = messages
+
+    def page_out(self, message_ids):
+        """
+
+        Drop the message history from memory, it will be loaded again on first access
+
+        Args:
+            message_ids: List of integers, the ids of the messages in the history, in order
+
+        Returns:
+            N/A
+
+        """
+        self._messages = None
+        self._message_ids = message_ids
+
+    def message_ids(self):
+        """
+
+        The ids of the messages, without paging in the history
+
+        Returns:
+            List of integers, the ids in the order of the history
+
+        """
+        if self._messages is None and self._message_ids is not None:
+            return self._message_ids
+        return [message.id for message in self.messages]
+
+    def count_messages(self):
+        """
+
+        Count the messages without paging in the history
+
+        Returns:
+            Integer, the number of messages
+
+        """
+        if self._messages is None and self._message_ids is not None:
+            return len(self._message_ids)
+        return len(self.messages)
+
+    def message_positions(self):
+        """
+
+        The position of every message in the history, indexed on first use from the ids of
+        the history so it is not paged in
+
+        Returns:
+            Dictionary, key is the message id, value is its position
+
+        """
+        positions = get_index('positions')
+        key = (self.TABLE, self.id)
+        if key not in positions:
+            positions[key] = {message_id: position for position, message_id in enumerate(self.message_ids())}
+        return positions[key]
+
+    def append_message(self, message):
+        """
+
+        Add a message at the end of the history
+
+        Args:
+            message: Object, the message
+
+        Returns:
+            N/A
+
+        """
+        self.messages.append(message)
+        message_index = built_index('messages')
+        if message_index is not None:
+            message_index[message.id] = (self.TABLE, self.id)
+        positions = get_index('positions').get((self.TABLE, self.id))
+        if positions is not None:
+            positions[message.id] = len(self.messages) - 1
+        index_message(message)
+        get_index('counters')['messages'] += 1
+        bump_version(self)
+        mark_dirty(self.TABLE, self.id, message.id)
+
+    def delete_message(self, position):
+        """
+
+        Remove the message at a position of the history, the later messages move up
+
+        Args:
+            position: Integer, the position of the message
+
+        Returns:
+            N/A
+
+        """
+        messages = self.messages
+        message = messages.pop(position)
+        message_index = built_index('messages')
+        if message_index is not None:
+            message_index.pop(message.id, None)
+        positions = get_index('positions').get((self.TABLE, self.id))
+        if positions is not None:
+            positions.pop(message.id, None)
+            for later in range(position, len(messages)):
+                positions[messages[later].id] = later
+        unindex_message(message)
+        get_index('counters')['messages'] -= 1
+        bump_version(self)
+        mark_dirty(self.TABLE, self.id, message.id)
+
+    def set_content(self, message, content):
+        """
 
+        Change the content of a message of the history
 
-class Channel:
+        Args:
+            message: Object, the message
+            content: String, the new content
+
+        Returns:
+            N/A
+
+        """
+        unindex_content(message.id, message.content)
+        index_content(message.id, content)
+        message.content = content
+        bump_version(self)
+        mark_dirty(self.TABLE, self.id, message.id)
+
+    def __setstate__(self, state):
+        # objects pickled before the history could be paged out
+        if 'messages' in state:
+            state['_messages'] = state.pop('messages')
+        # objects paged out when only the number of messages was kept, their ids are not
+        # known until the history is paged in
+        if '_message_count' in state:
+            del state['_message_count']
+            state['_message_ids'] = None
+        # objects pickled when the members were kept in lists
+        for name in self.MEMBERSHIP:
+            if isinstance(state.get(name), list):
+                state[name] = OrderedSet(state[name])
+        self.__dict__.update(state)
+
+
+class Channel(Conversation):
     """
     The channel's class, each channel will be an object and store in db['channels']
         id: Integer:
-        owner: list of integer
-        member: list of integer
+        owner: OrderedSet of integer
+        member: OrderedSet of integer
         name: string
         is_public: boolean
         messages: list of objects
     """
 
+    TABLE = 'channels'
+    MEMBERSHIP = ('owner', 'member')
+
     def __init__(self, u_id, name, is_public):
         global db
         # id: integer
         self.id = db['cid_root'] + 1
         db['cid_root'] += 1
-        # owner: list contain the channel owner's u_id
-        self.owner = []
+        mark_dirty()
+        # owner: ordered set contain the channel owner's u_id
+        self.owner = OrderedSet()
         self.owner.append(u_id)
-        # member: list contain the channel member's u_id
-        self.member = []
+        # member: ordered set contain the channel member's u_id
+        self.member = OrderedSet()
         self.member.append(u_id)
         # name: string
         self.name = name
@@ -797,6 +1727,10 @@ class Channel:
 
         """
         db['channels'].append(self)
+        get_index('channels')[self.id] = self
+        for u_id in self.member:
+            add_membership('user_channels', u_id, self)
+        mark_dirty('channels', self.id)
 
     @staticmethod
     def check_channel_id_match(channel_id):
@@ -811,10 +1745,10 @@ class Channel:
         Raise:
             InputError: channel_id does not refer to a valid channel.
         """
-        for exist_channel in db['channels']:
-            if exist_channel.id == channel_id:
-                return exist_channel
-        raise InputError(description='Channel ID is not a valid channel')
+        exist_channel = get_index('channels').get(channel_id)
+        if exist_channel is None:
+            raise InputError(description='Channel ID is not a valid channel')
+        return exist_channel
 
     def check_user_access(self, u_id):
         """
@@ -836,9 +1770,9 @@ class Channel:
         global db
         if self.is_public:
             return
-        for user in db['users']:
-            if user.id == u_id and user.permission_id == 1:
-                return
+        user = get_index('users').get(u_id)
+        if user is not None and user.permission_id == 1:
+            return
         raise AccessError
 
     def check_member_existence(self, u_id):
@@ -857,14 +1791,19 @@ class Channel:
             True or False
 
         """
-        for exist_member in self.member:
-            if exist_member == u_id:
-                return True
-        return False
+        return u_id in self.member
 
     def add_member(self, u_id):
         """Adds user (with u_id) to that channel"""
         self.member.append(u_id)
+        add_membership('user_channels', u_id, self)
+        mark_dirty('channels', self.id)
+
+    def remove_member(self, u_id):
+        """Removes user (with u_id) from the members of that channel"""
+        self.member.remove(u_id)
+        remove_membership('user_channels', u_id, self)
+        mark_dirty('channels', self.id)
 
     @staticmethod
     def list_v2(u_id):
@@ -879,13 +1818,11 @@ class Channel:
         """
         channels_list = dict()
         channels_list['channels'] = list()
-        for channel in db['channels']:
-            for member in channel.member:
-                information = dict()
-                if member == u_id:
-                    information['channel_id'] = channel.id
-                    information['name'] = channel.name
-                    channels_list['channels'].append(information)
+        for channel in get_memberships('user_channels', u_id):
+            information = dict()
+            information['channel_id'] = channel.id
+            information['name'] = channel.name
+            channels_list['channels'].append(information)
         return channels_list
 
     @staticmethod
@@ -918,16 +1855,19 @@ class Channel:
     def start_standup(self, length):
         self.standup_info['is_standup'] = True
         self.standup_info['time_finish'] = generate_timestamp() + length
+        mark_dirty('channels', self.id)
 
     @staticmethod
+    @transaction
     def end_standup(channel_id, u_id):
         load_db()
         match_channel = Channel.check_channel_id_match(channel_id)
         new_message = Message(u_id, match_channel.standup_info['message'])
-        match_channel.messages.append(new_message)
+        match_channel.append_message(new_message)
         match_channel.standup_info['is_standup'] = False
         match_channel.standup_info['message'] = str()
         match_channel.standup_info['time_finish'] = int()
+        mark_dirty('channels', match_channel.id)
         user = User.check_u_id_match(u_id)
         user.set_user_stats('send_message')
         set_dream_stats(num=1, action='add_message')
@@ -935,13 +1875,15 @@ class Channel:
 
     def modify_standup_message(self, user, message):
         self.standup_info['message'] += f'{user.handle}: {message}\n'
+        mark_dirty('channels', self.id)
 
     @staticmethod
+    @transaction
     def send_late_message(channel_id, late_message):
         load_db()
-        for channel in db['channels']:
-            if channel.id == channel_id:
-                channel.messages.append(late_message)
+        channel = get_index('channels').get(channel_id)
+        if channel is not None:
+            channel.append_message(late_message)
         user = User.check_u_id_match(late_message.owner_id)
         user.set_user_stats('send_message')
         set_dream_stats(num=1, action='add_message')
@@ -963,6 +1905,7 @@ class Message:
         # id: integer
         self.id = db['mid_root'] + 1
         db['mid_root'] += 1
+        mark_dirty()
         # owner_id: integer the owner's u_id
         self.owner_id = u_id
         # content: string the content of the message
@@ -1022,27 +1965,227 @@ class Message:
         message['is_pinned'] = self.is_pin
         return message
 
+    def transfer_to_result(self, user_id):
+        """
+
+        Create the dictionary of the message returned to a user, with the user's reacts
+
+        Args:
+            user_id: Integer, the user's id
+
+        Returns:
+            A dictionary of message
+
+        """
+        reacts = list()
+        for react_info in self.react_infos:
+            reacts.append(self.transfer_to_react(react_info['react_id'], user_id))
+        return self.transfer_to_message(reacts)
+
     @staticmethod
-    def search(user_id, query_str, ret_list):
-        for channel in db['channels']:
-            for message in channel.messages:
-                if user_id in channel.member:
-                    if re.search(query_str.encode('unicode_escape').decode(), message.content):
-                        reacts = list()
-                        for react_info in message.react_infos:
-                            reacts.append(message.transfer_to_react(react_info['react_id'], user_id))
-                        ret_list.append(message.transfer_to_message(reacts))
-        for dm in db['direct_messages']:
-            for message in dm.messages:
-                for user in dm.users:
-                    if user.id == user_id:
-                        if re.search(query_str.encode('unicode_escape').decode(), message.content):
-                            reacts = list()
-                            for react_info in message.react_infos:
-                                reacts.append(message.transfer_to_react(react_info['react_id'], user_id))
-                            ret_list.append(message.transfer_to_message(reacts))
+    def search_messages(user_id, query_str, newest_first=False, before=None, filters=None):
+        """
+        Find the messages of the user's channels and dms which match the query. They are
+        generated one at a time, so a caller which only wants a page stops the search early.
+        A search which ran to the end is cached until a message of the channels and dms is
+        sent, edited or removed, or the user joins or leaves one of them
+
+        Args:
+            user_id: Integer, the user's id
+            query_str: String, the query, matched as a regular expression
+            newest_first: Boolean, order by id from the newest, otherwise the channels come
+                          first, each history in order
+            before: Integer, only the messages with a smaller id, None for all
+            filters: Dictionary, see SEARCH_FILTERS, the filters which are missing or None
+                     are not applied. Only the channel and dm of channel_id and dm_id are
+                     searched, if any of them is given
+
+        Returns:
+            Generator of message objects
+
+        """
+        filters = tuple((filters or dict()).get(name) for name in SEARCH_FILTERS)
+        sender, channel_id, dm_id, since, until = filters
+        if channel_id is None and dm_id is None:
+            conversations = get_memberships('user_channels', user_id) + get_memberships('user_dms', user_id)
+        else:
+            conversations = [get_index('user_channels').get(user_id, dict()).get(channel_id),
+                             get_index('user_dms').get(user_id, dict()).get(dm_id)]
+            conversations = [conversation for conversation in conversations if conversation is not None]
+        versions = get_index('versions')
+        tag = tuple((conversation.TABLE, conversation.id, versions.get((conversation.TABLE, conversation.id), 0))
+                    for conversation in conversations)
+        key = (user_id, query_str, filters)
+        message_ids = result_cache.get(key, tag)
+        if message_ids is not None:
+            if newest_first:
+                message_ids = sorted(message_ids, reverse=True)
+            located = Message.locate_in(conversations, set(message_ids))
+            for message_id in message_ids:
+                if before is None or message_id < before:
+                    conversation, position = located[message_id]
+                    yield conversation.messages[position]
+            return
+        # a search narrowed to a channel or dm scans it, the indexes would page in every history
+        scan = channel_id is not None or dm_id is not None
+        messages = Message.match_messages(conversations, query_str, newest_first, before, sender, since, until,
+                                          scan)
+        if newest_first or before is not None:
+            yield from messages
+            return
+        message_ids = list()
+        for message in messages:
+            message_ids.append(message.id)
+            yield message
+        result_cache.put(key, tag, message_ids)
+
+    @staticmethod
+    def match_messages(conversations, query_str, newest_first=False, before=None, sender=None, since=None,
+                       until=None, scan=False):
+        """
+        Match the query against the messages of channels and dms, the search of
+        search_messages without the cache. Unless scan is True, the messages of a literal
+        query, a sender or a time range are looked up in the content, sender and time indexes
+
+        Args:
+            conversations: List of the channel and dm objects, the channels first
+            query_str: String, the query, matched as a regular expression
+            newest_first: Boolean, order by id from the newest, otherwise in the order of
+                          the channels and dms, each history in order
+            before: Integer, only the messages with a smaller id, None for all
+            sender: Integer, only the messages sent by this user, None for all
+            since: Integer, only the messages sent at or after this unix timestamp
+            until: Integer, only the messages sent at or before this unix timestamp
+            scan: Boolean, match every message of the conversations without the indexes
+
+        Returns:
+            Generator of message objects
+
+        """
+        def accepted(message):
+            return ((before is None or message.id < before)
+                    and (sender is None or message.owner_id == sender)
+                    and (since is None or message.time >= since)
+                    and (until is None or message.time <= until))
+
+        matches = search.compile_query(query_str)
+        postings = list()
+        # the content indexes cannot narrow a regular expression, they are not built for it
+        if not scan and search.literal(query_str) is not None:
+            candidates = search.candidates(query_str, [get_index('terms'), get_index('trigrams')])
+            if candidates is not None:
+                postings.append(candidates)
+        if not scan and sender is not None:
+            postings.append(get_index('senders').get(sender, set()))
+        if not scan and (since is not None or until is not None):
+            postings.append(get_index('times').between(since, until))
+        candidates = search.intersect(postings)
+        if candidates is None:
+            histories = [conversation.messages for conversation in conversations]
+            if newest_first:
+                # every history is in the order of the ids, merged lazily so a page stops
+                # once it is full
+                newest = (reversed(history) for history in histories)
+                if before is not None:
+                    newest = (itertools.dropwhile(lambda message: message.id >= before, history)
+                              for history in newest)
+                messages = heapq.merge(*newest, key=lambda message: message.id, reverse=True)
+            else:
+                messages = itertools.chain.from_iterable(histories)
+            workers = search.pool_size(config.search_workers)
+            if workers > 1 and sum(len(history) for history in histories) >= config.search_parallel_threshold:
+                # split a batch of search_parallel_threshold messages at a time, a page stops
+                # after the batch which fills it
+                messages = (message for message in messages if accepted(message))
+                while True:
+                    batch = list(itertools.islice(messages, config.search_parallel_threshold))
+                    if not batch:
+                        return
+                    positions = search.parallel_match(query_str, [message.content for message in batch], workers)
+                    yield from (batch[position] for position in positions)
+        else:
+            located = Message.locate_in(conversations, candidates)
+            if newest_first:
+                ids = sorted((message_id for message_id in located if before is None or message_id < before),
+                             reverse=True)
+                locations = (located[message_id] for message_id in ids)
+            else:
+                locations = located.values()
+            messages = (conversation.messages[position] for conversation, position in locations)
+        for message in messages:
+            if accepted(message) and matches(message.content):
+                yield message
+
+    @staticmethod
+    def search(user_id, query_str, ret_list, filters=None):
+        """
+        Find every message of the user's channels and dms which match the query, the
+        channels come first, each history in order
+
+        Args:
+            user_id: Integer, the user's id
+            query_str: String, the query, matched as a regular expression
+            ret_list: List, the matched messages are appended to it
+            filters: Dictionary, see search_messages
+
+        Returns:
+            List, ret_list
+
+        """
+        for message in Message.search_messages(user_id, query_str, filters=filters):
+            ret_list.append(message.transfer_to_result(user_id))
         return ret_list
 
+    @staticmethod
+    def locate(message_id):
+        """
+        Find the channel or dm of a message and its position in the history, without paging
+        in any history
+
+        Args:
+            message_id: Integer, the message's id
+
+        Returns:
+            Tuple (Object, the channel or dm, Integer, the position)
+
+        Raises:
+            InputError: When the message does not exist
+
+        """
+        location = get_index('messages').get(message_id)
+        if location is None:
+            raise InputError
+        table, key = location
+        conversation = get_index(table)[key]
+        return conversation, conversation.message_positions()[message_id]
+
+    @staticmethod
+    def locate_in(conversations, message_ids):
+        """
+        Find the channel or dm and the position of messages among some channels and dms
+
+        Args:
+            conversations: List of the channel and dm objects
+            message_ids: Set of integers, the ids of the messages
+
+        Returns:
+            Dictionary, key is the id of a message which was found, value is the tuple
+            (Object, the channel or dm, Integer, the position). The messages are in the
+            order of the conversations, each history in order
+
+        """
+        located = dict()
+        for conversation in conversations:
+            positions = conversation.message_positions()
+            if len(positions) <= len(message_ids):
+                found = (message_id for message_id in positions if message_id in message_ids)
+            else:
+                found = sorted((message_id for message_id in message_ids if message_id in positions),
+                               key=positions.get)
+            for message_id in found:
+                located[message_id] = (conversation, positions[message_id])
+        return located
+
     @staticmethod
     def id_to_message(message_id):
         """
@@ -1055,15 +2198,8 @@ class Message:
             Object, the message
 
         """
-        for channel in db['channels']:
-            for message in channel.messages:
-                if message.id == message_id:
-                    return message
-        for dm in db['direct_messages']:
-            for message in dm.messages:
-                if message.id == message_id:
-                    return message
-        raise InputError
+        container, position = Message.locate(message_id)
+        return container.messages[position]
 
     def edit(self, new_message, sender):
         """
@@ -1077,28 +2213,28 @@ class Message:
             N/A
 
         """
-        for channel in db['channels']:
-            for message in channel.messages:
-                if message.id == self.id:
-                    handle_list = check_tagged(new_message)
-                    for handle in handle_list:
-                        for user_id in channel.member:
-                            user = User.check_u_id_match(user_id)
-                            if user.handle == handle:
-                                add_message = f"{sender.handle} tagged you in {channel.name}: {new_message[:20]}"
-                                new_note = Notification(channel.id, -1, add_message)
-                                user.notifications.append(new_note)
-        for dm in db['direct_messages']:
-            for message in dm.messages:
-                if message.id == self.id:
-                    handle_list = check_tagged(new_message)
-                    for handle in handle_list:
-                        for user in dm.users:
-                            if user.handle == handle:
-                                add_message = f"{sender.handle} tagged you in {dm.name}: {new_message[:20]}"
-                                new_note = Notification(-1, dm.id, add_message)
-                                user.notifications.append(new_note)
-        self.content = new_message
+        container, _ = Message.locate(self.id)
+        handle_list = check_tagged(new_message)
+        if container.TABLE == 'channels':
+            channel = container
+            for handle in handle_list:
+                for user_id in channel.member:
+                    user = User.check_u_id_match(user_id)
+                    if user.handle == handle:
+                        add_message = f"{sender.handle} tagged you in {channel.name}: {new_message[:20]}"
+                        new_note = Notification(channel.id, -1, add_message)
+                        user.notifications.append(new_note)
+                        mark_dirty('users', user.id)
+        else:
+            dm = container
+            for handle in handle_list:
+                for user in dm.users:
+                    if user.handle == handle:
+                        add_message = f"{sender.handle} tagged you in {dm.name}: {new_message[:20]}"
+                        new_note = Notification(-1, dm.id, add_message)
+                        user.notifications.append(new_note)
+                        mark_dirty('users', user.id)
+        container.set_content(self, new_message)
 
     # def check_id_match(self, user_id):
     #     if self.owner_id == user_id:
@@ -1121,20 +2257,19 @@ class Message:
             AccessError: When the user don't have permission
 
         """
-        for channel in db['channels']:
-            for message in channel.messages:
-                if message.id == message_id and message.owner_id == user_id:
-                    return
-        for dm in db['direct_messages']:
-            for message in dm.messages:
-                if message.id == message_id and message.owner_id == user_id:
-                    return
-        for channel in db['channels']:
+        try:
+            owner_id = Message.id_to_message(message_id).owner_id
+        except InputError:
+            owner_id = None
+        if owner_id == user_id:
+            return
+        # owners are members as well, the channels the user is not a member of can be skipped
+        for channel in get_memberships('user_channels', user_id):
             if user_id in channel.owner:
                 return
-        for user in db['users']:
-            if user_id == user.id and user.permission_id == 1:
-                return
+        user = get_index('users').get(user_id)
+        if user is not None and user.permission_id == 1:
+            return
         raise AccessError
 
     @staticmethod
@@ -1149,26 +2284,22 @@ class Message:
             N/A
 
         """
-        for channel in db['channels']:
-            for i in range(0, len(channel.messages)):
-                if channel.messages[i].id == message.id:
-                    del channel.messages[i]
-                    return
-        for dm in db['direct_messages']:
-            for i in range(0, len(dm.messages)):
-                if dm.messages[i].id == message.id:
-                    del dm.messages[i]
-                    return
+        container, position = Message.locate(message.id)
+        container.delete_message(position)
 
 
-class DirectMessage:
+class DirectMessage(Conversation):
+
+    TABLE = 'direct_messages'
+    MEMBERSHIP = ('users',)
 
     def __init__(self, name, users, owner_id):
         global db
         self.name = name
         self.id = db['dmid_root'] + 1
         db['dmid_root'] += 1
-        self.users = users
+        mark_dirty()
+        self.users = OrderedSet(users)
         self.owner_id = owner_id
         self.messages = []
 
@@ -1190,10 +2321,10 @@ class DirectMessage:
         Raise:
             InputError: dm_id does not refer to a valid user.
         """
-        for exist_dm in db['direct_messages']:
-            if exist_dm.id == dm_id:
-                return exist_dm
-        raise InputError
+        exist_dm = get_index('direct_messages').get(dm_id)
+        if exist_dm is None:
+            raise InputError
+        return exist_dm
 
     def add_to_db(self):
         """
@@ -1206,6 +2337,10 @@ class DirectMessage:
         """
         # global db
         db['direct_messages'].append(self)
+        get_index('direct_messages')[self.id] = self
+        for user in self.users:
+            add_membership('user_dms', user.id, self)
+        mark_dirty('direct_messages', self.id)
 
     def remove_to_db(self):
         """
@@ -1213,6 +2348,25 @@ class DirectMessage:
         """
         global db
         db['direct_messages'].remove(self)
+        del get_index('direct_messages')[self.id]
+        get_index('counters')['messages'] -= self.count_messages()
+        for user in self.users:
+            remove_membership('user_dms', user.id, self)
+        message_index = built_index('messages')
+        if message_index is not None:
+            for message_id in self.message_ids():
+                message_index.pop(message_id, None)
+        get_index('positions').pop((self.TABLE, self.id), None)
+        if any(built_index(table) is not None for table in ('senders', 'times') + CONTENT_INDEXES):
+            for message in self.messages:
+                unindex_message(message)
+        mark_dirty('direct_messages', self.id)
+
+    def add_user(self, user):
+        """Adds the user object to the members of that dm"""
+        self.users.append(user)
+        add_membership('user_dms', user.id, self)
+        mark_dirty('direct_messages', self.id)
 
     @staticmethod
     def dm_list(u_id):
@@ -1225,13 +2379,11 @@ class DirectMessage:
             exist_dm: class
         """
         dms = list()
-        for exist_dm in db['direct_messages']:
-            for user in exist_dm.users:
-                if user.id == u_id:
-                    dm = dict()
-                    dm['dm_id'] = exist_dm.id
-                    dm['name'] = exist_dm.name
-                    dms.append(dm)
+        for exist_dm in get_memberships('user_dms', u_id):
+            dm = dict()
+            dm['dm_id'] = exist_dm.id
+            dm['name'] = exist_dm.name
+            dms.append(dm)
 
         return dms
 
@@ -1253,18 +2405,20 @@ class DirectMessage:
             AccessError: When user is not found
 
         """
-        for exist_dm in db['direct_messages']:
-            if exist_dm.id == dm_id:
-                for i in range(0, len(exist_dm.users)):
-                    if exist_dm.users[i].id == u_id:
-                        del (exist_dm.users[i])
+        exist_dm = get_index('direct_messages').get(dm_id)
+        user = get_index('users').get(u_id)
+        if exist_dm is not None and user in exist_dm.users:
+            exist_dm.users.remove(user)
+            remove_membership('user_dms', u_id, exist_dm)
+            mark_dirty('direct_messages', dm_id)
 
     @staticmethod
+    @transaction
     def send_late_message(dm_id, late_message):
         load_db()
-        for direct_message in db['direct_messages']:
-            if direct_message.id == dm_id:
-                direct_message.messages.append(late_message)
+        direct_message = get_index('direct_messages').get(dm_id)
+        if direct_message is not None:
+            direct_message.append_message(late_message)
         user = User.check_u_id_match(late_message.owner_id)
         user.set_user_stats('send_message')
         set_dream_stats(num=1, action='add_message')
@@ -1296,10 +2450,10 @@ class Notification:
         Returns:
 
         """
-        for user in db['users']:
-            if user.id == user_id:
-                for i in range(1, 21):
-                    if i > len(user.notifications):
-                        break
-                    ret_list.append(user.notifications[-i].transfer_to_notification())
+        user = get_index('users').get(user_id)
+        if user is not None:
+            for i in range(1, 21):
+                if i > len(user.notifications):
+                    break
+                ret_list.append(user.notifications[-i].transfer_to_notification())
         return ret_list
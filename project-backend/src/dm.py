@@ -1,8 +1,9 @@
 from src.error import AccessError, InputError
-from src.data import DirectMessage, User, load_db, save_db, set_dream_stats
+from src.data import DirectMessage, User, load_db, save_db, transaction, read_transaction, set_dream_stats
 import json
 
 
+@transaction
 def dm_invite_v1(token, dm_id, u_id):
     """
     Author (with token) invites a user (with user id u_id)
@@ -37,7 +38,7 @@ def dm_invite_v1(token, dm_id, u_id):
         # Don't need to invite user is already in the dm.
         if user_invite in match_dm.users:
             return {}
-        match_dm.users.append(user_invite)
+        match_dm.add_user(user_invite)
     else:
         # The authorised user is not already a member of the dm.
         raise AccessError
@@ -49,6 +50,7 @@ def dm_invite_v1(token, dm_id, u_id):
     return {}
 
 
+@read_transaction
 def dm_details_v1(token, dm_id):
     """
     Users that are part of this direct message can view basic information about the DM
@@ -99,6 +101,7 @@ def dm_details_v1(token, dm_id):
     save_db()
     return channels_dict
 
+@transaction
 def dm_remove_v1(token, dm_id):
     """
     Remove an existing DM. This can only be done by the original creator of the DM.
@@ -137,6 +140,7 @@ def dm_remove_v1(token, dm_id):
     save_db()
     return {}
 
+@transaction
 def dm_create_v1(token, u_ids):
     """
         Create a direct message
@@ -185,6 +189,7 @@ def dm_create_v1(token, u_ids):
     }
 
 
+@read_transaction
 def dm_messages_v1(token, dm_id, start):
     """
         Create a direct message
@@ -238,6 +243,7 @@ def dm_messages_v1(token, dm_id, start):
     }
 
 
+@read_transaction
 def dm_list_v1(token):
     load_db()
     cur_user_id = User.token_to_id(token)
@@ -245,6 +251,7 @@ def dm_list_v1(token):
     return {'dms': DirectMessage.dm_list(cur_user_id)}
 
 
+@transaction
 def dm_leave_v1(token, dm_id):
     load_db()
     cur_dm = DirectMessage.check_dm_id_match(dm_id)
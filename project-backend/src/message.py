@@ -1,10 +1,11 @@
 import threading
 
-from src.data import load_db, save_db, User, Channel, Message, DirectMessage, set_dream_stats
+from src.data import load_db, save_db, transaction, User, Channel, Message, DirectMessage, set_dream_stats
 from src.helper import check_tagged, share_message, generate_timestamp
 from src.error import InputError, AccessError
 
 
+@transaction
 def message_send_v2(token, channel_id, message):
     """
     Send a message from authorised_user to the channel specified by channel_id. Note: Each message should have it's
@@ -38,7 +39,7 @@ def message_send_v2(token, channel_id, message):
         raise AccessError
     # Create new message object and add it to the database
     new_message = Message(au_id, message)
-    match_channel.messages.append(new_message)
+    match_channel.append_message(new_message)
     # checking for tagged message. If so, create notification and save to database
     handle_list = check_tagged(message)
     # The list contain all tagged users
@@ -55,6 +56,7 @@ def message_send_v2(token, channel_id, message):
     }
 
 
+@transaction
 def message_senddm_v1(token, dm_id, message):
     load_db()
     dm_id = int(dm_id)
@@ -66,7 +68,7 @@ def message_senddm_v1(token, dm_id, message):
     exist_dm = DirectMessage.check_dm_id_match(dm_id)
     if new_user not in exist_dm.users:
         raise AccessError
-    exist_dm.messages.append(new_message)
+    exist_dm.append_message(new_message)
     # checking for tagged message. If so, create notification and save to database
     handle_list = check_tagged(message)
     # The list contain all tagged users
@@ -84,6 +86,7 @@ def message_senddm_v1(token, dm_id, message):
     }
 
 
+@transaction
 def message_edit_v2(token, message_id, message):
     '''
     Author (with token) 
@@ -126,6 +129,7 @@ def message_edit_v2(token, message_id, message):
     return {}
 
 
+@transaction
 def message_remove_v1(token, message_id):
     '''
     Author (with token) 
@@ -160,6 +164,7 @@ def message_remove_v1(token, message_id):
     return {}
 
 
+@transaction
 def message_share_v1(token, og_message_id, message, channel_id, dm_id):
     '''
     Author (with token) 
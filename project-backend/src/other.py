@@ -1,10 +1,14 @@
-from src.data import load_db, save_db, User, Channel, Message, DirectMessage, Notification
+from src.data import load_db, save_db, transaction, read_transaction, User, Channel, Message, DirectMessage, Notification
 from src import data
-from src.error import InputError
+from src.error import InputError, AccessError
 from src.helper import generate_timestamp
+from src import config
+from src import search
+import itertools
 import os
 
 
+@transaction
 def clear_v1():
     """
     Resets the internal data of the application to it's initial state
@@ -16,7 +20,7 @@ def clear_v1():
     data.db['users'].clear()
     data.db['channels'].clear()
     data.db['direct_messages'].clear()
-    data.db['login_token'].clear()
+    data.db['sessions'].clear()
     data.db['removed_users'].clear()
     data.db['dreams_stats'] = {
         'channels_exist': [{'num_channels_exist': 0, 'time_stamp': generate_timestamp()}],
@@ -33,42 +37,90 @@ def clear_v1():
     # Reset root in class DirectMessage
     DirectMessage.reset_root()
     # clear_db()
-    save_db()
+    data.rebuild_indexes()
+    save_db(checkpoint=True)
     return {}
 
 
-def search_v2(token, query_str):
+@read_transaction
+def search_v2(token, query_str, limit=None, cursor=None, u_id=None, channel_id=None, dm_id=None, since=None,
+              until=None):
     """
     Given a query string, return a collection of messages in all of the channels/DMs that the user has joined that
-    match the query
+    match the query. Without limit and cursor every match is returned, the channels first. With either of them one
+    page is returned, newest first, and the cursor of the response continues with the next page. The filters which
+    are given narrow the search down further
 
     Args:
         token: String, the current user's token
         query_str: String, the content that the user want to search
+        limit: Integer, the number of messages of a page, config.search_default_limit if only cursor is given
+        cursor: String, the cursor returned with the previous page, None for the first page
+        u_id: Integer, only the messages sent by this user
+        channel_id: Integer, only search this channel, and the dm of dm_id if it is given as well
+        dm_id: Integer, only search this dm, and the channel of channel_id if it is given as well
+        since: Integer, only the messages sent at or after this unix timestamp
+        until: Integer, only the messages sent at or before this unix timestamp
 
     Returns:
         Dictionary
         {
         messages: list contain data type message
+        cursor: String, the cursor of the next page, None on the last page, only returned for a page
         }
 
     Raises:
         AccessError: The token is invalid
-                    or query_str is above 1000 characters
+        AccessError: The user is not a member of the channel of channel_id or of the dm of dm_id
+        InputError: query_str is above 1000 characters
+                    or limit is not between 1 and config.search_max_limit
+                    or cursor is not a cursor returned by search
+                    or a filter is not an integer
+                    or channel_id is not a valid channel or dm_id is not a valid dm
 
     """
     load_db()
     if len(query_str) > 1000:
         raise InputError
     au_id = User.token_to_id(token)
-    ret_list = list()
-    ret_list = Message.search(au_id, query_str, ret_list)
+    filters = {'u_id': u_id, 'channel_id': channel_id, 'dm_id': dm_id, 'since': since, 'until': until}
+    try:
+        filters = {name: None if value is None else int(value) for name, value in filters.items()}
+    except ValueError as error:
+        raise InputError(description='Invalid search filter') from error
+    if filters['channel_id'] is not None:
+        if au_id not in Channel.check_channel_id_match(filters['channel_id']).member:
+            raise AccessError
+    if filters['dm_id'] is not None:
+        if User.check_u_id_match(au_id) not in DirectMessage.check_dm_id_match(filters['dm_id']).users:
+            raise AccessError
+    if limit is None and cursor is None:
+        ret_list = list()
+        ret_list = Message.search(au_id, query_str, ret_list, filters)
+        save_db()
+        return {
+            'messages': ret_list
+        }
+    try:
+        limit = config.search_default_limit if limit is None else int(limit)
+        before = None if cursor is None else search.decode_cursor(cursor)
+    except ValueError as error:
+        raise InputError(description='Invalid limit or cursor') from error
+    if limit < 1 or limit > config.search_max_limit:
+        raise InputError(description='Invalid limit')
+    # one more than the page, to know whether there is a next page
+    page = list(itertools.islice(Message.search_messages(au_id, query_str, newest_first=True, before=before,
+                                                         filters=filters), limit + 1))
+    next_cursor = search.encode_cursor(page[limit - 1].id) if len(page) > limit else None
+    ret_list = [message.transfer_to_result(au_id) for message in page[:limit]]
     save_db()
     return {
-        'messages': ret_list
+        'messages': ret_list,
+        'cursor': next_cursor
     }
 
 
+@read_transaction
 def notifications_get_v1(token):
     """
     Return the user's most recent 20 notifications
@@ -91,3 +143,62 @@ def notifications_get_v1(token):
     return {
         'notifications': ret_list
     }
+
+
+@read_transaction
+def sessions_stats_v1(token):
+    """
+    Return the number of logged in sessions and how fast expired sessions are evicted, for
+    monitoring. The eviction counters are those of the worker process answering the request
+
+    Args:
+        token: String, the current user's token
+
+    Returns:
+        Dictionary
+        {
+        num_sessions: Integer, the number of logged in tokens
+        num_evicted: Integer, the number of sessions evicted since the start
+        eviction_rate: Float, the sessions evicted per second by the last reaper run
+        }
+
+    Raises:
+        AccessError: When the user is not a Dreams owner
+
+    """
+    load_db()
+    au_id = User.token_to_id(token)
+    if not User.check_owner(au_id):
+        raise AccessError
+    save_db()
+    return data.session_stats()
+
+
+@read_transaction
+def search_stats_v1(token):
+    """
+    Return how often the searches were answered by the result cache, for monitoring. The
+    counters are those of the worker process answering the request
+
+    Args:
+        token: String, the current user's token
+
+    Returns:
+        Dictionary
+        {
+        num_entries: Integer, the number of cached searches
+        hits: Integer, the number of searches answered by the cache
+        misses: Integer, the number of searches which were not
+        hit_rate: Float, the share of the searches answered by the cache
+        }
+
+    Raises:
+        AccessError: When the user is not a Dreams owner
+
+    """
+    load_db()
+    au_id = User.token_to_id(token)
+    if not User.check_owner(au_id):
+        raise AccessError
+    save_db()
+    return data.search_stats()
@@ -0,0 +1,593 @@
+"""
+File of the indexes which serve search_v2
+
+search_v2 matches the query as a regular expression against the content of every message
+the user can see. The indexes never decide a match on their own: they narrow the search to
+the messages which can possibly match, and each of those is then verified with the pattern.
+
+A query without regex metacharacters matches literally, and the postings of both indexes
+are intersected for it:
+
+TermIndex is an inverted index from the words of the messages to the ids of the messages
+containing them. A word of the query which is enclosed by other characters of the query on
+both sides can only be matched by a message holding that whole word.
+
+TrigramIndex maps every three character substring of the messages to the ids of the
+messages containing it, a message matching the query contains every trigram of the query.
+
+TimeIndex orders the messages by the time they were sent, for the searches filtered by a
+time range.
+
+ResultCache keeps the messages matched by the last searches of the users, so a repeated
+search is answered without matching the query again.
+"""
+import base64
+import bisect
+import collections
+import functools
+import itertools
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+WORD = re.compile(r'\w+')
+
+# intersecting more postings is not worth it once this few candidates are left to verify
+FEW_CANDIDATES = 16
+
+# the characters which give a query a meaning other than its literal text
+METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+# number of compiled queries kept for the following requests
+PATTERN_CACHE_SIZE = 256
+
+# the messages of a parallel search are split in this many chunks per worker, so a worker
+# given the long messages does not hold up the others
+CHUNKS_PER_WORKER = 4
+
+# the process pool of the parallel search, started on its first use, and its size
+pool = None
+pool_workers = 0
+pool_lock = threading.Lock()
+
+
+def encode_cursor(message_id):
+    """
+
+    The opaque cursor of a page of search results which continues after a message
+
+    Args:
+        message_id: Integer, the id of the last message of the page
+
+    Returns:
+        String
+
+    """
+    return base64.urlsafe_b64encode(f'before:{message_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+
+    The message id a cursor continues after
+
+    Args:
+        cursor: String, a cursor given by encode_cursor
+
+    Returns:
+        Integer, the message id
+
+    Raises:
+        ValueError: When the cursor is not a cursor of encode_cursor
+
+    """
+    try:
+        prefix, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+    except (ValueError, UnicodeError) as error:
+        raise ValueError(f'Invalid cursor {cursor!r}') from error
+    if prefix != 'before':
+        raise ValueError(f'Invalid cursor {cursor!r}')
+    return int(message_id)
+
+
+def words(content):
+    """
+
+    The distinct words of a message, case folded
+
+    Args:
+        content: String, the message
+
+    Returns:
+        Set of strings
+
+    """
+    return {word.lower() for word in WORD.findall(content)}
+
+
+def literal(pattern):
+    """
+
+    The text a query matches, if it is a plain literal. search_v2 escapes the non-ASCII
+    characters of the query before compiling it, those escapes match the characters
+    themselves
+
+    Args:
+        pattern: String, the query
+
+    Returns:
+        String, the query itself, None if it contains a metacharacter
+
+    """
+    if METACHARACTERS.isdisjoint(pattern):
+        return pattern
+    return None
+
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_query(query_str):
+    """
+
+    Compile a query once into the function matching it against the messages. A literal is
+    looked up with the in operator, the rest is matched as a regular expression
+
+    Args:
+        query_str: String, the query as the user typed it
+
+    Returns:
+        Function taking the content of a message and returning whether it matches
+
+    Raises:
+        re.error: When the query is not a valid regular expression
+
+    """
+    text = literal(query_str)
+    if text is not None:
+        return lambda content: text in content
+    return re.compile(query_str.encode('unicode_escape').decode()).search
+
+
+def match_chunk(query_str, contents):
+    """
+
+    Match a query against a chunk of messages, run by the workers of the parallel search
+
+    Args:
+        query_str: String, the query as the user typed it
+        contents: List of strings, the messages
+
+    Returns:
+        List of integers, the positions of the matching messages in the chunk
+
+    """
+    matches = compile_query(query_str)
+    return [position for position, content in enumerate(contents) if matches(content)]
+
+
+def usable_cores():
+    """
+
+    The number of cores this process may run on
+
+    Returns:
+        Integer
+
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def pool_size(workers):
+    """
+
+    The number of processes a search is split across, at most one per core since more
+    processes than cores only add the cost of sending the messages to them
+
+    Args:
+        workers: Integer, the configured number of processes, None for one per core
+
+    Returns:
+        Integer, the search is not split if it is 1 or less
+
+    """
+    cores = usable_cores()
+    return cores if workers is None else min(workers, cores)
+
+
+def get_pool(workers):
+    """
+
+    The process pool of the parallel search, started again when the number of workers changes
+
+    Args:
+        workers: Integer, the number of processes
+
+    Returns:
+        ProcessPoolExecutor
+
+    """
+    global pool, pool_workers
+    with pool_lock:
+        if pool is None or pool_workers != workers:
+            if pool is not None:
+                pool.shutdown(wait=False)
+            pool = ProcessPoolExecutor(max_workers=workers)
+            pool_workers = workers
+        return pool
+
+
+def parallel_match(query_str, contents, workers):
+    """
+
+    Match a query against the messages in a pool of processes. The messages are split into
+    contiguous chunks and the matches of the chunks are merged back in the order of the
+    messages
+
+    Args:
+        query_str: String, the query as the user typed it
+        contents: List of strings, the messages
+        workers: Integer, the number of processes
+
+    Returns:
+        List of integers, the positions of the matching messages in ascending order
+
+    Raises:
+        re.error: When the query is not a valid regular expression
+
+    """
+    # an invalid query is refused before any chunk is sent
+    compile_query(query_str)
+    size = max(1, -(-len(contents) // (workers * CHUNKS_PER_WORKER)))
+    starts = range(0, len(contents), size)
+    chunks = [contents[start:start + size] for start in starts]
+    try:
+        results = list(get_pool(workers).map(match_chunk, itertools.repeat(query_str), chunks))
+    except BrokenProcessPool:
+        # a worker was killed, the pool is started again by the next search
+        global pool
+        with pool_lock:
+            pool = None
+        results = [match_chunk(query_str, chunk) for chunk in chunks]
+    return [start + position for start, positions in zip(starts, results) for position in positions]
+
+
+def trigrams(text):
+    """
+
+    The distinct three character substrings of a text
+
+    Args:
+        text: String
+
+    Returns:
+        Set of strings
+
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def candidates(query_str, content_indexes):
+    """
+
+    The messages which may match a query, the smallest postings are intersected first
+
+    Args:
+        query_str: String, the query as the user typed it
+        content_indexes: List of TermIndex or TrigramIndex
+
+    Returns:
+        Set of message ids, None if the indexes cannot narrow the search. The set may
+        still hold messages which do not match, and must not be modified
+
+    """
+    text = literal(query_str)
+    if text is None:
+        return None
+    postings = list()
+    for content_index in content_indexes:
+        postings += content_index.postings_of(text)
+    return intersect(postings)
+
+
+def intersect(postings):
+    """
+
+    Narrow down the messages to those of every posting, the smallest postings are
+    intersected first
+
+    Args:
+        postings: List of sets of message ids
+
+    Returns:
+        Set of message ids, None if there is no posting. Once FEW_CANDIDATES are left the
+        remaining postings are not intersected, so the set may still hold messages missing
+        from them, and it must not be modified
+
+    """
+    if not postings:
+        return None
+    postings = sorted(postings, key=len)
+    # the smallest posting is not copied, the result must not be modified
+    matched = postings[0]
+    for posting in postings[1:]:
+        if len(matched) <= FEW_CANDIDATES:
+            break
+        matched = matched & posting
+    return matched
+
+
+def complete_words(text):
+    """
+
+    The words of a literal which every text containing it holds as whole words, the first
+    and last word may be part of a longer word of the text
+
+    Args:
+        text: String, the literal
+
+    Returns:
+        Set of strings, case folded
+
+    """
+    return {match.group().lower() for match in WORD.finditer(text)
+            if match.start() > 0 and match.end() < len(text)}
+
+
+class TermIndex:
+    """
+    Inverted index from words to the messages containing them
+
+    Attributes:
+        postings: Dictionary, key is the case folded word and value is the set of ids of
+                  the messages containing it
+    """
+
+    def __init__(self):
+        self.postings = dict()
+
+    @staticmethod
+    def keys(content):
+        """The keys a message is indexed under"""
+        return words(content)
+
+    @staticmethod
+    def query_keys(text):
+        """The keys every message containing a literal is indexed under"""
+        return complete_words(text)
+
+    def add(self, message_id, content):
+        """
+
+        Index a message under its keys
+
+        Args:
+            message_id: Integer, the message's id
+            content: String, the message
+
+        Returns:
+            N/A
+
+        """
+        for key in self.keys(content):
+            self.postings.setdefault(key, set()).add(message_id)
+
+    def remove(self, message_id, content):
+        """
+
+        Remove a message from the postings of its keys
+
+        Args:
+            message_id: Integer, the message's id
+            content: String, the message as it was indexed
+
+        Returns:
+            N/A
+
+        """
+        for key in self.keys(content):
+            posting = self.postings.get(key)
+            if posting is not None:
+                posting.discard(message_id)
+                if not posting:
+                    del self.postings[key]
+
+    def postings_of(self, text):
+        """
+
+        The postings every message containing a literal is in
+
+        Args:
+            text: String, the literal
+
+        Returns:
+            List of sets of message ids
+
+        """
+        return [self.postings.get(key, set()) for key in self.query_keys(text)]
+
+    def candidates(self, query_str):
+        """
+
+        The messages which may match a query according to this index alone
+
+        Args:
+            query_str: String, the query
+
+        Returns:
+            Set of message ids, None if the index cannot narrow the search
+
+        """
+        return candidates(query_str, [self])
+
+
+class TrigramIndex(TermIndex):
+    """
+    Index from the three character substrings of the messages to the messages containing
+    them, case sensitive like the match itself
+
+    Attributes:
+        postings: Dictionary, key is the trigram and value is the set of ids of the
+                  messages containing it
+    """
+
+    @staticmethod
+    def keys(content):
+        return trigrams(content)
+
+    @staticmethod
+    def query_keys(text):
+        return trigrams(text)
+
+
+class TimeIndex:
+    """
+    Index of the messages in the order of the time they were sent
+
+    Attributes:
+        entries: List of tuples (time, message id), sorted
+    """
+
+    def __init__(self):
+        self.entries = list()
+
+    def add(self, message_id, time):
+        """
+
+        Index a message at the time it was sent
+
+        Args:
+            message_id: Integer, the message's id
+            time: Integer, the unix timestamp the message was sent at
+
+        Returns:
+            N/A
+
+        """
+        bisect.insort(self.entries, (time, message_id))
+
+    def remove(self, message_id, time):
+        """
+
+        Remove a message from the index
+
+        Args:
+            message_id: Integer, the message's id
+            time: Integer, the unix timestamp the message was sent at
+
+        Returns:
+            N/A
+
+        """
+        position = bisect.bisect_left(self.entries, (time, message_id))
+        if position < len(self.entries) and self.entries[position] == (time, message_id):
+            del self.entries[position]
+
+    def between(self, since=None, until=None):
+        """
+
+        The messages sent in a time range
+
+        Args:
+            since: Integer, the earliest time included, None for no lower bound
+            until: Integer, the latest time included, None for no upper bound
+
+        Returns:
+            Set of message ids
+
+        """
+        start = 0 if since is None else bisect.bisect_left(self.entries, (since,))
+        end = len(self.entries) if until is None else bisect.bisect_right(self.entries, (until, float('inf')))
+        return {message_id for _, message_id in self.entries[start:end]}
+
+
+class ResultCache:
+    """
+    Least recently used cache of the messages matched by the searches of the users. Every
+    entry is tagged with the versions of the channels and dms it searched, and is only used
+    while the user can see the same channels and dms and none of them has changed
+
+    Attributes:
+        size: Integer, the number of entries kept
+        entries: OrderedDict, key is (u_id, query) and value is (tag, list of the ids of the
+                 matched messages), the least recently used first
+        hits: Integer, the number of searches answered by the cache
+        misses: Integer, the number of searches which were not
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, tag):
+        """
+
+        The matched messages of a search, if they are still valid
+
+        Args:
+            key: Tuple (u_id, query)
+            tag: Tuple, the versions of the channels and dms the user can see
+
+        Returns:
+            List of message ids, None on a miss
+
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != tag:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, tag, message_ids):
+        """
+
+        Keep the matched messages of a search, the least recently used entry is dropped
+        when the cache is full
+
+        Args:
+            key: Tuple (u_id, query)
+            tag: Tuple, the versions of the channels and dms searched
+            message_ids: List of integers, the ids of the matched messages
+
+        Returns:
+            N/A
+
+        """
+        self.entries[key] = (tag, message_ids)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every entry, the counters are kept"""
+        self.entries.clear()
+
+    def stats(self):
+        """
+
+        The number of entries and how often the cache answered
+
+        Returns:
+            Dictionary
+            {
+            num_entries: Integer, the number of cached searches
+            hits: Integer, the number of searches answered by the cache
+            misses: Integer, the number of searches which were not
+            hit_rate: Float, the share of the searches answered by the cache
+            }
+
+        """
+        lookups = self.hits + self.misses
+        return {
+            'num_entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else float(),
+        }
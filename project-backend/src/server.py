@@ -4,6 +4,7 @@ from flask import Flask, request
 from flask_cors import CORS
 from src.error import InputError
 from src import config
+from src import data
 
 from src import admin
 from src import auth
@@ -562,13 +563,29 @@ def user_all():
     return dumps(output_info)
 
 
+@APP.route("/user/stats/v1", methods=['GET'])
+def user_stats():
+    token = str(request.args.get('token'))
+    output_info = user.user_stats_v1(
+        token
+    )
+    return dumps(output_info)
+
+
 @APP.route("/search/v2", methods=['GET'])
 def search():
     token = str(request.args.get('token'))
     query_str = str(request.args.get('query_str'))
     output_info = other.search_v2(
         token,
-        query_str
+        query_str,
+        request.args.get('limit'),
+        request.args.get('cursor'),
+        request.args.get('u_id'),
+        request.args.get('channel_id'),
+        request.args.get('dm_id'),
+        request.args.get('since'),
+        request.args.get('until'),
     )
     return dumps(output_info)
 
@@ -603,10 +620,29 @@ def notifications_get():
     return dumps(output_info)
 
 
+@APP.route("/sessions/stats/v1", methods=['GET'])
+def sessions_stats():
+    token = str(request.args.get('token'))
+    output_info = other.sessions_stats_v1(
+        token
+    )
+    return dumps(output_info)
+
+
+@APP.route("/search/stats/v1", methods=['GET'])
+def search_stats():
+    token = str(request.args.get('token'))
+    output_info = other.search_stats_v1(
+        token
+    )
+    return dumps(output_info)
+
+
 @APP.route("/clear/v1", methods=["DELETE"])
 def clear():
     output_info = other.clear_v1()
     return dumps(output_info)
 
 if __name__ == "__main__":
+    data.start_session_reaper()
     APP.run(port=config.port) # Do not edit this port
@@ -0,0 +1,513 @@
+"""
+File of the binary snapshot format of the database
+
+A snapshot starts with MAGIC and a version byte, followed by the database encoded as
+one value. Every value starts with a one byte tag. Lists are stored column by column:
+the attribute names of the objects and the keys of the dicts in a list are written once
+per list instead of once per item, integers are delta encoded into the narrowest array
+type, and the strings of a column are written as one block. Objects which appear more
+than once, like the users of a dm, are written once and referred to by their position.
+
+The writer and the reader are streaming, the file is written and read in CHUNK_SIZE
+blocks and the whole encoded snapshot is never held in memory.
+"""
+import gc
+import pickle
+import struct
+import sys
+from array import array
+from itertools import accumulate, chain
+from operator import itemgetter, sub
+
+MAGIC = b'DREAMS'
+VERSION = 1
+
+CHUNK_SIZE = 1 << 16
+
+# value tags
+NONE, TRUE, FALSE, INT, FLOAT, STR, LIST, TUPLE, DICT, OBJECT, REF, SHAPE, PICKLE = range(13)
+
+# column tags
+COL_VALUES, COL_INT, COL_FLOAT, COL_BOOL, COL_STR, COL_LIST, COL_DICT, COL_OBJECT = range(8)
+
+# array types tried for an integer column, from the narrowest
+INT_TYPES = (('b', 1 << 7), ('h', 1 << 15), ('i', 1 << 31), ('q', 1 << 63))
+
+FLOAT_FORMAT = struct.Struct('<d')
+
+# the module of the classes which can be stored as objects
+CLASS_MODULE = 'src.data'
+
+
+def dump(db, f):
+    """
+
+    Write the database to a binary file as a snapshot
+
+    Args:
+        db: Dictionary, the database
+        f: File object opened in binary mode for writing
+
+    Returns:
+        N/A
+
+    """
+    writer = SnapshotWriter(f)
+    writer.write_header()
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        writer.write_value(db)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    writer.flush()
+
+
+def load(f):
+    """
+
+    Read the database from a snapshot
+
+    Args:
+        f: File object opened in binary mode for reading
+
+    Returns:
+        Dictionary, the database
+
+    Raises:
+        ValueError: When the file is not a snapshot, or of an unknown version
+        EOFError: When the snapshot is truncated
+
+    """
+    reader = SnapshotReader(f)
+    reader.read_header()
+    # the reader creates no reference cycles, collecting while millions of objects are
+    # allocated would only scan them again and again
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return reader.read_value()
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def object_state(obj):
+    """
+
+    The attributes stored for an object, a paged out message history is paged in
+
+    """
+    state = obj.__dict__
+    if '_messages' in state and state['_messages'] is None:
+        state = dict(state)
+        state['_messages'] = obj.messages
+        state.pop('_message_ids', None)
+    return state
+
+
+def to_array(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def int_typecode(values):
+    """
+
+    The narrowest array type which holds every value, None if the values do not fit
+
+    """
+    if not values:
+        return 'b'
+    lowest, highest = min(values), max(values)
+    for typecode, bound in INT_TYPES:
+        if -bound <= lowest and highest < bound:
+            return typecode
+    return None
+
+
+class SnapshotWriter:
+    """
+    Encode values to a binary file
+
+    Attributes:
+        f: File object, the file written to
+        out: Bytearray, the encoded bytes not flushed yet
+        memo: Dictionary, key is id() of an object already written, value is its position
+        shapes: Dictionary, key is (class name, attribute names), value is the shape id
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.out = bytearray()
+        self.memo = dict()
+        self.shapes = dict()
+
+    def flush(self):
+        self.f.write(self.out)
+        self.out.clear()
+
+    def write_header(self):
+        self.out += MAGIC
+        self.out.append(VERSION)
+
+    def write_uint(self, value):
+        while value > 0x7f:
+            self.out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        self.out.append(value)
+
+    def write_int(self, value):
+        # zigzag, so small negative numbers stay small
+        self.write_uint(value << 1 if value >= 0 else (-value << 1) - 1)
+
+    def write_str(self, value):
+        encoded = value.encode('utf-8', 'surrogatepass')
+        self.write_uint(len(encoded))
+        self.out += encoded
+
+    def write_shape(self, obj):
+        """
+
+        Write the shape of an object the first time it is used
+
+        Returns:
+            Integer, the shape id
+
+        """
+        key = (type(obj).__name__, tuple(object_state(obj)))
+        if key not in self.shapes:
+            self.shapes[key] = len(self.shapes)
+            self.out.append(SHAPE)
+            self.write_str(key[0])
+            self.write_uint(len(key[1]))
+            for name in key[1]:
+                self.write_str(name)
+        return self.shapes[key]
+
+    def write_value(self, value):
+        """
+
+        Write one value with its tag
+
+        """
+        if len(self.out) >= CHUNK_SIZE:
+            self.flush()
+        value_type = type(value)
+        if value is None:
+            self.out.append(NONE)
+        elif value_type is bool:
+            self.out.append(TRUE if value else FALSE)
+        elif value_type is int:
+            self.out.append(INT)
+            self.write_int(value)
+        elif value_type is float:
+            self.out.append(FLOAT)
+            self.out += FLOAT_FORMAT.pack(value)
+        elif value_type is str:
+            self.out.append(STR)
+            self.write_str(value)
+        elif value_type in (list, tuple):
+            self.out.append(LIST if value_type is list else TUPLE)
+            self.write_uint(len(value))
+            self.write_column(value if value_type is list else list(value))
+        elif value_type is dict:
+            self.out.append(DICT)
+            self.write_uint(len(value))
+            self.write_column(list(value))
+            self.write_column(list(value.values()))
+        elif id(value) in self.memo:
+            self.out.append(REF)
+            self.write_uint(self.memo[id(value)])
+        elif value_type.__module__ == CLASS_MODULE:
+            shape = self.write_shape(value)
+            self.memo[id(value)] = len(self.memo)
+            self.out.append(OBJECT)
+            self.write_uint(shape)
+            for item in object_state(value).values():
+                self.write_value(item)
+        else:
+            self.out.append(PICKLE)
+            encoded = pickle.dumps(value)
+            self.write_uint(len(encoded))
+            self.out += encoded
+
+    def write_column(self, values):
+        """
+
+        Write the items of a list, the length is written by the caller
+
+        """
+        if len(self.out) >= CHUNK_SIZE:
+            self.flush()
+        if not values:
+            self.out.append(COL_VALUES)
+            return
+        types = set(map(type, values))
+        first_type = type(values[0])
+        if len(types) > 1:
+            self.write_values(values)
+        elif first_type is int:
+            self.write_int_column(values)
+        elif first_type is float:
+            self.out.append(COL_FLOAT)
+            self.out += to_array('d', values).tobytes()
+        elif first_type is bool:
+            self.out.append(COL_BOOL)
+            self.out += bytes(values)
+        elif first_type is str:
+            self.out.append(COL_STR)
+            self.write_str_column(values)
+        elif first_type is list:
+            self.out.append(COL_LIST)
+            self.write_int_column(list(map(len, values)), tagged=False)
+            self.write_column(list(chain.from_iterable(values)))
+        elif first_type is dict:
+            self.write_dict_column(values)
+        elif first_type.__module__ == CLASS_MODULE:
+            self.write_object_column(values)
+        else:
+            self.write_values(values)
+
+    def write_values(self, values):
+        self.out.append(COL_VALUES)
+        for value in values:
+            self.write_value(value)
+
+    def write_int_column(self, values, tagged=True):
+        deltas = list(map(sub, values, [0] + values[:-1]))
+        typecode = int_typecode(deltas)
+        if typecode is None:
+            if not tagged:
+                raise ValueError('Length of a list out of range')
+            self.write_values(values)
+            return
+        if tagged:
+            self.out.append(COL_INT)
+        self.out += typecode.encode()
+        self.out += to_array(typecode, deltas).tobytes()
+
+    def write_str_column(self, values):
+        self.write_int_column(list(map(len, values)), tagged=False)
+        encoded = ''.join(values).encode('utf-8', 'surrogatepass')
+        self.write_uint(len(encoded))
+        self.flush()
+        self.f.write(encoded)
+
+    def write_dict_column(self, values):
+        keys = tuple(values[0])
+        if not all(type(key) is str for key in keys) \
+                or set(map(tuple, values)) != {keys}:
+            self.write_values(values)
+            return
+        self.out.append(COL_DICT)
+        self.write_uint(len(keys))
+        for key in keys:
+            self.write_str(key)
+        for key in keys:
+            self.write_column(list(map(itemgetter(key), values)))
+
+    def write_object_column(self, values):
+        # every object has to be new and of the same shape, so they can be created in
+        # a row before their attributes are read
+        states = [object_state(value) for value in values]
+        names = tuple(states[0])
+        ids = set(map(id, values))
+        if len(ids) != len(values) or not ids.isdisjoint(self.memo) \
+                or set(map(tuple, states)) != {names}:
+            self.write_values(values)
+            return
+        shape = self.write_shape(values[0])
+        for value in values:
+            self.memo[id(value)] = len(self.memo)
+        self.out.append(COL_OBJECT)
+        self.write_uint(shape)
+        for name in names:
+            self.write_column(list(map(itemgetter(name), states)))
+
+
+class SnapshotReader:
+    """
+    Decode values from a binary file
+
+    Attributes:
+        f: File object, the file read from
+        buf: Bytes, the block read from the file
+        pos: Integer, the position of the next byte in buf
+        objects: List, the objects already read, in the order they were written
+        shapes: List, the (class, attribute names) of every shape already read
+        classes: Module, the module the classes of the objects are looked up in
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = b''
+        self.pos = 0
+        self.objects = list()
+        self.shapes = list()
+        self.classes = None
+
+    def read(self, size):
+        end = self.pos + size
+        if end > len(self.buf):
+            self.buf = self.buf[self.pos:] + self.f.read(max(size, CHUNK_SIZE))
+            self.pos, end = 0, size
+            if end > len(self.buf):
+                raise EOFError('Snapshot is truncated')
+        data = self.buf[self.pos:end]
+        self.pos = end
+        return data
+
+    def read_byte(self):
+        if self.pos >= len(self.buf):
+            self.buf, self.pos = self.f.read(CHUNK_SIZE), 0
+            if not self.buf:
+                raise EOFError('Snapshot is truncated')
+        byte = self.buf[self.pos]
+        self.pos += 1
+        return byte
+
+    def read_header(self):
+        if self.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a snapshot')
+        version = self.read_byte()
+        if version != VERSION:
+            raise ValueError(f'Unsupported snapshot version {version}')
+
+    def read_uint(self):
+        value = shift = 0
+        while True:
+            byte = self.read_byte()
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def read_int(self):
+        value = self.read_uint()
+        return -((value + 1) >> 1) if value & 1 else value >> 1
+
+    def read_str(self):
+        return self.read(self.read_uint()).decode('utf-8', 'surrogatepass')
+
+    def resolve_class(self, name):
+        if self.classes is None:
+            from src import data
+            self.classes = data
+        cls = getattr(self.classes, name, None)
+        if not isinstance(cls, type):
+            raise ValueError(f'Unknown class {name} in snapshot')
+        return cls
+
+    def read_shape(self):
+        cls = self.resolve_class(self.read_str())
+        names = [self.read_str() for _ in range(self.read_uint())]
+        self.shapes.append((cls, names))
+
+    def new_object(self, cls):
+        obj = cls.__new__(cls)
+        self.objects.append(obj)
+        return obj
+
+    @staticmethod
+    def set_state(obj, state):
+        setstate = getattr(obj, '__setstate__', None)
+        if setstate is not None:
+            setstate(state)
+        else:
+            obj.__dict__.update(state)
+
+    def read_value(self):
+        """
+
+        Read one value with its tag
+
+        """
+        tag = self.read_byte()
+        while tag == SHAPE:
+            self.read_shape()
+            tag = self.read_byte()
+        if tag == NONE:
+            return None
+        if tag == TRUE:
+            return True
+        if tag == FALSE:
+            return False
+        if tag == INT:
+            return self.read_int()
+        if tag == FLOAT:
+            return FLOAT_FORMAT.unpack(self.read(FLOAT_FORMAT.size))[0]
+        if tag == STR:
+            return self.read_str()
+        if tag in (LIST, TUPLE):
+            items = self.read_column(self.read_uint())
+            return items if tag == LIST else tuple(items)
+        if tag == DICT:
+            size = self.read_uint()
+            keys = self.read_column(size)
+            return dict(zip(keys, self.read_column(size)))
+        if tag == REF:
+            return self.objects[self.read_uint()]
+        if tag == OBJECT:
+            cls, names = self.shapes[self.read_uint()]
+            obj = self.new_object(cls)
+            self.set_state(obj, {name: self.read_value() for name in names})
+            return obj
+        if tag == PICKLE:
+            return pickle.loads(self.read(self.read_uint()))
+        raise ValueError(f'Unknown tag {tag} in snapshot')
+
+    def read_column(self, size):
+        """
+
+        Read the items of a list of the given length
+
+        """
+        tag = self.read_byte()
+        while tag == SHAPE:
+            self.read_shape()
+            tag = self.read_byte()
+        if tag == COL_VALUES:
+            return [self.read_value() for _ in range(size)]
+        if tag == COL_INT:
+            return self.read_int_column(size)
+        if tag == COL_FLOAT:
+            return self.read_array('d', size).tolist()
+        if tag == COL_BOOL:
+            return [byte == 1 for byte in self.read(size)]
+        if tag == COL_STR:
+            lengths = self.read_int_column(size)
+            text = self.read(self.read_uint()).decode('utf-8', 'surrogatepass')
+            ends = list(accumulate(lengths))
+            return [text[end - length:end] for length, end in zip(lengths, ends)]
+        if tag == COL_LIST:
+            lengths = self.read_int_column(size)
+            items = self.read_column(sum(lengths))
+            ends = list(accumulate(lengths))
+            return [items[end - length:end] for length, end in zip(lengths, ends)]
+        if tag == COL_DICT:
+            keys = [self.read_str() for _ in range(self.read_uint())]
+            columns = [self.read_column(size) for _ in keys]
+            return [dict(zip(keys, row)) for row in zip(*columns)] if keys else [dict() for _ in range(size)]
+        if tag == COL_OBJECT:
+            cls, names = self.shapes[self.read_uint()]
+            objs = [self.new_object(cls) for _ in range(size)]
+            columns = [self.read_column(size) for _ in names]
+            for obj, row in zip(objs, zip(*columns) if names else [()] * size):
+                self.set_state(obj, dict(zip(names, row)))
+            return objs
+        raise ValueError(f'Unknown column tag {tag} in snapshot')
+
+    def read_array(self, typecode, size):
+        values = array(typecode)
+        values.frombytes(self.read(values.itemsize * size))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def read_int_column(self, size):
+        typecode = chr(self.read_byte())
+        return list(accumulate(self.read_array(typecode, size)))
@@ -0,0 +1,1285 @@
+"""
+File of the storage engines which persist the database to the disk
+
+The engine is selected by config.storage_engine:
+    'pickle': a full snapshot (config.db_file, in the binary format of src/snapshot.py)
+              plus a write-ahead log of pickled entries (config.wal_file).
+              Each save appends a small journal entry holding only the records modified
+              during the request, the snapshot is only rebuilt at a checkpoint, and
+              loading replays the journal on top of the snapshot. The checkpoint is
+              written by a forked child process, off the request path.
+    'sqlite': a sqlite3 database (config.sqlite_file) with one row for each user, channel,
+              dm, message and notification, each save only updates the modified rows.
+    'sharded': a directory (config.shard_dir) with a metadata file for the id roots, one
+               record file for every user, a log of the sessions and one segment file for
+               every channel and dm, each save only rewrites the records of the users and
+               the segments of the channels and dms it touched.
+
+The sqlite and sharded engines load the users, channels and dms eagerly, the message
+history of a channel or dm is only paged in when it is first accessed.
+
+Several worker processes can share the files: every request holds the database lock
+(config.lock_file) while it loads and saves, and the generation counter in the lock file
+tells a worker when another one has saved since it last loaded. Requests which only read
+share the lock, so the read requests of several workers run at the same time, a request
+which writes holds it exclusively.
+"""
+import contextlib
+import copy
+import os
+import pickle
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # without flock only the threads of one process are serialised
+    fcntl = None
+
+from src import config
+from src import snapshot
+
+# order in which the records of one journal entry are replayed, a dm refers to users
+# and a message refers to its channel or dm, so they have to be applied afterwards
+TABLE_ORDER = ('meta', 'users', 'channels', 'direct_messages', 'messages')
+
+# the roots and sessions, the pickle and sqlite engines write them as a whole with every save
+META_KEYS = ('uid_root', 'cid_root', 'dmid_root', 'mid_root', 'sessions')
+
+# engines: the engine object of every storage engine been used, by name
+engines = dict()
+
+
+def get_engine():
+    """
+
+    Get the storage engine selected by config.storage_engine
+
+    Returns:
+        Object, the storage engine
+
+    Raises:
+        ValueError: When the engine name is unknown
+
+    """
+    name = config.storage_engine
+    if name not in engines:
+        if name not in ENGINES:
+            raise ValueError(f'Unknown storage engine {name}')
+        engines[name] = ENGINES[name]()
+    return engines[name]
+
+
+def load():
+    """
+
+    Load the database with the selected storage engine
+
+    Returns:
+        Dictionary, the database, None if nothing has been saved yet
+
+    """
+    loaded = get_engine().load()
+    lock.seen = lock.generation()
+    return loaded
+
+
+def save(db, changes, checkpoint=False):
+    """
+
+    Save the database with the selected storage engine
+
+    Args:
+        db: Dictionary, the database
+        changes: Dictionary, the records modified since the last save, see data.mark_dirty
+        checkpoint: Boolean, whether to write the whole database
+
+    Returns:
+        N/A
+
+    Raises:
+        SharedLockError: When the lock is only held shared
+
+    """
+    if lock.shared:
+        raise SharedLockError
+    get_engine().save(db, changes, checkpoint)
+    lock.advance()
+
+
+def load_messages(table, key):
+    """
+
+    Page in the message history of a channel or dm which was loaded without it
+
+    Args:
+        table: String, 'channels' or 'direct_messages'
+        key: Integer, the id of the channel or dm
+
+    Returns:
+        List of message objects
+
+    """
+    return get_engine().load_messages(table, key)
+
+
+def is_changed():
+    """
+
+    Check whether the database has been written by another process since this process
+    last loaded or saved it, either through a save which advanced the generation or by
+    changing the files directly
+
+    Returns:
+        True if the database has to be reloaded
+
+    """
+    return lock.generation() != lock.seen or get_engine().is_changed()
+
+
+class SharedLockError(Exception):
+    """
+    Raised when a request holding the lock shared turns out to write the database, the
+    request has to be run again under the exclusive lock
+    """
+
+
+class DatabaseLock:
+    """
+    The lock of the database, shared by the threads of this process through a reentrant
+    lock and by the worker processes through an flock on config.lock_file. The flock is
+    taken shared by the requests which only read, exclusively otherwise. The lock file
+    also holds two counters: the generation, advanced by every save, and the number of
+    checkpoints, advanced whenever the snapshot is rewritten
+
+    Attributes:
+        thread_lock: RLock, serialise the threads of this process
+        depth: Integer, number of nested acquires by the thread holding the lock
+        fd: Integer, the file descriptor of the lock file, None until first used
+        path: String, the absolute path of the opened lock file
+        pid: Integer, the process which opened the lock file, a forked child opens its own
+        seen: Integer, the generation of the database in memory, None if not loaded yet
+        shared: Boolean, whether the flock is held shared
+    """
+
+    def __init__(self):
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+        self.path = None
+        self.pid = None
+        self.seen = None
+        self.shared = False
+
+    def open(self):
+        """
+
+        Open config.lock_file, open it again when the configured path has changed
+
+        Returns:
+            Integer, the file descriptor
+
+        """
+        path = os.path.abspath(config.lock_file)
+        if self.fd is None or path != self.path or self.pid != os.getpid():
+            if self.fd is not None and self.pid == os.getpid():
+                os.close(self.fd)
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.path = path
+            self.pid = os.getpid()
+        return self.fd
+
+    def acquire(self, shared=False):
+        """
+
+        Acquire the lock, a nested acquire keeps the mode of the outermost one
+
+        Args:
+            shared: Boolean, whether other processes may hold the lock shared meanwhile
+
+        Raises:
+            SharedLockError: When the lock is acquired exclusively while this thread
+                             holds it shared
+
+        """
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self.open(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                except BaseException:
+                    self.thread_lock.release()
+                    raise
+            self.shared = shared
+        elif self.shared and not shared:
+            self.thread_lock.release()
+            raise SharedLockError
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.shared = False
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @contextlib.contextmanager
+    def read(self):
+        """The lock held shared for the duration of a with statement"""
+        self.acquire(shared=True)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    GENERATION = 0
+    CHECKPOINT = 1
+
+    def counter(self, index):
+        fd = self.open()
+        os.lseek(fd, index * 8, os.SEEK_SET)
+        return int.from_bytes(os.read(fd, 8), 'little')
+
+    def increment(self, index):
+        """
+
+        Increment one of the counters of the lock file
+
+        Returns:
+            Integer, the new value
+
+        """
+        value = self.counter(index) + 1
+        fd = self.open()
+        os.lseek(fd, index * 8, os.SEEK_SET)
+        os.write(fd, value.to_bytes(8, 'little'))
+        return value
+
+    def generation(self):
+        return self.counter(self.GENERATION)
+
+    def advance(self):
+        """
+
+        Advance the generation after a save, the database in memory is the new generation
+
+        """
+        self.seen = self.increment(self.GENERATION)
+
+
+# lock: the lock of the database held by every request, see data.transaction
+lock = DatabaseLock()
+
+
+def write_atomic(path, dump, obj):
+    """
+
+    Write a file through a temporary file which is renamed over it, so a crash leaves
+    either the old or the new file but never a truncated one
+
+    Args:
+        path: String, the file to write
+        dump: Function, dump(obj, f) writes obj to the binary file f
+        obj: Object, the content of the file
+
+    Returns:
+        N/A
+
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def find_entity(db, table, key):
+    """
+
+    Find a user, channel or dm by its id
+
+    Args:
+        db: Dictionary, the database
+        table: String, 'users', 'channels' or 'direct_messages'
+        key: Integer, the id of the entity
+
+    Returns:
+        entity: Object, None if it does not exist
+        removed: Boolean, whether the entity is in db['removed_users']
+
+    """
+    for entity in db[table]:
+        if entity.id == key:
+            return entity, False
+    if table == 'users':
+        for entity in db['removed_users']:
+            if entity.id == key:
+                return entity, True
+    return None, False
+
+
+def find_message(container, message_id):
+    """
+
+    Find the position of a message in a channel or dm
+
+    Returns:
+        Integer, the index of the message, None if it does not exist
+
+    """
+    for index, message in enumerate(container.messages):
+        if message.id == message_id:
+            return index
+    return None
+
+
+def entity_state(table, entity, removed):
+    """
+
+    The stored state of a user, channel or dm. Messages are stored on their own and the
+    members of a dm are stored as user ids, so the record stays small
+
+    """
+    if entity is None:
+        return None
+    if table == 'users':
+        return entity, removed
+    state = copy.copy(entity)
+    state.messages = list()
+    # the ids of a paged out history are read back from the messages
+    state.__dict__.pop('_message_ids', None)
+    if table == 'direct_messages':
+        state.users = [user.id for user in entity.users]
+    return state
+
+
+def resolve_users(db, state):
+    """
+
+    Replace the user ids of a stored dm with the user objects
+
+    """
+    from src.data import OrderedSet
+    users = [find_entity(db, 'users', u_id)[0] for u_id in state.users]
+    state.users = OrderedSet(user for user in users if user is not None)
+
+
+def iter_changes(db, changes):
+    """
+
+    Resolve the modified records to their current state
+
+    Args:
+        db: Dictionary, the database
+        changes: Dictionary, key is (table, id), value is the list of modified message ids,
+                 None in the list means the entity itself has been modified
+
+    Returns:
+        List of record (table, key, state), state is None if the record has been deleted.
+        The key of a message is (table, container id, message id)
+
+    """
+    records = list()
+    for (table, key), message_ids in changes.items():
+        # the roots and the sessions are written with the metadata
+        if table in ('meta', 'sessions'):
+            continue
+        entity, removed = find_entity(db, table, key)
+        if entity is None or None in message_ids:
+            records.append((table, key, entity_state(table, entity, removed)))
+        if entity is None:
+            continue
+        for message_id in dict.fromkeys(message_ids):
+            if message_id is None:
+                continue
+            index = find_message(entity, message_id)
+            message = None if index is None else entity.messages[index]
+            records.append(('messages', (table, key, message_id), message))
+    records.sort(key=lambda record: TABLE_ORDER.index(record[0]))
+    return records
+
+
+class StatsTracker:
+    """
+    Remember the length of every dreams_stats series when it was last persisted, so only
+    the new entries of the series have to be written
+    """
+
+    def __init__(self):
+        self.saved = dict()
+
+    def remember(self, db):
+        self.saved.clear()
+        for series, value in db['dreams_stats'].items():
+            if isinstance(value, list):
+                self.saved[series] = len(value)
+
+    def tail(self, db):
+        """
+
+        Returns:
+            Dictionary, key is the series, value is (start, new entries from start)
+
+        """
+        stats_tail = dict()
+        for series, value in db['dreams_stats'].items():
+            if isinstance(value, list):
+                start = self.saved.get(series, 0)
+                if start > len(value):
+                    start = 0
+                stats_tail[series] = (start, value[start:])
+        return stats_tail
+
+
+class PickleEngine:
+    """
+    Store the database as a binary snapshot plus a write-ahead log
+
+    A checkpoint renames the log to the rotated log and forks a child which writes the
+    memory image of the database to the snapshot, then removes the rotated log. The
+    parent goes on appending to a new log. Until the child is done the rotated log is
+    replayed before the log, replaying it again on the new snapshot is harmless since an
+    entry holds the whole state of every record in it
+
+    Attributes:
+        wal_entries: Integer, number of journal entries appended since the last checkpoint
+        stats: StatsTracker, the persisted length of the dreams_stats series
+        disk_state: Tuple, stat of the files when this process last loaded or saved them
+        child: Integer, pid of the child writing a checkpoint, None if there is none
+    """
+
+    def __init__(self):
+        self.wal_entries = 0
+        self.stats = StatsTracker()
+        self.disk_state = None
+        self.child = None
+
+    @staticmethod
+    def rotated_wal_file():
+        return config.wal_file + '.old'
+
+    def load(self):
+        """
+
+        Load the snapshot and replay the write-ahead log on it
+
+        Returns:
+            Dictionary, the recovered database, None if there is no snapshot
+
+        """
+        db = None
+        if os.access(config.db_file, os.R_OK) and os.path.getsize(config.db_file) > 0:
+            # The snapshot is replaced atomically, a truncated one is a damaged disk and
+            # must not be taken for an empty database
+            with open(config.db_file, 'rb') as f:
+                # a database.p written before the snapshot format is a plain pickle
+                is_snapshot = f.read(len(snapshot.MAGIC)) == snapshot.MAGIC
+                f.seek(0)
+                db = snapshot.load(f) if is_snapshot else pickle.load(f)
+
+        replayed = 0
+        for path in (self.rotated_wal_file(), config.wal_file):
+            if db is None or not os.access(path, os.R_OK):
+                continue
+            with open(path, 'rb+') as f:
+                while True:
+                    offset = f.tell()
+                    try:
+                        entry = pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError):
+                        # A torn entry at the tail is a write interrupted by a crash, cut
+                        # it off so the next append is not hidden behind it
+                        if offset < os.fstat(f.fileno()).st_size:
+                            f.truncate(offset)
+                        break
+                    self.apply_entry(db, entry)
+                    replayed += 1
+
+        self.wal_entries = replayed
+        if db is not None:
+            self.stats.remember(db)
+        self.disk_state = self.stat_files()
+        return db
+
+    def save(self, db, changes, checkpoint=False):
+        """
+
+        Append a journal entry, and start a background checkpoint once the log holds
+        config.checkpoint_interval entries. A forced checkpoint, or a save without the
+        log, rewrites the snapshot before returning
+
+        """
+        self.reap()
+        if not config.wal_enabled or checkpoint or not os.path.exists(config.db_file):
+            self.write_snapshot(db)
+            return
+        entry = self.build_entry(db, changes)
+        with open(config.wal_file, 'ab') as f:
+            pickle.dump(entry, f)
+        self.wal_entries += 1
+        self.stats.remember(db)
+        if self.wal_entries >= config.checkpoint_interval and self.child is None:
+            self.start_checkpoint(db)
+        self.disk_state = self.stat_files()
+
+    def start_checkpoint(self, db):
+        """
+
+        Rotate the log and fork a child writing the snapshot, the request does not wait
+        for it. Without fork, or after a background checkpoint failed and left its rotated
+        log behind, the snapshot is written before returning
+
+        """
+        if not config.background_snapshot or not hasattr(os, 'fork') \
+                or os.path.exists(self.rotated_wal_file()):
+            self.write_snapshot(db)
+            return
+        os.replace(config.wal_file, self.rotated_wal_file())
+        checkpoint = lock.increment(lock.CHECKPOINT)
+        self.wal_entries = 0
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.write_checkpoint(db, checkpoint)
+                status = 0
+            finally:
+                os._exit(status)
+        self.child = pid
+
+    def write_checkpoint(self, db, checkpoint):
+        """
+
+        Run in the forked child, write the snapshot aside and install it under the lock.
+        If another worker has rewritten the snapshot meanwhile, the checkpoint counter has
+        moved on and this older snapshot is dropped
+
+        """
+        tmp_path = f'{config.db_file}.{os.getpid()}.tmp'
+        write_atomic(tmp_path, snapshot.dump, db)
+        try:
+            with DatabaseLock() as child_lock:
+                if child_lock.counter(child_lock.CHECKPOINT) == checkpoint:
+                    os.replace(tmp_path, config.db_file)
+                    os.remove(self.rotated_wal_file())
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def reap(self, wait=False):
+        """
+
+        Collect the child writing a checkpoint once it has exited
+
+        Args:
+            wait: Boolean, whether to block until the child exits
+
+        Returns:
+            N/A
+
+        """
+        if self.child is None:
+            return
+        try:
+            pid, _ = os.waitpid(self.child, 0 if wait else os.WNOHANG)
+        except ChildProcessError:
+            # the child of the process this worker was forked from
+            self.child = None
+            return
+        if pid == 0:
+            return
+        self.child = None
+        # the new snapshot is the one written from this process' memory, so it does not
+        # have to be reloaded unless someone else appended to the log meanwhile
+        state = self.stat_files()
+        if self.disk_state is not None and state[1] == self.disk_state[1]:
+            self.disk_state = state
+
+    def write_snapshot(self, db):
+        """
+
+        Write the full database to the snapshot and empty the write-ahead log
+
+        """
+        # a running background checkpoint finds the counter moved on and drops its older
+        # snapshot. It is not waited for, it needs the lock this request is holding
+        lock.increment(lock.CHECKPOINT)
+        self.reap()
+        write_atomic(config.db_file, snapshot.dump, db)
+        for path in (config.wal_file, self.rotated_wal_file()):
+            if os.path.exists(path):
+                os.remove(path)
+        self.wal_entries = 0
+        self.stats.remember(db)
+        self.disk_state = self.stat_files()
+
+    def stat_files(self):
+        """
+
+        The inode, size and modification time of the snapshot, the write-ahead log and
+        the rotated log
+
+        Returns:
+            Tuple, one entry for each file, None if the file does not exist
+
+        """
+        state = list()
+        for path in (config.db_file, config.wal_file, self.rotated_wal_file()):
+            try:
+                stat = os.stat(path)
+                state.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                state.append(None)
+        return tuple(state)
+
+    def is_changed(self):
+        self.reap()
+        if self.disk_state is None:
+            return True
+        state = self.stat_files()
+        if self.child is not None:
+            # the snapshot and the rotated log are being replaced by the child, from the
+            # memory of this process
+            return state[1] != self.disk_state[1]
+        return state != self.disk_state
+
+    @staticmethod
+    def load_messages(table, key):
+        # The snapshot holds every message, nothing is ever paged out
+        return list()
+
+    def build_entry(self, db, changes):
+        """
+
+        Build the journal entry of the records modified since the last save
+
+        Returns:
+            List of record (table, key, state), see iter_changes
+
+        """
+        meta = {key: db[key] for key in META_KEYS}
+        meta['utilization_rate'] = db['dreams_stats']['utilization_rate']
+        meta['stats_tail'] = self.stats.tail(db)
+        return [('meta', None, meta)] + iter_changes(db, changes)
+
+    @staticmethod
+    def apply_entry(db, entry):
+        """
+
+        Replay one journal entry on the database
+
+        """
+        for table, key, state in entry:
+            if table == 'meta':
+                PickleEngine.apply_meta(db, state)
+            elif table == 'users':
+                PickleEngine.apply_user(db, key, state)
+            elif table == 'messages':
+                PickleEngine.apply_message(db, key, state)
+            else:
+                PickleEngine.apply_conversation(db, table, key, state)
+
+    @staticmethod
+    def apply_meta(db, state):
+        # entries journaled before the session table carry the login_token list instead
+        if 'login_token' in state:
+            db['login_token'] = state['login_token']
+        else:
+            db.pop('login_token', None)
+        for key in META_KEYS:
+            if key in state:
+                db[key] = state[key]
+        db['dreams_stats']['utilization_rate'] = state['utilization_rate']
+        for series, (start, entries) in state['stats_tail'].items():
+            db['dreams_stats'][series][start:] = entries
+
+    @staticmethod
+    def apply_user(db, key, state):
+        user, removed = state
+        exist_user, was_removed = find_entity(db, 'users', key)
+        if exist_user is None:
+            db['removed_users' if removed else 'users'].append(user)
+            return
+        # Update in place, the dms hold references to the same user object
+        exist_user.__dict__.update(user.__dict__)
+        if removed and not was_removed:
+            db['users'].remove(exist_user)
+            db['removed_users'].append(exist_user)
+
+    @staticmethod
+    def apply_conversation(db, table, key, state):
+        exist, _ = find_entity(db, table, key)
+        if state is None:
+            if exist is not None:
+                db[table].remove(exist)
+            return
+        if table == 'direct_messages':
+            resolve_users(db, state)
+        if exist is None:
+            db[table].append(state)
+            return
+        messages = exist.messages
+        exist.__dict__.update(state.__dict__)
+        exist.messages = messages
+
+    @staticmethod
+    def apply_message(db, key, message):
+        table, container_id, message_id = key
+        container, _ = find_entity(db, table, container_id)
+        if container is None:
+            return
+        index = find_message(container, message_id)
+        if index is None:
+            if message is not None:
+                container.messages.append(message)
+        elif message is None:
+            del container.messages[index]
+        else:
+            container.messages[index].__dict__.update(message.__dict__)
+
+
+class SqliteEngine:
+    """
+    Store the database in sqlite3, one row for each user, channel, dm, message and
+    notification, the rest of the object is pickled into the state column
+
+    Attributes:
+        conn: Connection, the connection to config.sqlite_file
+        path: String, the absolute path of the connected file
+        pid: Integer, the process which connected
+        stats: StatsTracker, the persisted length of the dreams_stats series
+        data_version: Integer, the data version when this process last loaded or saved
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value BLOB
+        );
+        CREATE TABLE IF NOT EXISTS dreams_stats (
+            series TEXT,
+            position INTEGER,
+            value INTEGER,
+            time_stamp INTEGER,
+            PRIMARY KEY (series, position)
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            u_id INTEGER PRIMARY KEY,
+            email TEXT,
+            handle TEXT,
+            removed INTEGER,
+            state BLOB
+        );
+        CREATE INDEX IF NOT EXISTS users_email ON users (email);
+        CREATE INDEX IF NOT EXISTS users_handle ON users (handle);
+        CREATE TABLE IF NOT EXISTS notifications (
+            u_id INTEGER,
+            position INTEGER,
+            channel_id INTEGER,
+            dm_id INTEGER,
+            message TEXT,
+            PRIMARY KEY (u_id, position)
+        );
+        CREATE TABLE IF NOT EXISTS channels (
+            channel_id INTEGER PRIMARY KEY,
+            name TEXT,
+            state BLOB
+        );
+        CREATE TABLE IF NOT EXISTS direct_messages (
+            dm_id INTEGER PRIMARY KEY,
+            name TEXT,
+            state BLOB
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER PRIMARY KEY,
+            channel_id INTEGER,
+            dm_id INTEGER,
+            position INTEGER,
+            owner_id INTEGER,
+            time INTEGER,
+            content TEXT,
+            state BLOB
+        );
+        CREATE INDEX IF NOT EXISTS messages_position ON messages (position);
+        CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, position);
+        CREATE INDEX IF NOT EXISTS messages_dm ON messages (dm_id, position);
+        CREATE INDEX IF NOT EXISTS messages_owner ON messages (owner_id);
+    """
+
+    # the column which refers to the channel or dm
+    CONTAINER_COLUMN = {'channels': 'channel_id', 'direct_messages': 'dm_id'}
+
+    def __init__(self):
+        self.conn = None
+        self.path = None
+        self.pid = None
+        self.stats = StatsTracker()
+        self.data_version = None
+
+    def connect(self):
+        """
+
+        Connect to config.sqlite_file, reconnect when the configured path has changed
+
+        Returns:
+            Connection
+
+        """
+        path = os.path.abspath(config.sqlite_file)
+        if self.conn is None or path != self.path or self.pid != os.getpid():
+            # a connection must not be used across fork, a forked worker opens its own
+            if self.conn is not None and self.pid == os.getpid():
+                self.conn.close()
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.executescript(self.SCHEMA)
+            self.path = path
+            self.pid = os.getpid()
+            self.data_version = None
+        return self.conn
+
+    def version(self):
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def is_changed(self):
+        if self.conn is None or os.path.abspath(config.sqlite_file) != self.path:
+            return True
+        return self.version() != self.data_version
+
+    def load(self):
+        """
+
+        Load the whole database from the rows
+
+        Returns:
+            Dictionary, the database, None if nothing has been saved yet
+
+        """
+        # Imported here, src.data imports this module
+        from src.data import Notification
+        conn = self.connect()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'db'").fetchone()
+        self.data_version = self.version()
+        if row is None:
+            return None
+        db = pickle.loads(row[0])
+
+        for series, value, time_stamp in conn.execute(
+                'SELECT series, value, time_stamp FROM dreams_stats ORDER BY series, position'):
+            db['dreams_stats'][series].append({f'num_{series}': value, 'time_stamp': time_stamp})
+
+        users = dict()
+        for removed, state in conn.execute('SELECT removed, state FROM users ORDER BY u_id'):
+            user = pickle.loads(state)
+            users[user.id] = user
+            db['removed_users' if removed else 'users'].append(user)
+        for u_id, channel_id, dm_id, message in conn.execute(
+                'SELECT u_id, channel_id, dm_id, message FROM notifications '
+                'ORDER BY u_id, position'):
+            users[u_id].notifications.append(Notification(channel_id, dm_id, message))
+
+        containers = {'channels': dict(), 'direct_messages': dict()}
+        for (state,) in conn.execute('SELECT state FROM channels ORDER BY channel_id'):
+            channel = pickle.loads(state)
+            containers['channels'][channel.id] = channel
+            db['channels'].append(channel)
+        for (state,) in conn.execute('SELECT state FROM direct_messages ORDER BY dm_id'):
+            dm = pickle.loads(state)
+            resolve_users(db, dm)
+            containers['direct_messages'][dm.id] = dm
+            db['direct_messages'].append(dm)
+        for table, containers_of_table in containers.items():
+            id_column = self.CONTAINER_COLUMN[table]
+            # only the ids are read, from the index of the conversation and position
+            message_ids = dict()
+            for key, message_id in conn.execute(f'SELECT {id_column}, message_id FROM messages '
+                                                f'WHERE {id_column} IS NOT NULL '
+                                                f'ORDER BY {id_column}, position'):
+                message_ids.setdefault(key, list()).append(message_id)
+            for key, container in containers_of_table.items():
+                container.page_out(message_ids.get(key, list()))
+
+        self.stats.remember(db)
+        return db
+
+    def load_messages(self, table, key):
+        id_column = self.CONTAINER_COLUMN[table]
+        rows = self.connect().execute(
+            f'SELECT state FROM messages WHERE {id_column} = ? ORDER BY position', (key,))
+        return [pickle.loads(state) for (state,) in rows]
+
+    def save(self, db, changes, checkpoint=False):
+        """
+
+        Update the modified rows in one transaction, or rewrite every row at a checkpoint
+
+        """
+        conn = self.connect()
+        with conn:
+            first = conn.execute("SELECT 1 FROM meta WHERE key = 'db'").fetchone() is None
+            if checkpoint or first:
+                self.rewrite(db)
+            else:
+                self.write_meta(db)
+                for table, key, state in iter_changes(db, changes):
+                    if table == 'users':
+                        self.write_user(key, state)
+                    elif table == 'messages':
+                        self.write_message(*key, state)
+                    else:
+                        self.write_conversation(table, key, state)
+        self.stats.remember(db)
+        self.data_version = self.version()
+
+    def rewrite(self, db):
+        for table in ('meta', 'dreams_stats', 'users', 'notifications', 'channels',
+                      'direct_messages', 'messages'):
+            self.conn.execute(f'DELETE FROM {table}')
+        self.stats.saved.clear()
+        self.write_meta(db)
+        for removed, table in ((False, 'users'), (True, 'removed_users')):
+            for user in db[table]:
+                self.write_user(user.id, (user, removed))
+        for table in ('channels', 'direct_messages'):
+            for container in db[table]:
+                self.write_conversation(table, container.id, entity_state(table, container, False))
+                for message in container.messages:
+                    self.write_message(table, container.id, message.id, message)
+
+    def write_meta(self, db):
+        meta = {key: db[key] for key in META_KEYS}
+        meta['dreams_stats'] = {series: list() for series in db['dreams_stats']}
+        meta['dreams_stats']['utilization_rate'] = db['dreams_stats']['utilization_rate']
+        for key in ('users', 'channels', 'direct_messages', 'removed_users'):
+            meta[key] = list()
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('db', ?)",
+                          (pickle.dumps(meta),))
+        for series, (start, entries) in self.stats.tail(db).items():
+            self.conn.execute('DELETE FROM dreams_stats WHERE series = ? AND position >= ?',
+                              (series, start))
+            self.conn.executemany(
+                'INSERT INTO dreams_stats (series, position, value, time_stamp) '
+                'VALUES (?, ?, ?, ?)',
+                [(series, start + i, entry[f'num_{series}'], entry['time_stamp'])
+                 for i, entry in enumerate(entries)])
+
+    def write_user(self, u_id, state):
+        user, removed = state
+        # Notifications only ever get appended, the stored ones are kept
+        stored = self.conn.execute('SELECT COUNT(*) FROM notifications WHERE u_id = ?',
+                                   (u_id,)).fetchone()[0]
+        self.conn.executemany(
+            'INSERT INTO notifications (u_id, position, channel_id, dm_id, message) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(u_id, stored + i, notification.channel_id, notification.dm_id,
+              notification.message)
+             for i, notification in enumerate(user.notifications[stored:])])
+        row = copy.copy(user)
+        row.notifications = list()
+        self.conn.execute(
+            'INSERT INTO users (u_id, email, handle, removed, state) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (u_id) DO UPDATE SET email = excluded.email, '
+            'handle = excluded.handle, removed = excluded.removed, state = excluded.state',
+            (u_id, user.email, user.handle, int(removed), pickle.dumps(row)))
+
+    def write_conversation(self, table, key, state):
+        id_column = self.CONTAINER_COLUMN[table]
+        if state is None:
+            self.conn.execute(f'DELETE FROM {table} WHERE {id_column} = ?', (key,))
+            self.conn.execute(f'DELETE FROM messages WHERE {id_column} = ?', (key,))
+            return
+        self.conn.execute(f'INSERT OR REPLACE INTO {table} ({id_column}, name, state) '
+                          'VALUES (?, ?, ?)', (key, state.name, pickle.dumps(state)))
+
+    def write_message(self, table, container_id, message_id, message):
+        if message is None:
+            self.conn.execute('DELETE FROM messages WHERE message_id = ?', (message_id,))
+            return
+        channel_id = container_id if table == 'channels' else None
+        dm_id = container_id if table == 'direct_messages' else None
+        # A new message goes after every stored message, an update keeps its position
+        self.conn.execute(
+            'INSERT INTO messages (message_id, channel_id, dm_id, position, owner_id, time, '
+            'content, state) VALUES (?, ?, ?, '
+            '(SELECT COALESCE(MAX(position), 0) + 1 FROM messages), ?, ?, ?, ?) '
+            'ON CONFLICT (message_id) DO UPDATE SET content = excluded.content, '
+            'state = excluded.state',
+            (message_id, channel_id, dm_id, message.owner_id, message.time, message.content,
+             pickle.dumps(message)))
+
+
+class ShardedEngine:
+    """
+    Store the database in config.shard_dir, one small metadata file for the id roots, one
+    record file for every user, append-only logs of the sessions and of the dreams_stats
+    entries, and for every channel and every dm one segment file plus one file of its
+    message history. A save only rewrites the files of the records it touched
+
+    Attributes:
+        stats: StatsTracker, the persisted length of the dreams_stats series
+        session_records: Integer, number of session records in the session log
+        outdated: Boolean, whether the loaded metadata file still holds the users and
+                  sessions, the next save then rewrites every file
+        disk_state: Tuple, stat of the files when this process last loaded or saved them
+    """
+
+    META_FILE = 'meta.p'
+    STATS_FILE = 'stats.log'
+    SESSIONS_FILE = 'sessions.log'
+    # prefix of the user record file names, followed by the id of the user
+    USER_PREFIX = 'user_'
+    # prefix of the segment file names, followed by the id of the channel or dm
+    SHARD_PREFIX = {'channels': 'channel_', 'direct_messages': 'dm_'}
+
+    def __init__(self):
+        self.stats = StatsTracker()
+        self.session_records = 0
+        self.outdated = False
+        self.disk_state = None
+
+    @staticmethod
+    def path(name):
+        return os.path.join(config.shard_dir, name)
+
+    def user_name(self, key):
+        return f'{self.USER_PREFIX}{key}.p'
+
+    def shard_name(self, table, key):
+        return f'{self.SHARD_PREFIX[table]}{key}.p'
+
+    def history_name(self, table, key):
+        return f'{self.SHARD_PREFIX[table]}{key}.messages.p'
+
+    @staticmethod
+    def write_file(name, obj):
+        """
+
+        Write an object to a file of the shard directory, the file is replaced as a whole so
+        a crash never leaves half of a segment behind
+
+        """
+        write_atomic(ShardedEngine.path(name), pickle.dump, obj)
+
+    @staticmethod
+    def read_log(name):
+        """
+
+        Read the records of a log of the shard directory, a record cut short by a crash
+        ends the log
+
+        Returns:
+            List of the records, empty if the log does not exist
+
+        """
+        records = list()
+        if not os.path.exists(ShardedEngine.path(name)):
+            return records
+        with open(ShardedEngine.path(name), 'rb') as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except (EOFError, pickle.UnpicklingError):
+                    return records
+
+    def stat_files(self):
+        state = list()
+        for path in (config.shard_dir, self.path(self.STATS_FILE), self.path(self.SESSIONS_FILE)):
+            try:
+                stat = os.stat(path)
+                state.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                state.append(None)
+        return tuple(state)
+
+    def is_changed(self):
+        return self.disk_state is None or self.stat_files() != self.disk_state
+
+    def load(self):
+        """
+
+        Load the metadata, the logs, the user records and every segment
+
+        Returns:
+            Dictionary, the database, None if nothing has been saved yet
+
+        """
+        if not os.path.exists(self.path(self.META_FILE)):
+            self.disk_state = self.stat_files()
+            return None
+        with open(self.path(self.META_FILE), 'rb') as f:
+            db = pickle.load(f)
+        # files saved before the user records and the session log, or before the session table
+        self.outdated = bool(db['users'] or db['removed_users'] or db.get('sessions')
+                             or 'login_token' in db)
+        for stats_tail in self.read_log(self.STATS_FILE):
+            for series, (start, entries) in stats_tail.items():
+                db['dreams_stats'][series][start:] = entries
+        self.session_records = 0
+        for records in self.read_log(self.SESSIONS_FILE):
+            sessions = db.setdefault('sessions', dict())
+            for token, session in records.items():
+                if session is None:
+                    sessions.pop(token, None)
+                else:
+                    sessions[token] = session
+            self.session_records += len(records)
+
+        users = list()
+        for name in os.listdir(config.shard_dir):
+            if name.endswith('.messages.p') or not name.endswith('.p'):
+                continue
+            if name.startswith(self.USER_PREFIX):
+                with open(self.path(name), 'rb') as f:
+                    users.append(pickle.load(f))
+            for table, prefix in self.SHARD_PREFIX.items():
+                if name.startswith(prefix):
+                    with open(self.path(name), 'rb') as f:
+                        db[table].append(pickle.load(f))
+        for user, removed in sorted(users, key=lambda state: state[0].id):
+            db['removed_users' if removed else 'users'].append(user)
+        for table in self.SHARD_PREFIX:
+            db[table].sort(key=lambda container: container.id)
+        for dm in db['direct_messages']:
+            resolve_users(db, dm)
+
+        self.stats.remember(db)
+        self.disk_state = self.stat_files()
+        return db
+
+    def load_messages(self, table, key):
+        path = self.path(self.history_name(table, key))
+        if not os.path.exists(path):
+            return list()
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, db, changes, checkpoint=False):
+        """
+
+        Rewrite the touched records and segments and append the logs, or rewrite every file
+        at a checkpoint
+
+        """
+        os.makedirs(config.shard_dir, exist_ok=True)
+        if checkpoint or self.outdated or not os.path.exists(self.path(self.META_FILE)):
+            self.rewrite(db)
+        else:
+            if ('meta', None) in changes:
+                self.write_meta(db)
+            self.append_stats(db)
+            self.append_sessions(db, [key for table, key in changes if table == 'sessions'])
+            for (table, key), message_ids in changes.items():
+                if table == 'users':
+                    self.write_user(key, entity_state(table, *find_entity(db, table, key)))
+                elif table in self.SHARD_PREFIX:
+                    history = any(message_id is not None for message_id in message_ids)
+                    self.write_shard(table, key, find_entity(db, table, key)[0], history)
+        self.stats.remember(db)
+        self.disk_state = self.stat_files()
+
+    def rewrite(self, db):
+        for name in os.listdir(config.shard_dir):
+            os.remove(self.path(name))
+        self.stats.saved.clear()
+        self.outdated = False
+        self.write_meta(db)
+        self.append_stats(db)
+        self.write_sessions(db)
+        for removed, table in ((False, 'users'), (True, 'removed_users')):
+            for user in db[table]:
+                self.write_user(user.id, (user, removed))
+        for table in self.SHARD_PREFIX:
+            for container in db[table]:
+                self.write_shard(table, container.id, container, True)
+
+    def write_meta(self, db):
+        meta = {key: db[key] for key in META_KEYS}
+        meta['sessions'] = dict()
+        meta['dreams_stats'] = {series: list() for series in db['dreams_stats']}
+        meta['dreams_stats']['utilization_rate'] = db['dreams_stats']['utilization_rate']
+        for key in ('users', 'removed_users', 'channels', 'direct_messages'):
+            meta[key] = list()
+        self.write_file(self.META_FILE, meta)
+
+    def append_stats(self, db):
+        stats_tail = self.stats.tail(db)
+        if any(entries for _, entries in stats_tail.values()):
+            with open(self.path(self.STATS_FILE), 'ab') as f:
+                pickle.dump(stats_tail, f)
+
+    def append_sessions(self, db, tokens):
+        """
+
+        Append the state of the modified sessions to the session log, None for an evicted
+        one. Once the log holds config.checkpoint_interval records more than there are
+        sessions, it is replaced by the session table
+
+        """
+        if not tokens:
+            return
+        sessions = {token: db['sessions'].get(token) for token in tokens}
+        self.session_records += len(sessions)
+        if self.session_records > len(db['sessions']) + config.checkpoint_interval:
+            self.write_sessions(db)
+            return
+        with open(self.path(self.SESSIONS_FILE), 'ab') as f:
+            pickle.dump(sessions, f)
+
+    def write_sessions(self, db):
+        self.write_file(self.SESSIONS_FILE, dict(db['sessions']))
+        self.session_records = len(db['sessions'])
+
+    def write_user(self, key, state):
+        """
+
+        Write the record of a user, (user, whether the user is removed), or remove it if
+        state is None
+
+        """
+        name = self.user_name(key)
+        if state is None:
+            if os.path.exists(self.path(name)):
+                os.remove(self.path(name))
+            return
+        self.write_file(name, state)
+
+    def write_shard(self, table, key, container, history):
+        """
+
+        Write the segment of a channel or dm, and its message history if history is True
+
+        """
+        names = (self.shard_name(table, key), self.history_name(table, key))
+        if container is None:
+            for name in names:
+                if os.path.exists(self.path(name)):
+                    os.remove(self.path(name))
+            return
+        shard = copy.copy(container)
+        shard.page_out(container.message_ids())
+        if table == 'direct_messages':
+            shard.users = [user.id for user in container.users]
+        self.write_file(names[0], shard)
+        if history:
+            self.write_file(names[1], container.messages)
+
+
+ENGINES = {
+    'pickle': PickleEngine,
+    'sqlite': SqliteEngine,
+    'sharded': ShardedEngine,
+}
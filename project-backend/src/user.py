@@ -1,7 +1,8 @@
-from src.data import load_db, save_db
+from src.data import load_db, save_db, transaction, read_transaction, mark_dirty
 from src.data import User
 from src.error import InputError, AccessError
 
+@read_transaction
 def user_profile_v2(token, u_id):
     """
 
@@ -44,6 +45,7 @@ def user_profile_v2(token, u_id):
 
     return output
 
+@transaction
 def user_profile_setname_v2(token, name_first, name_last):
     """
 
@@ -78,12 +80,14 @@ def user_profile_setname_v2(token, name_first, name_last):
     # set name
     match_user.name['name_fir'] = name_first
     match_user.name['name_last'] = name_last
+    mark_dirty('users', match_user.id)
     # update database
     save_db()
 
     return {
     }
 
+@transaction
 def user_profile_setemail_v2(token, email):
     """
 
@@ -115,13 +119,14 @@ def user_profile_setemail_v2(token, email):
     User.check_email_valid(email)
     User.check_email_been_used(email)
     # set email
-    match_user.email = email
+    match_user.set_email(email)
     # update database
     save_db()
 
     return {
     }
 
+@transaction
 def user_profile_sethandle_v1(token, handle_str):
     """
 
@@ -150,13 +155,14 @@ def user_profile_sethandle_v1(token, handle_str):
     # Check whether the handle is valid and whether it has been taken
     User.check_handle_valid(handle_str)
     # set handle
-    match_user.handle = handle_str
+    match_user.set_handle(handle_str)
     # update database
     save_db()
 
     return {
     }
 
+@read_transaction
 def users_all_v1(token):
     """
 
@@ -185,3 +191,33 @@ def users_all_v1(token):
     # retur all users' profile
     return User.profile_append_in_users()
 
+@read_transaction
+def user_stats_v1(token):
+    """
+
+    Given a registered user's token, return the user's stats of channels joined, dms joined
+    and messages sent, and the user's involvement rate.
+    If the token is invalid, an AccessError will be raised.
+
+    Args:
+        'token': string
+
+    Returns:
+        Dictionary
+        {
+        user_stats: see the data type user_stats
+        }
+
+    Raises:
+        AccessError: When the token is invalid
+
+    """
+    # load database
+    load_db()
+    # get the corresponding user
+    token_uid = User.token_to_id(token)
+    match_user = User.check_u_id_match(token_uid)
+    save_db()
+    return {
+        'user_stats': match_user.transfer_to_stats()
+    }
@@ -1,7 +1,9 @@
 import pytest
 
+from src import data
 from src.auth import auth_login_v2, auth_register_v2, auth_logout_v1
 from src.other import clear_v1
+from src.data import User, load_db, save_db
 from src.error import InputError
 
 
@@ -256,6 +258,48 @@ class TestLogout:
             assert auth_logout_v1(ret_dict['token']) == {'is_success': False}
 
 
+def add_users(count):
+    """Register count users straight into the database, without a request per user"""
+    load_db()
+    for i in range(len(data.db['users']), count):
+        User(f'user{i}@example.com', 'password', 'First', 'Last', f'firstlast{i}').add_to_db()
+    save_db()
+
+
+@pytest.mark.usefixtures("clear")
+class TestLoginThroughput:
+    """
+    Test cases for the cost of login against the number of registered users, the latency
+    is measured by benchmarks/login_benchmark.py
+    """
+    def test_single_hash(self, monkeypatch):
+        """The candidate password is hashed once, whatever the number of users"""
+        add_users(1000)
+        hashed = list()
+        encrypt_password = User.encrypt_password
+        monkeypatch.setattr(User, 'encrypt_password',
+                            staticmethod(lambda password: hashed.append(password) or encrypt_password(password)))
+        assert auth_login_v2('user999@example.com', 'password')['auth_user_id'] == 1000
+        assert len(hashed) == 1
+        with pytest.raises(InputError):
+            auth_login_v2('user999@example.com', 'wrong password')
+        assert len(hashed) == 2
+
+    def test_email_index(self, monkeypatch):
+        """The user is found through the email index, the users are not scanned"""
+        add_users(1000)
+
+        class Unscanned(list):
+            def __iter__(self):
+                raise AssertionError('the users were scanned')
+
+        users = data.db['users']
+        monkeypatch.setitem(data.db, 'users', Unscanned(users))
+        assert User.check_email_password_match('user999@example.com', 'password') is users[999]
+        with pytest.raises(InputError):
+            User.check_email_password_match('missing@example.com', 'password')
+
+
 # @pytest.mark.usefixtures("clear")
 # class TestPasswordResetRequest:
 #     test_user = auth_register_v2('andrew.brode233@gmail.com', '123456', 'Andrew', 'Brode')
@@ -0,0 +1,14 @@
+import pytest
+
+from src import config
+
+
+def pytest_addoption(parser):
+    parser.addoption('--storage-engine', default=config.storage_engine,
+                     help="storage engine of the database, 'pickle', 'sqlite' or 'sharded'")
+
+
+@pytest.fixture(autouse=True, scope='session')
+def storage_engine(request):
+    """Run the tests against the storage engine given on the command line"""
+    config.storage_engine = request.config.getoption('--storage-engine')
@@ -0,0 +1,470 @@
+from src import data
+from src import storage
+from src.admin import admin_user_remove_v1
+from src.auth import auth_register_v2, auth_logout_v1
+from src.channel import channel_join_v2, channel_leave_v1, channel_addowner_v1
+from src.channels import channels_create_v2, channels_list_v2
+from src.dm import dm_create_v1, dm_remove_v1, dm_invite_v1, dm_leave_v1, dm_list_v1
+from src.other import clear_v1, notifications_get_v1
+from src.user import user_profile_setemail_v2, user_profile_sethandle_v1
+from src.data import User, Channel, DirectMessage, Message, OrderedSet
+from src import config
+from src.helper import generate_timestamp
+from src.error import InputError, AccessError
+from src.message import message_send_v2, message_senddm_v1, message_edit_v2, message_remove_v1
+import pickle
+import random
+import threading
+
+import pytest
+
+
+@pytest.fixture()
+def clear(tmp_path, monkeypatch):
+    """Keep the database files of these tests away from the working directory"""
+    monkeypatch.chdir(tmp_path)
+    clear_v1()
+
+
+@pytest.fixture(name='user_list')
+def create_user_list():
+    """
+    Fixture function, register two users and create a channel and a dm between them
+
+    Returns:
+        user_list: List, contain the registered users' information
+
+    """
+    user_list = list()
+    user_list.append(auth_register_v2("pony.ma@qq.com", "PonyMa", "Pony", "Ma"))
+    user_list.append(auth_register_v2("jack.ma@qq.com", "JackMa", "Jack", "Ma"))
+    return user_list
+
+
+@pytest.fixture()
+def expiry(monkeypatch):
+    """Let the sessions expire, they do not by default"""
+    monkeypatch.setattr(config, 'session_ttl', 24 * 60 * 60)
+    monkeypatch.setattr(config, 'session_idle_timeout', 60 * 60)
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    """The current timestamp seen by the sessions, advanced by the test"""
+    now = [generate_timestamp()]
+    monkeypatch.setattr(data, 'generate_timestamp', lambda: now[0])
+    return now
+
+
+def restart():
+    """Simulate a restart of the server, the database only exists on the disk"""
+    data.db = None
+    storage.engines.clear()
+    data.load_db()
+
+
+@pytest.mark.usefixtures("clear")
+class TestIdIndex:
+    """
+    Test cases for the indexes of the users, channels and dms by id
+    """
+    def test_lookup(self, user_list):
+        """Every registered user, created channel and dm is found by its id"""
+        channel = channels_create_v2(user_list[0]['token'], "channel", is_public=True)
+        dm = dm_create_v1(user_list[0]['token'], [user_list[1]['auth_user_id']])
+        for user in user_list:
+            assert User.check_u_id_match(user['auth_user_id']).id == user['auth_user_id']
+        assert Channel.check_channel_id_match(channel['channel_id']).id == channel['channel_id']
+        assert DirectMessage.check_dm_id_match(dm['dm_id']).id == dm['dm_id']
+        with pytest.raises(InputError):
+            User.check_u_id_match(100)
+        with pytest.raises(InputError):
+            Channel.check_channel_id_match(100)
+
+    def test_rebuilt_on_load(self, user_list):
+        """The indexes refer to the objects of the reloaded database"""
+        channel = channels_create_v2(user_list[0]['token'], "channel", is_public=True)
+        restart()
+        assert User.check_u_id_match(user_list[1]['auth_user_id']) is data.db['users'][1]
+        assert Channel.check_channel_id_match(channel['channel_id']) is data.db['channels'][0]
+
+    def test_removed_user(self, user_list):
+        """A removed user moves from the users to the removed users"""
+        admin_user_remove_v1(user_list[0]['token'], user_list[1]['auth_user_id'])
+        with pytest.raises(InputError):
+            User.check_u_id_match(user_list[1]['auth_user_id'])
+        assert User.check_u_id_match_in_removed(user_list[1]['auth_user_id']).id == user_list[1]['auth_user_id']
+
+    def test_removed_dm(self, user_list):
+        """A removed dm is no longer found"""
+        dm = dm_create_v1(user_list[0]['token'], [user_list[1]['auth_user_id']])
+        dm_remove_v1(user_list[0]['token'], dm['dm_id'])
+        with pytest.raises(InputError):
+            DirectMessage.check_dm_id_match(dm['dm_id'])
+
+    def test_clear(self, user_list):
+        """Nothing is found after clear"""
+        clear_v1()
+        with pytest.raises(InputError):
+            User.check_u_id_match(user_list[0]['auth_user_id'])
+
+
+@pytest.mark.usefixtures("clear")
+class TestUniquenessIndex:
+    """
+    Test cases for the indexes of the users by email and handle
+    """
+    def test_handle_suffix(self):
+        """Users with the same name get the handle followed by the lowest free number"""
+        handles = list()
+        for i in range(4):
+            user = auth_register_v2(f"pony{i}@qq.com", "PonyMa", "Pony", "Ma")
+            handles.append(User.check_u_id_match(user['auth_user_id']).handle)
+        assert handles == ['ponyma', 'ponyma0', 'ponyma1', 'ponyma2']
+
+    def test_taken_suffix(self):
+        """A handle chosen by another user is skipped"""
+        auth_register_v2("pony0@qq.com", "PonyMa", "Pony", "Ma")
+        user = auth_register_v2("jack@qq.com", "JackMa", "Jack", "Ma")
+        user_profile_sethandle_v1(user['token'], 'ponyma0')
+        user = auth_register_v2("pony1@qq.com", "PonyMa", "Pony", "Ma")
+        assert User.check_u_id_match(user['auth_user_id']).handle == 'ponyma1'
+
+    def test_freed_handle(self, user_list):
+        """The handle and email of a changed or removed user can be taken again"""
+        user_profile_sethandle_v1(user_list[0]['token'], 'newhandle')
+        user_profile_setemail_v2(user_list[0]['token'], 'new@qq.com')
+        admin_user_remove_v1(user_list[0]['token'], user_list[1]['auth_user_id'])
+        User.check_handle_valid('ponyma')
+        User.check_handle_valid('jackma')
+        User.check_email_been_used('pony.ma@qq.com')
+        User.check_email_been_used('jack.ma@qq.com')
+        with pytest.raises(InputError):
+            User.check_handle_valid('newhandle')
+        with pytest.raises(InputError):
+            User.check_email_been_used('new@qq.com')
+
+    def test_freed_suffix(self):
+        """A suffix freed by a handle change is generated again"""
+        users = [auth_register_v2(f"pony{i}@qq.com", "PonyMa", "Pony", "Ma") for i in range(4)]
+        user_profile_sethandle_v1(users[2]['token'], 'somethingelse')
+        user = auth_register_v2("pony4@qq.com", "PonyMa", "Pony", "Ma")
+        assert User.check_u_id_match(user['auth_user_id']).handle == 'ponyma1'
+        user = auth_register_v2("pony5@qq.com", "PonyMa", "Pony", "Ma")
+        assert User.check_u_id_match(user['auth_user_id']).handle == 'ponyma3'
+
+    def test_rebuilt_on_load(self, user_list):
+        """The email and handle indexes are rebuilt after a restart"""
+        restart()
+        with pytest.raises(InputError):
+            User.check_email_been_used('jack.ma@qq.com')
+        with pytest.raises(InputError):
+            User.check_handle_valid('jackma')
+        user = auth_register_v2("pony1@qq.com", "PonyMa", "Pony", "Ma")
+        assert User.check_u_id_match(user['auth_user_id']).handle == 'ponyma0'
+
+
+@pytest.mark.usefixtures("clear")
+class TestSession:
+    """
+    Test cases for the session table of the logged in tokens
+    """
+    def test_session(self, user_list):
+        """Every token has a session of its user until it logs out"""
+        for user in user_list:
+            session = data.db['sessions'][user['token']]
+            assert session['u_id'] == user['auth_user_id']
+            assert User.token_to_id(user['token']) == user['auth_user_id']
+        auth_logout_v1(user_list[0]['token'])
+        assert user_list[0]['token'] not in data.db['sessions']
+        with pytest.raises(AccessError):
+            User.token_to_id(user_list[0]['token'])
+
+    def test_expired(self, user_list):
+        """An expired session is refused"""
+        data.db['sessions'][user_list[0]['token']]['expires'] = 0
+        with pytest.raises(AccessError):
+            User.token_to_id(user_list[0]['token'])
+
+    def test_removed_user(self, user_list):
+        """The sessions of a removed user are revoked"""
+        admin_user_remove_v1(user_list[0]['token'], user_list[1]['auth_user_id'])
+        assert user_list[1]['token'] not in data.db['sessions']
+        assert user_list[0]['token'] in data.db['sessions']
+
+    def test_no_expiry(self, user_list, clock):
+        """Without session_ttl and session_idle_timeout a token does not expire"""
+        clock[0] += 365 * 24 * 60 * 60
+        assert User.token_to_id(user_list[0]['token']) == user_list[0]['auth_user_id']
+        assert data.reap_sessions() == 0
+
+    def test_session_ttl(self, expiry, user_list, clock):
+        """A token expires session_ttl seconds after login, even when it is used"""
+        for _ in range(config.session_ttl // config.session_touch_interval - 1):
+            clock[0] += config.session_touch_interval
+            User.token_to_id(user_list[0]['token'])
+        clock[0] += config.session_touch_interval
+        with pytest.raises(AccessError):
+            User.token_to_id(user_list[0]['token'])
+
+    def test_idle_timeout(self, expiry, user_list, clock):
+        """A token expires when it has not been used for session_idle_timeout seconds"""
+        clock[0] += config.session_idle_timeout - 1
+        User.token_to_id(user_list[0]['token'])
+        clock[0] += 1
+        User.token_to_id(user_list[0]['token'])
+        with pytest.raises(AccessError):
+            User.token_to_id(user_list[1]['token'])
+
+    def test_reap(self, expiry, user_list, clock):
+        """The reaper evicts the expired sessions and keeps the others"""
+        clock[0] += config.session_idle_timeout - 1
+        notifications_get_v1(user_list[0]['token'])
+        clock[0] += 1
+        evicted = data.session_monitor['num_evicted']
+        assert data.reap_sessions() == 1
+        assert list(data.db['sessions']) == [user_list[0]['token']]
+        stats = data.session_stats()
+        assert stats['num_sessions'] == 1
+        assert stats['num_evicted'] == evicted + 1
+        assert stats['eviction_rate'] > 0
+        restart()
+        assert list(data.db['sessions']) == [user_list[0]['token']]
+
+    def test_reaper_thread(self, user_list, monkeypatch):
+        """The background reaper runs reap_sessions until it is stopped"""
+        reaped = threading.Event()
+        monkeypatch.setattr(data, 'reap_sessions', reaped.set)
+        stop = data.start_session_reaper(0.01)
+        assert reaped.wait(5)
+        stop.set()
+
+    def test_migrate_login_token(self, user_list):
+        """The tokens of the login_token list of an old database become sessions"""
+        data.db['login_token'] = list(data.db['sessions'])
+        data.db['sessions'].clear()
+        data.migrate_sessions()
+        assert 'login_token' not in data.db
+        for user in user_list:
+            assert User.token_to_id(user['token']) == user['auth_user_id']
+
+
+@pytest.mark.usefixtures("clear")
+class TestMembershipIndex:
+    """
+    Test cases for the indexes of the channels and dms of every user
+    """
+    def test_channels(self, user_list):
+        """Joined channels are listed in creation order until the user leaves"""
+        ids = [channels_create_v2(user_list[0]['token'], f"channel{i}", is_public=True)['channel_id']
+               for i in range(3)]
+        channel_join_v2(user_list[1]['token'], ids[2])
+        channel_addowner_v1(user_list[0]['token'], ids[0], user_list[1]['auth_user_id'])
+        listed = channels_list_v2(user_list[1]['token'])['channels']
+        assert [channel['channel_id'] for channel in listed] == [ids[0], ids[2]]
+        channel_leave_v1(user_list[1]['token'], ids[0])
+        restart()
+        listed = channels_list_v2(user_list[1]['token'])['channels']
+        assert [channel['channel_id'] for channel in listed] == [ids[2]]
+
+    def test_dms(self, user_list):
+        """Created and invited dms are listed until the user leaves or the dm is removed"""
+        third = auth_register_v2("third@qq.com", "ThirdUser", "Third", "User")
+        first = dm_create_v1(user_list[0]['token'], [user_list[1]['auth_user_id']])['dm_id']
+        second = dm_create_v1(user_list[0]['token'], [])['dm_id']
+        dm_invite_v1(user_list[0]['token'], second, third['auth_user_id'])
+        assert [dm['dm_id'] for dm in dm_list_v1(third['token'])['dms']] == [second]
+        dm_leave_v1(user_list[1]['token'], first)
+        assert dm_list_v1(user_list[1]['token'])['dms'] == []
+        dm_remove_v1(user_list[0]['token'], second)
+        assert dm_list_v1(third['token'])['dms'] == []
+        assert [dm['dm_id'] for dm in dm_list_v1(user_list[0]['token'])['dms']] == [first]
+
+    def test_removed_user(self, user_list):
+        """A removed user leaves all channels and dms"""
+        channel = channels_create_v2(user_list[1]['token'], "channel", is_public=True)['channel_id']
+        channel_join_v2(user_list[0]['token'], channel)
+        dm = dm_create_v1(user_list[0]['token'], [user_list[1]['auth_user_id']])['dm_id']
+        admin_user_remove_v1(user_list[0]['token'], user_list[1]['auth_user_id'])
+        assert user_list[1]['auth_user_id'] not in Channel.check_channel_id_match(channel).member
+        assert [user.id for user in DirectMessage.check_dm_id_match(dm).users] == [user_list[0]['auth_user_id']]
+        assert data.get_memberships('user_channels', user_list[1]['auth_user_id']) == []
+        assert data.get_memberships('user_dms', user_list[1]['auth_user_id']) == []
+
+
+@pytest.mark.usefixtures("clear")
+class TestOrderedSet:
+    """
+    Test cases for the membership containers of the channels and dms
+    """
+    def test_order(self):
+        """Members keep the order they were added in, and are only added once"""
+        members = OrderedSet([3, 1])
+        members.append(2)
+        members.append(3)
+        members.extend([5, 1, 4])
+        assert list(members) == [3, 1, 2, 5, 4]
+        assert len(members) == 5
+        members.remove(1)
+        assert list(members) == [3, 2, 5, 4]
+        assert 1 not in members and 5 in members
+        with pytest.raises(ValueError):
+            members.remove(1)
+
+    def test_channel_details_order(self, user_list):
+        """channel members are reported in join order after leaving and joining again"""
+        channel = channels_create_v2(user_list[0]['token'], "channel", is_public=True)['channel_id']
+        third = auth_register_v2("third@qq.com", "ThirdUser", "Third", "User")
+        channel_join_v2(third['token'], channel)
+        channel_join_v2(user_list[1]['token'], channel)
+        channel_leave_v1(third['token'], channel)
+        channel_join_v2(third['token'], channel)
+        restart()
+        members = Channel.check_channel_id_match(channel).member
+        assert isinstance(members, OrderedSet)
+        assert list(members) == [user_list[0]['auth_user_id'], user_list[1]['auth_user_id'], third['auth_user_id']]
+
+    def test_legacy_lists(self, user_list):
+        """Channels and dms pickled with member lists are loaded with ordered sets"""
+        channel = Channel(user_list[0]['auth_user_id'], "channel", is_public=True)
+        dm = DirectMessage("dm", [data.db['users'][0], data.db['users'][1]], user_list[0]['auth_user_id'])
+        channel.owner, channel.member = list(channel.owner), list(channel.member)
+        dm.users = list(dm.users)
+        channel, dm = pickle.loads(pickle.dumps((channel, dm)))
+        assert isinstance(channel.member, OrderedSet) and isinstance(channel.owner, OrderedSet)
+        assert list(channel.member) == [user_list[0]['auth_user_id']]
+        assert isinstance(dm.users, OrderedSet)
+        assert [user.id for user in dm.users] == [user_list[0]['auth_user_id'], user_list[1]['auth_user_id']]
+
+
+@pytest.mark.usefixtures("clear")
+class TestMessageIndex:
+    """
+    Test cases for the index of the messages by id
+    """
+    def test_positions(self, user_list):
+        """Messages are found in their channel or dm, and later messages move up on removal"""
+        channel = channels_create_v2(user_list[0]['token'], "channel", is_public=True)['channel_id']
+        dm = dm_create_v1(user_list[0]['token'], [user_list[1]['auth_user_id']])['dm_id']
+        ids = [message_send_v2(user_list[0]['token'], channel, f"message {i}")['message_id'] for i in range(4)]
+        dm_message = message_senddm_v1(user_list[1]['token'], dm, "dm message")['message_id']
+        message_remove_v1(user_list[0]['token'], ids[1])
+        assert Message.locate(ids[3]) == (data.get_index('channels')[channel], 2)
+        assert Message.locate(dm_message) == (data.get_index('direct_messages')[dm], 0)
+        message_edit_v2(user_list[0]['token'], ids[3], "edited")
+        assert Message.id_to_message(ids[3]).content == "edited"
+        with pytest.raises(InputError):
+            Message.id_to_message(ids[1])
+
+    def test_built_on_first_use(self, user_list):
+        """After a load the index is only built when a message is looked up, with the positions of its history"""
+        other = channels_create_v2(user_list[0]['token'], "other", is_public=True)['channel_id']
+        other_message = message_send_v2(user_list[0]['token'], other, "other message")['message_id']
+        channel = channels_create_v2(user_list[0]['token'], "channel", is_public=True)['channel_id']
+        ids = [message_send_v2(user_list[0]['token'], channel, f"message {i}")['message_id'] for i in range(3)]
+        restart()
+        assert data.built_index('messages') is None
+        assert data.get_index('positions') == dict()
+        assert Message.id_to_message(ids[2]).content == "message 2"
+        assert data.built_index('messages') == {other_message: ('channels', other),
+                                                **{message_id: ('channels', channel) for message_id in ids}}
+        assert data.get_index('positions') == {('channels', channel): {ids[0]: 0, ids[1]: 1, ids[2]: 2}}
+
+    def test_late_message(self, user_list):
+        """Messages delivered later and standup messages are indexed"""
+        channel = channels_create_v2(user_list[0]['token'], "channel", is_public=True)['channel_id']
+        data.get_index('messages')
+        Channel.check_channel_id_match(channel).message_positions()
+        late_message = Message(user_list[0]['auth_user_id'], "late message")
+        data.save_db()
+        Channel.send_late_message(channel, late_message)
+        Channel.check_channel_id_match(channel).standup_info['message'] = "standup message"
+        Channel.end_standup(channel, user_list[0]['auth_user_id'])
+        assert Message.id_to_message(late_message.id).content == "late message"
+        assert Message.id_to_message(late_message.id + 1).content == "standup message"
+
+    def test_removed_dm(self, user_list):
+        """The messages of a removed dm are no longer found"""
+        dm = dm_create_v1(user_list[0]['token'], [user_list[1]['auth_user_id']])['dm_id']
+        message_id = message_senddm_v1(user_list[1]['token'], dm, "dm message")['message_id']
+        Message.locate(message_id)
+        dm_remove_v1(user_list[0]['token'], dm)
+        assert message_id not in data.get_index('messages')
+        assert ('direct_messages', dm) not in data.get_index('positions')
+        with pytest.raises(InputError):
+            Message.id_to_message(message_id)
+
+
+def recount():
+    """The involvement and utilization rates counted from the whole database"""
+    messages = sum(len(container.messages) for table in ('channels', 'direct_messages')
+                   for container in data.db[table])
+    total = len(data.db['channels']) + len(data.db['direct_messages']) + messages
+    rates = dict()
+    for user in data.db['users']:
+        stats = user.user_stats
+        numerator = (stats['channels_joined'][-1]['num_channels_joined'] + stats['dms_joined'][-1]['num_dms_joined'] +
+                     stats['messages_sent'][-1]['num_messages_sent'])
+        rates[user.id] = numerator / total if total else 0
+    active = [user for user in data.db['users'] if user.is_active()]
+    utilization_rate = len(active) / len(data.db['users']) if data.db['users'] else 0.0
+    return messages, rates, utilization_rate
+
+
+@pytest.mark.usefixtures("clear")
+class TestWorkspaceCounters:
+    """
+    Test cases for the counters the stats are updated from
+    """
+    def test_same_stats(self, user_list):
+        """After every request the stats are those counted from the whole database"""
+        rand = random.Random(0)
+        users = user_list + [auth_register_v2(f"user{i}@qq.com", "password", "User", f"Number{i}") for i in range(3)]
+        channels = [channels_create_v2(users[0]['token'], "channel", is_public=True)['channel_id']]
+        dms = list()
+        messages = list()
+        for _ in range(150):
+            user = rand.choice(users)
+            action = rand.randrange(8)
+            try:
+                if action == 0:
+                    channels.append(channels_create_v2(user['token'], "channel", is_public=True)['channel_id'])
+                elif action == 1:
+                    channel_join_v2(user['token'], rand.choice(channels))
+                elif action == 2:
+                    channel_leave_v1(user['token'], rand.choice(channels))
+                elif action == 3:
+                    dms.append(dm_create_v1(user['token'], [rand.choice(users)['auth_user_id']])['dm_id'])
+                elif action == 4 and dms:
+                    dm = rand.choice(dms)
+                    (dm_remove_v1 if rand.random() < 0.3 else dm_leave_v1)(user['token'], dm)
+                elif action == 5 and dms:
+                    messages.append((user, message_senddm_v1(user['token'], rand.choice(dms), "dm")['message_id']))
+                elif action == 6:
+                    messages.append((user, message_send_v2(user['token'], rand.choice(channels), "hi")['message_id']))
+                elif action == 7 and messages:
+                    owner, message_id = messages.pop(rand.randrange(len(messages)))
+                    message_remove_v1(owner['token'], message_id)
+            except (InputError, AccessError):
+                pass
+            messages_exist, rates, utilization_rate = recount()
+            assert data.get_index('counters')['messages'] == messages_exist
+            assert {user.id: user.involvement_rate() for user in data.db['users']} == rates
+            assert data.get_dream_stats()['utilization_rate'] == utilization_rate
+        admin_user_remove_v1(users[0]['token'], users[4]['auth_user_id'])
+        auth_register_v2("late@qq.com", "password", "Late", "User")
+        _, rates, utilization_rate = recount()
+        assert {user.id: user.involvement_rate() for user in data.db['users']} == rates
+        assert data.get_dream_stats()['utilization_rate'] == utilization_rate
+        restart()
+        assert data.get_index('counters')['messages'] == recount()[0]
+
+    def test_join_without_recount(self, user_list):
+        """Joining a channel only updates the stats of the joining user"""
+        channel = channels_create_v2(user_list[0]['token'], "channel", is_public=True)['channel_id']
+        before = {series: len(stats) for series, stats in data.db['users'][0].user_stats.items()}
+        channel_join_v2(user_list[1]['token'], channel)
+        assert {series: len(stats) for series, stats in data.db['users'][0].user_stats.items()} == before
+        assert 'involvement_rate' not in data.db['users'][1].user_stats
+        assert data.db['users'][1].involvement_rate() == 1
+        assert data.get_dream_stats()['utilization_rate'] == 1
@@ -9,6 +9,7 @@ from src.error import InputError, AccessError
 from src.message import message_send_v2, message_share_v1, message_edit_v2, message_remove_v1, message_senddm_v1
 from src.other import clear_v1
 from src.dm import dm_create_v1, dm_messages_v1
+from src import data
 
 
 @pytest.fixture()
@@ -415,6 +416,15 @@ class TestShare:
         assert message['messages'][0]['message'] == "\n\"\"\"\nmessage1\n\"\"\""
         assert message['messages'][1]['message'] == "message1"
 
+    def test_message_share_stats(self, users, channel_id):
+        """A shared message is counted by the nested send and by the share in the user's and Dreams' stats"""
+        msg = message_send_v2(users[0]["token"], channel_id, "message1")
+        message_share_v1(users[0]["token"], msg["message_id"], '', channel_id, -1)
+        messages_sent = data.db['users'][0].user_stats['messages_sent']
+        assert [entry['num_messages_sent'] for entry in messages_sent] == [0, 1, 2, 3]
+        messages_exist = data.get_dream_stats()['messages_exist']
+        assert [entry['num_messages_exist'] for entry in messages_exist] == [0, 1, 2, 3]
+
 
 def create_dict_list():
     """
@@ -5,10 +5,13 @@ import string
 from src.auth import auth_register_v2, auth_login_v2, auth_logout_v1
 from src.channel import channel_invite_v2
 from src.channels import channels_create_v2
-from src.error import InputError
+from src.error import InputError, AccessError
 from src.message import message_send_v2, message_senddm_v1, message_edit_v2
-from src.other import clear_v1, search_v2, notifications_get_v1
+from src.other import clear_v1, search_v2, notifications_get_v1, sessions_stats_v1, search_stats_v1
 from src.dm import dm_create_v1
+from src.helper import generate_timestamp
+from src import config
+from src import data
 
 
 
@@ -248,3 +251,56 @@ class TestNotification:
         assert len(notifications_get_v1(login_list[1]['token'])['notifications']) == 3
         assert len(notifications_get_v1(login_list[2]['token'])['notifications']) == 2
         assert len(notifications_get_v1(login_list[3]['token'])['notifications']) == 2
+
+
+@pytest.mark.usefixtures("clear")
+class TestSessionStats:
+    """
+    Test cases for the session monitoring counts
+    """
+    def test_num_sessions(self, reg_list, login_list):
+        """Every register and login opens a session, logout closes it"""
+        assert sessions_stats_v1(reg_list[0]['token'])['num_sessions'] == 8
+        auth_logout_v1(login_list[1]['token'])
+        assert sessions_stats_v1(reg_list[0]['token'])['num_sessions'] == 7
+
+    def test_num_evicted(self, reg_list, login_list, monkeypatch):
+        """The sessions expired by the idle timeout are counted once the reaper evicts them"""
+        monkeypatch.setattr(config, 'session_idle_timeout', 60 * 60)
+        now = [generate_timestamp() + config.session_idle_timeout - 1]
+        monkeypatch.setattr(data, 'generate_timestamp', lambda: now[0])
+        before = sessions_stats_v1(reg_list[0]['token'])
+        now[0] += 1
+        assert data.reap_sessions() == 7
+        stats = sessions_stats_v1(reg_list[0]['token'])
+        assert stats['num_sessions'] == 1
+        assert stats['num_evicted'] == before['num_evicted'] + 7
+        assert stats['eviction_rate'] > 0
+
+    def test_not_owner(self, reg_list):
+        """Only a Dreams owner can read the counts"""
+        with pytest.raises(AccessError):
+            sessions_stats_v1(reg_list[1]['token'])
+
+
+@pytest.mark.usefixtures("clear")
+class TestSearchStats:
+    """
+    Test cases for the search cache counts
+    """
+    def test_hits(self, channel_list, login_list):
+        """A repeated search is a hit, a new search is a miss"""
+        token = login_list[0]['token']
+        before = search_stats_v1(token)
+        search_v2(token, "pony's channel")
+        search_v2(token, "pony's channel")
+        stats = search_stats_v1(token)
+        assert stats['misses'] == before['misses'] + 1
+        assert stats['hits'] == before['hits'] + 1
+        assert stats['num_entries'] >= 1
+        assert 0 < stats['hit_rate'] <= 1
+
+    def test_not_owner(self, reg_list):
+        """Only a Dreams owner can read the counts"""
+        with pytest.raises(AccessError):
+            search_stats_v1(reg_list[1]['token'])
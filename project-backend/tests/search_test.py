@@ -0,0 +1,445 @@
+import itertools
+import random
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from src import config
+from src import data
+from src import search
+from src import storage
+from src.auth import auth_register_v2
+from src.admin import admin_user_remove_v1
+from src.channel import channel_join_v2, channel_leave_v1
+from src.channels import channels_create_v2
+from src.dm import dm_create_v1
+from src.message import message_send_v2, message_senddm_v1, message_edit_v2, message_remove_v1
+from src.other import clear_v1, search_v2
+from src.error import InputError, AccessError
+from src.search import (TermIndex, TrigramIndex, TimeIndex, ResultCache, compile_query, complete_words,
+                        encode_cursor, parallel_match)
+
+
+WORDS = ['hello', 'world', 'Hello', 'pony', 'ma', 'dreams', 'channel', 'dm', 'foo_bar', 'café']
+
+QUERIES = ['hello world', ' world ', 'hello', 'ello wor', 'Hello world', ' ma ', 'o w', 'café pony',
+           ' foo_bar ', 'h.llo', 'world$', '^pony', ' pony dm ', 'missing words here', '']
+
+
+@pytest.fixture()
+def clear():
+    clear_v1()
+
+
+@pytest.fixture(name='workspace')
+def create_workspace():
+    """
+    Fixture function, register three users, create two channels and a dm and send random
+    messages to them
+
+    Returns:
+        Dictionary, the registered users, and the ids of the sent messages
+
+    """
+    users = [auth_register_v2(f"user{i}@qq.com", "password", "User", f"Number{i}") for i in range(3)]
+    public = channels_create_v2(users[0]['token'], "public", is_public=True)['channel_id']
+    private = channels_create_v2(users[1]['token'], "private", is_public=False)['channel_id']
+    channel_join_v2(users[2]['token'], public)
+    dm = dm_create_v1(users[0]['token'], [users[1]['auth_user_id']])['dm_id']
+    rand = random.Random(0)
+    message_ids = list()
+    for _ in range(120):
+        content = ' '.join(rand.choice(WORDS) for _ in range(rand.randint(1, 6)))
+        target = rand.randrange(3)
+        if target == 0:
+            message_ids.append(message_send_v2(users[rand.choice((0, 2))]['token'], public, content)['message_id'])
+        elif target == 1:
+            message_ids.append(message_send_v2(users[1]['token'], private, content)['message_id'])
+        else:
+            message_ids.append(message_senddm_v1(users[rand.randrange(2)]['token'], dm, content)['message_id'])
+    return {'users': users, 'message_ids': message_ids}
+
+
+def scan(u_id, query_str):
+    """The ids of the matched messages, found by scanning every history like search_v2 used to"""
+    pattern = query_str.encode('unicode_escape').decode()
+    matched = list()
+    for channel in data.db['channels']:
+        if u_id in channel.member:
+            matched += [message.id for message in channel.messages if re.search(pattern, message.content)]
+    for dm in data.db['direct_messages']:
+        if u_id in [user.id for user in dm.users]:
+            matched += [message.id for message in dm.messages if re.search(pattern, message.content)]
+    return matched
+
+
+def filtered(u_id, query_str, filters):
+    """The ids of the matched messages which pass the filters, found by a scan"""
+    located = {message.id: (conversation, message) for table in ('channels', 'direct_messages')
+               for conversation in data.db[table] for message in conversation.messages}
+    searched_conversations = {('channels', filters.get('channel_id')), ('direct_messages', filters.get('dm_id'))}
+    matched = list()
+    for message_id in scan(u_id, query_str):
+        conversation, message = located[message_id]
+        if filters.get('u_id') is not None and message.owner_id != filters['u_id']:
+            continue
+        if filters.get('channel_id') is not None or filters.get('dm_id') is not None:
+            if (conversation.TABLE, conversation.id) not in searched_conversations:
+                continue
+        if filters.get('since') is not None and message.time < filters['since']:
+            continue
+        if filters.get('until') is not None and message.time > filters['until']:
+            continue
+        matched.append(message_id)
+    return matched
+
+
+def searched(token, query_str, **filters):
+    return [message['message_id'] for message in search_v2(token, query_str, **filters)['messages']]
+
+
+def paged(token, query_str, limit):
+    """The ids of the matched messages, collected page by page"""
+    matched = list()
+    cursor = None
+    while True:
+        page = search_v2(token, query_str, limit=limit, cursor=cursor)
+        assert len(page['messages']) <= limit
+        matched += [message['message_id'] for message in page['messages']]
+        cursor = page['cursor']
+        if cursor is None:
+            return matched
+
+
+class TestTermIndex:
+    """
+    Test cases for the inverted index of the words of the messages
+    """
+    def test_complete_words(self):
+        """Only the words enclosed by other characters of the query are complete"""
+        assert complete_words('hello world') == set()
+        assert complete_words('say hello world') == {'hello'}
+        assert complete_words(' Hello-world ') == {'hello', 'world'}
+
+    def test_candidates(self):
+        """The candidates are the messages holding every complete word"""
+        index = TermIndex()
+        index.add(1, 'hello big world')
+        index.add(2, 'Hello big World')
+        index.add(3, 'big')
+        assert index.candidates('hello big world') == {1, 2, 3}
+        assert index.candidates('o big w') == {1, 2, 3}
+        assert index.candidates(' hello big ') == {1, 2}
+        index.remove(1, 'hello big world')
+        assert index.candidates(' hello big ') == {2}
+        assert index.candidates(' missing ') == set()
+
+    def test_not_narrowed(self):
+        """Patterns with metacharacters and queries without complete words scan the histories"""
+        index = TermIndex()
+        index.add(1, 'hello world')
+        assert index.candidates('hello world') is None
+        assert index.candidates(' hello.world ') is None
+        assert index.candidates(' (hello) ') is None
+
+
+class TestTrigramIndex:
+    """
+    Test cases for the index of the three character substrings of the messages
+    """
+    def test_candidates(self):
+        """The candidates contain every trigram of the query"""
+        index = TrigramIndex()
+        index.add(1, 'hello world')
+        index.add(2, 'hello there')
+        index.add(3, 'Hello world')
+        assert index.candidates('ello wor') == {1, 3}
+        assert index.candidates('llo') == {1, 2, 3}
+        assert index.candidates('Hel') == {3}
+        index.remove(1, 'hello world')
+        assert index.candidates('ello wor') == {3}
+
+    def test_not_narrowed(self):
+        """Queries shorter than a trigram and patterns with metacharacters are not narrowed"""
+        index = TrigramIndex()
+        index.add(1, 'hello world')
+        assert index.candidates('he') is None
+        assert index.candidates('hel+o') is None
+
+
+class TestCompileQuery:
+    """
+    Test cases for the matchers the queries are compiled into
+    """
+    def test_same_matches(self):
+        """The matcher agrees with the regular expression of the query on every message"""
+        contents = ['hello world', 'Hello World', 'café pony', 'tab\there', 'a.b', '', 'x\\y']
+        for query in QUERIES + ['tab\there', 'HELLO', 'é', 'x\\\\y']:
+            pattern = query.encode('unicode_escape').decode()
+            for content in contents:
+                assert bool(compile_query(query)(content)) == bool(re.search(pattern, content))
+
+    def test_shared(self):
+        """A query is compiled once and reused by the following requests"""
+        compile_query.cache_clear()
+        for _ in range(3):
+            compile_query('hello')
+            compile_query('h.llo')
+        assert compile_query.cache_info().misses == 2
+        assert compile_query.cache_info().hits == 4
+
+    def test_invalid(self):
+        """Invalid regular expressions are not cached"""
+        for _ in range(2):
+            with pytest.raises(re.error):
+                compile_query('(hello')
+        assert compile_query('(hello)')('hello')
+
+    def test_parallel_match(self):
+        """The matches of the chunks are merged back in the order of the messages"""
+        contents = [f'message {i}' for i in range(100)]
+        assert parallel_match('7', contents, 2) == [i for i in range(100) if '7' in str(i)]
+        assert parallel_match('^message 9$', contents[:10], 3) == [9]
+        assert parallel_match('x', [], 2) == []
+        with pytest.raises(re.error):
+            parallel_match('(', contents, 2)
+
+
+class TestTimeIndex:
+    """
+    Test cases for the index of the messages by time
+    """
+    def test_between(self):
+        """The messages of a time range are found, both bounds included"""
+        index = TimeIndex()
+        for message_id, time in [(1, 100), (2, 100), (3, 105), (4, 110), (5, 103)]:
+            index.add(message_id, time)
+        assert index.between(100, 105) == {1, 2, 3, 5}
+        assert index.between(101, None) == {3, 4, 5}
+        assert index.between(None, 100) == {1, 2}
+        assert index.between(111, None) == set()
+        index.remove(2, 100)
+        index.remove(4, 999)
+        assert index.between() == {1, 3, 4, 5}
+
+
+class TestResultCache:
+    """
+    Test cases for the cache of the search results
+    """
+    def test_tag(self):
+        """An entry is only used with the tag it was stored with"""
+        cache = ResultCache(4)
+        assert cache.get((1, 'hello'), (('channels', 1, 0),)) is None
+        cache.put((1, 'hello'), (('channels', 1, 0),), [3, 5])
+        assert cache.get((1, 'hello'), (('channels', 1, 0),)) == [3, 5]
+        assert cache.get((1, 'hello'), (('channels', 1, 1),)) is None
+        assert cache.get((2, 'hello'), (('channels', 1, 0),)) is None
+        assert cache.stats() == {'num_entries': 1, 'hits': 1, 'misses': 3, 'hit_rate': 0.25}
+
+    def test_least_recently_used(self):
+        """The least recently used entry is dropped when the cache is full"""
+        cache = ResultCache(2)
+        cache.put((1, 'a'), (), [1])
+        cache.put((1, 'b'), (), [2])
+        cache.get((1, 'a'), ())
+        cache.put((1, 'c'), (), [3])
+        assert cache.get((1, 'b'), ()) is None
+        assert cache.get((1, 'a'), ()) == [1]
+        assert cache.get((1, 'c'), ()) == [3]
+
+
+@pytest.mark.usefixtures("clear")
+class TestSearch:
+    """
+    Test cases for search_v2 served by the indexes
+    """
+    def test_same_results(self, workspace):
+        """Every user gets the messages a scan of their channels and dms finds, in the same order"""
+        for user in workspace['users']:
+            for query in QUERIES:
+                assert searched(user['token'], query) == scan(user['auth_user_id'], query)
+
+    def test_edit_and_remove(self, workspace):
+        """Edited and removed messages are searched by their new content"""
+        users = workspace['users']
+        rand = random.Random(1)
+        for message_id in rand.sample(workspace['message_ids'], 30):
+            owner = data.Message.id_to_message(message_id).owner_id
+            token = next(user['token'] for user in users if user['auth_user_id'] == owner)
+            if rand.random() < 0.5:
+                message_edit_v2(token, message_id, 'edited ' + rand.choice(WORDS) + ' message')
+            else:
+                message_remove_v1(token, message_id)
+        for user in users:
+            for query in QUERIES + [' edited ', 'edited hello message']:
+                assert searched(user['token'], query) == scan(user['auth_user_id'], query)
+
+    def test_reloaded(self, workspace):
+        """The indexes are built again for a reloaded database"""
+        data.db = None
+        storage.engines.clear()
+        data.load_db()
+        user = workspace['users'][0]
+        assert searched(user['token'], ' hello ') == scan(user['auth_user_id'], ' hello ')
+
+    def test_pages(self, workspace):
+        """The pages hold every match once, newest first"""
+        for user in workspace['users']:
+            for query in QUERIES:
+                expected = sorted(scan(user['auth_user_id'], query), reverse=True)
+                assert paged(user['token'], query, 7) == expected
+                assert paged(user['token'], query, 1000) == expected
+
+    def test_page_stops_early(self, workspace):
+        """A page of a query the indexes cannot narrow only reads the newest messages of each history"""
+        read = list()
+
+        class History(list):
+            def __iter__(self):
+                for message in super().__iter__():
+                    read.append(message.id)
+                    yield message
+
+            def __reversed__(self):
+                for message in super().__reversed__():
+                    read.append(message.id)
+                    yield message
+
+        conversations = [SimpleNamespace(messages=History(conversation.messages))
+                         for table in ('channels', 'direct_messages') for conversation in data.db[table]]
+        expected = sorted(message.id for conversation in conversations for message in conversation.messages)
+        read.clear()
+        page = itertools.islice(data.Message.match_messages(conversations, '.*', newest_first=True), 5)
+        assert [message.id for message in page] == expected[:-6:-1]
+        assert len(read) <= 5 + len(conversations)
+        read.clear()
+        page = itertools.islice(data.Message.match_messages(conversations, '.*', newest_first=True,
+                                                            before=expected[-5]), 5)
+        assert [message.id for message in page] == expected[-6:-11:-1]
+        assert len(read) < len(expected)
+
+    def test_stable_cursor(self, workspace):
+        """Messages sent or removed between two pages do not shift the next page"""
+        user = workspace['users'][0]
+        expected = sorted(scan(user['auth_user_id'], ' hello '), reverse=True)
+        first = search_v2(user['token'], ' hello ', limit=5)
+        channel = data.db['channels'][0].id
+        message_send_v2(user['token'], channel, 'new hello message')
+        message_remove_v1(user['token'], expected[5])
+        second = search_v2(user['token'], ' hello ', limit=5, cursor=first['cursor'])
+        assert [message['message_id'] for message in second['messages']] == expected[6:11]
+
+    def test_default_limit(self, workspace):
+        """A cursor without a limit returns a page of the default size"""
+        user = workspace['users'][0]
+        cursor = encode_cursor(workspace['message_ids'][-1] + 1)
+        page = search_v2(user['token'], '', cursor=cursor)
+        assert len(page['messages']) == config.search_default_limit
+
+    def test_invalid_page(self, workspace):
+        """Limits out of range and cursors not made by search are refused"""
+        token = workspace['users'][0]['token']
+        for limit in (0, -1, config.search_max_limit + 1, 'ten'):
+            with pytest.raises(InputError):
+                search_v2(token, 'hello', limit=limit)
+        for cursor in ('garbage', encode_cursor(1)[:-2], 'YWZ0ZXI6MTA='):
+            with pytest.raises(InputError):
+                search_v2(token, 'hello', cursor=cursor)
+
+    def test_parallel(self, workspace, monkeypatch):
+        """The searches split across processes find the messages a scan finds, in the same order"""
+        monkeypatch.setattr(config, 'search_workers', 2)
+        monkeypatch.setattr(config, 'search_parallel_threshold', 1)
+        monkeypatch.setattr(search, 'usable_cores', lambda: 2)
+        matched = list()
+        parallel_match = search.parallel_match
+        monkeypatch.setattr(search, 'parallel_match',
+                            lambda *args: matched.append(args[2]) or parallel_match(*args))
+        for user in workspace['users']:
+            for query in ['h.llo', 'world$', '^pony', '(dm|ma) ', '']:
+                assert searched(user['token'], query) == scan(user['auth_user_id'], query)
+                expected = sorted(scan(user['auth_user_id'], query), reverse=True)
+                assert paged(user['token'], query, 7) == expected
+        assert set(matched) == {2}
+
+    def test_single_core(self, workspace, monkeypatch):
+        """On a single core the search is never split, whatever the number of workers"""
+        monkeypatch.setattr(config, 'search_parallel_threshold', 1)
+        monkeypatch.setattr(search, 'usable_cores', lambda: 1)
+        monkeypatch.setattr(search, 'parallel_match', None)
+        user = workspace['users'][0]
+        for workers in (None, 2, 8):
+            monkeypatch.setattr(config, 'search_workers', workers)
+            assert searched(user['token'], 'h.llo') == scan(user['auth_user_id'], 'h.llo')
+
+    def test_cached(self, workspace):
+        """A repeated search is answered by the cache until a visible conversation changes"""
+        users = workspace['users']
+        public, private = [channel.id for channel in data.db['channels']]
+        dm = data.db['direct_messages'][0].id
+        searched(users[2]['token'], ' hello ')
+        hits = data.search_stats()['hits']
+        assert searched(users[2]['token'], ' hello ') == scan(users[2]['auth_user_id'], ' hello ')
+        assert data.search_stats()['hits'] == hits + 1
+        # the private channel and the dm are not visible to the user
+        message_send_v2(users[1]['token'], private, 'private hello message')
+        message_senddm_v1(users[0]['token'], dm, 'dm hello message')
+        assert searched(users[2]['token'], ' hello ') == scan(users[2]['auth_user_id'], ' hello ')
+        assert data.search_stats()['hits'] == hits + 2
+        for change in (lambda: message_send_v2(users[0]['token'], public, 'new hello message'),
+                       lambda: message_edit_v2(users[0]['token'], scan(users[2]['auth_user_id'], ' hello ')[0],
+                                               'edited'),
+                       lambda: message_remove_v1(users[0]['token'], scan(users[2]['auth_user_id'], ' hello ')[-1]),
+                       lambda: channel_leave_v1(users[2]['token'], public),
+                       lambda: channel_join_v2(users[2]['token'], public)):
+            change()
+            assert searched(users[2]['token'], ' hello ') == scan(users[2]['auth_user_id'], ' hello ')
+            assert data.search_stats()['hits'] == hits + 2
+        assert paged(users[2]['token'], ' hello ', 4) == sorted(scan(users[2]['auth_user_id'], ' hello '),
+                                                                reverse=True)
+
+    def test_removed_user(self, workspace):
+        """The messages of a removed user are searched by their new content"""
+        users = workspace['users']
+        searched(users[0]['token'], 'Removed user')
+        admin_user_remove_v1(users[0]['token'], users[2]['auth_user_id'])
+        for query in ('Removed user', ' Removed ', 'hello'):
+            assert searched(users[0]['token'], query) == scan(users[0]['auth_user_id'], query)
+
+
+    def test_filters(self, workspace, monkeypatch):
+        """The filters narrow the search down to the messages a scan finds among the filtered ones"""
+        users = workspace['users']
+        public = data.db['channels'][0].id
+        dm = data.db['direct_messages'][0].id
+        clock = itertools.count(1000)
+        monkeypatch.setattr(data, 'generate_timestamp', lambda: next(clock))
+        for i in range(30):
+            if i % 2:
+                message_send_v2(users[2 if i % 3 else 0]['token'], public, f'timed hello {i}')
+            else:
+                message_senddm_v1(users[1 if i % 4 else 0]['token'], dm, f'timed hello {i}')
+        user = users[0]
+        for filters in ({'u_id': users[1]['auth_user_id']}, {'channel_id': public}, {'dm_id': dm},
+                        {'channel_id': public, 'dm_id': dm}, {'since': 1010, 'until': 1020}, {'until': 1004},
+                        {'u_id': users[2]['auth_user_id'], 'since': 1005}, {'since': '1025', 'dm_id': str(dm)}):
+            expected_filters = {name: int(value) for name, value in filters.items()}
+            for query in ['hello', ' hello ', 'timed', 'h.llo', '']:
+                expected = filtered(user['auth_user_id'], query, expected_filters)
+                assert searched(user['token'], query, **filters) == expected
+                page = search_v2(user['token'], query, limit=1000, **filters)
+                assert [message['message_id'] for message in page['messages']] == sorted(expected, reverse=True)
+
+    def test_invalid_filters(self, workspace):
+        """Filters which are not integers, unknown conversations and conversations of others are refused"""
+        users = workspace['users']
+        private = data.db['channels'][1].id
+        dm = data.db['direct_messages'][0].id
+        for filters in ({'u_id': 'ten'}, {'since': '1.5'}, {'channel_id': 99}, {'dm_id': 99}):
+            with pytest.raises(InputError):
+                search_v2(users[2]['token'], 'hello', **filters)
+        for filters in ({'channel_id': private}, {'dm_id': dm}):
+            with pytest.raises(AccessError):
+                search_v2(users[2]['token'], 'hello', **filters)
@@ -0,0 +1,654 @@
+import multiprocessing
+import os
+import pickle
+import pytest
+import sqlite3
+import threading
+import time
+
+from src import config
+from src import data
+from src import snapshot
+from src import storage
+from src.admin import admin_user_remove_v1
+from src.auth import auth_register_v2, auth_login_v2, auth_logout_v1
+from src.channel import channel_messages_v2, channel_details_v2
+from src.channels import channels_create_v2, channels_list_v2, channels_listall_v2
+from src.dm import dm_create_v1, dm_list_v1
+from src.message import message_send_v2, message_senddm_v1, message_edit_v2, message_remove_v1, \
+    message_share_v1
+from src.other import clear_v1, search_v2, notifications_get_v1
+from src.user import users_all_v1
+
+
+@pytest.fixture()
+def clear(tmp_path, monkeypatch):
+    """Keep the database files of these tests away from the working directory"""
+    monkeypatch.chdir(tmp_path)
+    clear_v1()
+
+
+def restart():
+    """Simulate a restart of the server, the database only exists on the disk"""
+    data.db = None
+    storage.engines.clear()
+    data.load_db()
+
+
+def file_state():
+    """The size and modification time of the database files"""
+    state = list()
+    for path in (config.db_file, config.wal_file, config.sqlite_file):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            state.append((path, stat.st_size, stat.st_mtime_ns))
+    return state
+
+
+def plain(value):
+    """Convert the objects in a value to dicts, so two databases can be compared"""
+    if isinstance(value, (list, tuple, data.OrderedSet)):
+        return [plain(item) for item in value]
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if hasattr(value, '__dict__'):
+        return type(value).__name__, plain(vars(value))
+    return value
+
+
+@pytest.fixture()
+def sharded_engine(monkeypatch):
+    monkeypatch.setattr(config, 'storage_engine', 'sharded')
+
+
+@pytest.fixture(name='channel')
+def create_channel():
+    """
+    Fixture function, register a user and create a channel for further tests
+
+    Returns:
+        channel: Dict, contain the user's token and the channel's id
+
+    """
+    user = auth_register_v2("pony.ma@qq.com", "PonyMa", "Pony", "Ma")
+    channel = channels_create_v2(user['token'], "pony's channel", is_public=True)
+    return {'token': user['token'], 'channel_id': channel['channel_id']}
+
+
+@pytest.fixture()
+def pickle_engine(monkeypatch):
+    monkeypatch.setattr(config, 'storage_engine', 'pickle')
+
+
+@pytest.fixture()
+def sqlite_engine(monkeypatch):
+    monkeypatch.setattr(config, 'storage_engine', 'sqlite')
+
+
+@pytest.mark.usefixtures("pickle_engine", "clear")
+class TestWriteAheadLog:
+    """
+    Test cases for the write-ahead log of the database
+    """
+    def test_send_append_to_log(self, channel):
+        """Sending a message only appends to the log, the snapshot is not rewritten"""
+        snapshot_size = os.path.getsize(config.db_file)
+        log_size = os.path.getsize(config.wal_file)
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        assert os.path.getsize(config.db_file) == snapshot_size
+        assert os.path.getsize(config.wal_file) > log_size
+
+    def test_recover_from_log(self, channel):
+        """Reloading replays the log on top of the snapshot"""
+        id1 = message_send_v2(channel['token'], channel['channel_id'], "first")['message_id']
+        id2 = message_send_v2(channel['token'], channel['channel_id'], "second")['message_id']
+        message_edit_v2(channel['token'], id1, "first edited")
+        message_remove_v1(channel['token'], id2)
+        restart()
+        messages = channel_messages_v2(channel['token'], channel['channel_id'], 0)['messages']
+        assert [message['message'] for message in messages] == ["first edited"]
+        assert data.db['dreams_stats']['messages_exist'][-1]['num_messages_exist'] == 1
+
+    @pytest.mark.parametrize('background', [True, False])
+    def test_checkpoint(self, channel, monkeypatch, background):
+        """The snapshot is rebuilt and the log emptied once the interval is reached"""
+        monkeypatch.setattr(config, 'background_snapshot', background)
+        engine = storage.get_engine()
+        monkeypatch.setattr(config, 'checkpoint_interval', engine.wal_entries + 4)
+        for i in range(3):
+            message_send_v2(channel['token'], channel['channel_id'], f"message {i}")
+        assert os.path.exists(config.wal_file)
+        message_send_v2(channel['token'], channel['channel_id'], "checkpoint")
+        assert not os.path.exists(config.wal_file)
+        engine.reap(wait=True)
+        assert not os.path.exists(engine.rotated_wal_file())
+        messages = channel_messages_v2(channel['token'], channel['channel_id'], 0)['messages']
+        assert len(messages) == 4
+        with open(config.db_file, 'rb') as f:
+            assert len(snapshot.load(f)['channels'][0].messages) == 4
+
+    def test_background_not_reloaded(self, channel, monkeypatch):
+        """The snapshot written by the child is not taken for a change of another writer"""
+        engine = storage.get_engine()
+        monkeypatch.setattr(config, 'checkpoint_interval', engine.wal_entries + 1)
+        message_send_v2(channel['token'], channel['channel_id'], "checkpoint")
+        engine.reap(wait=True)
+        resident_db = data.db
+        channels_listall_v2(channel['token'])
+        assert data.db is resident_db
+
+    def test_running_child_not_reloaded(self, channel, monkeypatch):
+        """The snapshot replaced by a child which has not exited yet is not reloaded either"""
+        engine = storage.get_engine()
+        monkeypatch.setattr(config, 'checkpoint_interval', engine.wal_entries + 1)
+        parent = os.getpid()
+        write_atomic = storage.write_atomic
+
+        def slow_exit(path, dump, obj):
+            write_atomic(path, dump, obj)
+            if os.getpid() != parent:
+                time.sleep(1)
+
+        monkeypatch.setattr(storage, 'write_atomic', slow_exit)
+        before = os.stat(config.db_file).st_mtime_ns
+        message_send_v2(channel['token'], channel['channel_id'], "checkpoint")
+        deadline = time.time() + 5
+        while os.stat(config.db_file).st_mtime_ns == before and time.time() < deadline:
+            time.sleep(0.01)
+        assert engine.child is not None
+        resident_db = data.db
+        channels_listall_v2(channel['token'])
+        assert data.db is resident_db
+        engine.reap(wait=True)
+
+    def test_recover_during_checkpoint(self, channel, monkeypatch):
+        """The rotated log is replayed while the child has not replaced the snapshot yet"""
+        engine = storage.get_engine()
+        monkeypatch.setattr(config, 'checkpoint_interval', engine.wal_entries + 1)
+
+        def fail(path, dump, obj):
+            raise OSError
+
+        monkeypatch.setattr(storage, 'write_atomic', fail)
+        message_send_v2(channel['token'], channel['channel_id'], "rotated")
+        engine.reap(wait=True)
+        assert os.path.exists(engine.rotated_wal_file())
+        message_send_v2(channel['token'], channel['channel_id'], "appended")
+        restart()
+        messages = channel_messages_v2(channel['token'], channel['channel_id'], 0)['messages']
+        assert [message['message'] for message in messages] == ["appended", "rotated"]
+
+    def test_clear_during_checkpoint(self, channel, monkeypatch):
+        """A forced snapshot does not wait for a running checkpoint, which drops its older snapshot"""
+        engine = storage.get_engine()
+        monkeypatch.setattr(config, 'checkpoint_interval', engine.wal_entries + 1)
+        parent = os.getpid()
+        dump = snapshot.dump
+
+        def slow_dump(db, f):
+            if os.getpid() != parent:
+                time.sleep(1)
+            dump(db, f)
+
+        monkeypatch.setattr(snapshot, 'dump', slow_dump)
+        message_send_v2(channel['token'], channel['channel_id'], "checkpoint")
+        assert engine.child is not None
+        cleared = threading.Thread(target=clear_v1, daemon=True)
+        cleared.start()
+        cleared.join(timeout=10)
+        assert not cleared.is_alive()
+        engine.reap(wait=True)
+        restart()
+        assert data.db['users'] == []
+        assert data.db['channels'] == []
+
+    def test_crash_during_snapshot(self, channel, monkeypatch):
+        """A snapshot interrupted by a crash leaves the previous snapshot in place"""
+        with open(config.db_file, 'rb') as f:
+            before = f.read()
+
+        def crash(db, f):
+            f.write(b'partial')
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(snapshot, 'dump', crash)
+        with pytest.raises(KeyboardInterrupt):
+            data.save_db(checkpoint=True)
+        with open(config.db_file, 'rb') as f:
+            assert f.read() == before
+        assert not [name for name in os.listdir('.') if name.endswith('.tmp')]
+
+    def test_truncated_snapshot(self, channel, monkeypatch):
+        """A damaged snapshot is an error, not an empty database"""
+        with open(config.db_file, 'rb+') as f:
+            f.truncate(os.path.getsize(config.db_file) // 2)
+        monkeypatch.setattr(data, 'db', None)
+        monkeypatch.setattr(storage, 'engines', dict())
+        with pytest.raises(EOFError):
+            data.load_db()
+
+    def test_torn_tail(self, channel):
+        """An entry cut off by a crash is dropped without losing the entries before it"""
+        message_send_v2(channel['token'], channel['channel_id'], "before crash")
+        with open(config.wal_file, 'ab') as f:
+            f.write(b'\x80\x04\x95')
+        message_send_v2(channel['token'], channel['channel_id'], "after crash")
+        messages = channel_messages_v2(channel['token'], channel['channel_id'], 0)['messages']
+        assert [message['message'] for message in messages] == ["after crash", "before crash"]
+
+
+@pytest.mark.usefixtures("pickle_engine", "clear")
+class TestSnapshot:
+    """
+    Test cases for the binary snapshot format
+    """
+    def test_round_trip(self, channel, tmp_path):
+        """Every object is read back equal, the users of a dm are shared with db['users']"""
+        other = auth_register_v2("jack.ma@qq.com", "JackMa", "Jack", "Ma")
+        dm = dm_create_v1(channel['token'], [other['auth_user_id']])
+        message_send_v2(channel['token'], channel['channel_id'], "hello @jackma")
+        message_senddm_v1(channel['token'], dm['dm_id'], "hi")
+        data.db['channels'][0].messages[0].react_infos[0]['u_ids'].append(other['auth_user_id'])
+        path = tmp_path / 'snapshot'
+        with open(path, 'wb') as f:
+            snapshot.dump(data.db, f)
+        with open(path, 'rb') as f:
+            loaded = snapshot.load(f)
+        assert plain(loaded) == plain(data.db)
+        assert all(user in loaded['users'] for user in loaded['direct_messages'][0].users)
+        assert loaded['direct_messages'][0].id == dm['dm_id']
+
+    def test_smaller_than_pickle(self, channel):
+        """The snapshot of many messages is smaller than their pickle"""
+        for i in range(200):
+            message_send_v2(channel['token'], channel['channel_id'], f"message {i}")
+        data.save_db(checkpoint=True)
+        assert os.path.getsize(config.db_file) < len(pickle.dumps(data.db)) / 2
+
+    def test_load_legacy_pickle(self, channel):
+        """A database.p written as a plain pickle is still loaded"""
+        with open(config.db_file, 'wb') as f:
+            pickle.dump(data.db, f)
+        restart()
+        assert channels_listall_v2(channel['token'])['channels'][0]['name'] == "pony's channel"
+
+    def test_unsupported_version(self, tmp_path):
+        """A snapshot of another version is refused"""
+        path = tmp_path / 'snapshot'
+        path.write_bytes(snapshot.MAGIC + bytes([snapshot.VERSION + 1]))
+        with open(path, 'rb') as f:
+            with pytest.raises(ValueError):
+                snapshot.load(f)
+
+
+@pytest.mark.usefixtures("pickle_engine", "clear")
+class TestDirtyTracking:
+    """
+    Test cases for skipping the save when nothing has been modified
+    """
+    @pytest.mark.parametrize('wal_enabled', [True, False])
+    def test_read_only_not_saved(self, channel, monkeypatch, wal_enabled):
+        """Read only endpoints do not write the database"""
+        monkeypatch.setattr(config, 'wal_enabled', wal_enabled)
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        before = file_state()
+        channels_listall_v2(channel['token'])
+        channels_list_v2(channel['token'])
+        channel_details_v2(channel['token'], channel['channel_id'])
+        channel_messages_v2(channel['token'], channel['channel_id'], 0)
+        dm_list_v1(channel['token'])
+        users_all_v1(channel['token'])
+        search_v2(channel['token'], "hello")
+        notifications_get_v1(channel['token'])
+        assert file_state() == before
+
+    def test_write_saved(self, channel):
+        """A modification marks the database dirty until it is saved"""
+        data.load_db()
+        assert not data.is_dirty()
+        data.set_dream_stats()
+        assert data.is_dirty()
+        data.save_db()
+        assert not data.is_dirty()
+
+
+@pytest.mark.usefixtures("pickle_engine", "clear")
+class TestResident:
+    """
+    Test cases for keeping the database in memory between requests
+    """
+    def test_not_reloaded(self, channel):
+        """The database is not unpickled again when no one else wrote it"""
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        resident_db = data.db
+        channels_listall_v2(channel['token'])
+        assert data.db is resident_db
+
+    def test_reload_other_writer(self, channel):
+        """The database is reloaded after another process changed the files"""
+        data.save_db(checkpoint=True)
+        with open(config.db_file, 'rb') as f:
+            other_db = snapshot.load(f)
+        other_db['channels'][0].name = "renamed"
+        with open(config.db_file, 'wb') as f:
+            snapshot.dump(other_db, f)
+        channels = channels_listall_v2(channel['token'])['channels']
+        assert channels[0]['name'] == "renamed"
+
+    def test_reload_failed_request(self, channel):
+        """Changes left unsaved by a failed request are discarded"""
+        data.db['channels'][0].name = "unsaved"
+        data.mark_dirty('channels', channel['channel_id'])
+        channels = channels_listall_v2(channel['token'])['channels']
+        assert channels[0]['name'] == "pony's channel"
+
+    def test_nested_not_reloaded(self, channel):
+        """A request called by another one keeps the changes its caller has not saved yet"""
+        with storage.lock:
+            data.load_db()
+            resident_db = data.db
+            data.db['channels'][0].name = "unsaved"
+            data.mark_dirty('channels', channel['channel_id'])
+            message_send_v2(channel['token'], channel['channel_id'], "hello")
+            assert data.db is resident_db
+            assert data.db['channels'][0].name == "unsaved"
+
+    def test_share_after_touch(self, channel, monkeypatch):
+        """Sharing a message with a session due for a touch keeps the database in memory"""
+        message_id = message_send_v2(channel['token'], channel['channel_id'], "hello")['message_id']
+        used = data.db['sessions'][channel['token']]['used'] + 120
+        monkeypatch.setattr(data, 'generate_timestamp', lambda: used)
+        resident_db = data.db
+        message_share_v1(channel['token'], message_id, '', channel['channel_id'], -1)
+        assert data.db is resident_db
+        assert len(data.db['channels'][0].messages) == 2
+        assert data.db['sessions'][channel['token']]['used'] == used
+
+
+@pytest.mark.usefixtures("sqlite_engine", "clear")
+class TestSqlite:
+    """
+    Test cases for the sqlite storage engine
+    """
+    def test_recover(self, channel):
+        """Every row is loaded back after a restart"""
+        id1 = message_send_v2(channel['token'], channel['channel_id'], "@ponyma first")['message_id']
+        id2 = message_send_v2(channel['token'], channel['channel_id'], "second")['message_id']
+        message_edit_v2(channel['token'], id1, "first edited")
+        message_remove_v1(channel['token'], id2)
+        restart()
+        messages = channel_messages_v2(channel['token'], channel['channel_id'], 0)['messages']
+        assert [message['message'] for message in messages] == ["first edited"]
+        assert len(notifications_get_v1(channel['token'])['notifications']) == 1
+        assert data.db['dreams_stats']['messages_exist'][-1]['num_messages_exist'] == 1
+
+    def test_single_row(self, channel):
+        """Sending a message inserts its row without rewriting the others"""
+        engine = storage.get_engine()
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        rows = engine.conn.execute('SELECT message_id, channel_id, content FROM messages').fetchall()
+        assert rows == [(1, channel['channel_id'], "hello")]
+        channel_row = engine.conn.execute('SELECT rowid, state FROM channels').fetchall()
+        message_send_v2(channel['token'], channel['channel_id'], "world")
+        assert engine.conn.execute('SELECT rowid, state FROM channels').fetchall() == channel_row
+
+    def test_read_only_not_saved(self, channel):
+        """Read only endpoints do not write the database"""
+        before = file_state()
+        channels_listall_v2(channel['token'])
+        search_v2(channel['token'], "hello")
+        assert file_state() == before
+
+    def test_reload_other_writer(self, channel):
+        """The database is reloaded after another connection committed"""
+        other = sqlite3.connect(config.sqlite_file)
+        with other:
+            other.execute("UPDATE channels SET name = 'renamed'")
+        other.close()
+        resident_db = data.db
+        channels_listall_v2(channel['token'])
+        assert data.db is not resident_db
+
+
+@pytest.mark.usefixtures("sharded_engine", "clear")
+class TestSharded:
+    """
+    Test cases for the sharded storage engine
+    """
+    def test_only_touched_shard(self, channel):
+        """Sending a message only rewrites the history of its channel"""
+        other = channels_create_v2(channel['token'], "other channel", is_public=True)
+        other_shard = os.path.join(config.shard_dir, f"channel_{other['channel_id']}.p")
+        history = os.path.join(config.shard_dir, f"channel_{channel['channel_id']}.messages.p")
+        other_stat = os.stat(other_shard)
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        assert os.path.exists(history)
+        assert os.stat(other_shard).st_mtime_ns == other_stat.st_mtime_ns
+        assert os.stat(other_shard).st_ino == other_stat.st_ino
+
+    def test_recover(self, channel):
+        """Every segment is loaded back after a restart"""
+        other = channels_create_v2(channel['token'], "other channel", is_public=True)
+        message_send_v2(channel['token'], other['channel_id'], "other")
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        restart()
+        channels = channels_listall_v2(channel['token'])['channels']
+        assert [channel['name'] for channel in channels] == ["pony's channel", "other channel"]
+        messages = channel_messages_v2(channel['token'], other['channel_id'], 0)['messages']
+        assert [message['message'] for message in messages] == ["other"]
+        assert data.db['dreams_stats']['messages_exist'][-1]['num_messages_exist'] == 2
+
+    def test_send_writes_own_records(self, channel):
+        """Sending a message leaves the records of the other users and the sessions alone"""
+        other = auth_register_v2("other@qq.com", "OtherPassword", "Other", "User")
+        other_record = os.path.join(config.shard_dir, f"user_{other['auth_user_id']}.p")
+        sessions_log = os.path.join(config.shard_dir, "sessions.log")
+        other_stat = os.stat(other_record)
+        sessions_stat = os.stat(sessions_log)
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        assert os.stat(other_record).st_mtime_ns == other_stat.st_mtime_ns
+        assert os.stat(other_record).st_ino == other_stat.st_ino
+        assert os.stat(sessions_log).st_size == sessions_stat.st_size
+        with open(os.path.join(config.shard_dir, "meta.p"), 'rb') as f:
+            meta = pickle.load(f)
+        assert meta['users'] == [] and meta['sessions'] == {}
+
+    def test_sessions_logged(self, channel):
+        """Logging in and out appends to the session log, which is replayed on a restart"""
+        login = auth_login_v2("pony.ma@qq.com", "PonyMa")
+        auth_logout_v1(channel['token'])
+        restart()
+        assert list(data.db['sessions']) == [login['token']]
+        assert [user.id for user in data.db['users']] == [login['auth_user_id']]
+
+    def test_session_log_replaced(self, channel, monkeypatch):
+        """The session log is replaced by the session table once it holds enough stale records"""
+        monkeypatch.setattr(config, 'checkpoint_interval', 3)
+        for _ in range(10):
+            auth_logout_v1(auth_login_v2("pony.ma@qq.com", "PonyMa")['token'])
+        engine = storage.get_engine()
+        assert engine.session_records <= len(data.db['sessions']) + 3
+        sessions = dict(data.db['sessions'])
+        restart()
+        assert data.db['sessions'] == sessions
+
+    def test_removed_user_record(self, channel):
+        """A removed user is loaded back into removed_users"""
+        other = auth_register_v2("other@qq.com", "OtherPassword", "Other", "User")
+        admin_user_remove_v1(channel['token'], other['auth_user_id'])
+        restart()
+        assert [user.id for user in data.db['removed_users']] == [other['auth_user_id']]
+        assert other['auth_user_id'] not in [user.id for user in data.db['users']]
+
+
+@pytest.mark.parametrize('engine', ['sqlite', 'sharded'])
+@pytest.mark.usefixtures("clear")
+class TestLazyHistory:
+    """
+    Test cases for paging in the message history on first access
+    """
+    @pytest.fixture(autouse=True)
+    def use_engine(self, monkeypatch, engine):
+        monkeypatch.setattr(config, 'storage_engine', engine)
+        clear_v1()
+
+    def test_paged_out_after_restart(self, channel):
+        """Only the history of the channel which is read is loaded"""
+        other = channels_create_v2(channel['token'], "other channel", is_public=True)
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        message_send_v2(channel['token'], other['channel_id'], "other")
+        restart()
+        assert all(c._messages is None for c in data.db['channels'])
+        messages = channel_messages_v2(channel['token'], channel['channel_id'], 0)['messages']
+        assert [message['message'] for message in messages] == ["hello"]
+        histories = {c.id: c._messages for c in data.db['channels']}
+        assert histories[other['channel_id']] is None
+        assert data.db['users'][0].involvement_rate() == 1
+
+    def test_count_without_page_in(self, channel):
+        """The stats count the messages of a paged out history"""
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        restart()
+        assert data.db['channels'][0].count_messages() == 1
+        assert data.db['channels'][0]._messages is None
+
+    def test_edit_without_page_in(self, channel):
+        """Editing a message only loads the history of its channel"""
+        other = channels_create_v2(channel['token'], "other channel", is_public=True)
+        message_send_v2(channel['token'], other['channel_id'], "other")
+        message_id = message_send_v2(channel['token'], channel['channel_id'], "hello")['message_id']
+        restart()
+        message_edit_v2(channel['token'], message_id, "edited")
+        histories = {c.id: c._messages for c in data.db['channels']}
+        assert histories[other['channel_id']] is None
+        restart()
+        messages = channel_messages_v2(channel['token'], channel['channel_id'], 0)['messages']
+        assert [message['message'] for message in messages] == ["edited"]
+        assert data.db['channels'][1].message_ids() == [message_id - 1]
+
+    def test_filtered_search(self, channel):
+        """A search narrowed to a channel only loads its history, a regex builds no content index"""
+        other = channels_create_v2(channel['token'], "other channel", is_public=True)
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        message_send_v2(channel['token'], other['channel_id'], "hello other")
+        restart()
+        for query in ('h.llo', 'hello'):
+            messages = search_v2(channel['token'], query, channel_id=channel['channel_id'])['messages']
+            assert [message['message'] for message in messages] == ["hello"]
+        histories = {c.id: c._messages for c in data.db['channels']}
+        assert histories[other['channel_id']] is None
+        assert data.built_index('terms') is None
+        assert len(search_v2(channel['token'], 'h.llo')['messages']) == 2
+        assert data.built_index('terms') is None
+
+
+def send_messages(token, channel_id, count):
+    """Run in a worker process, send count messages to the channel"""
+    for i in range(count):
+        message_send_v2(token, channel_id, f"{os.getpid()} {i}")
+
+
+@pytest.mark.parametrize('engine', ['pickle', 'sqlite', 'sharded'])
+@pytest.mark.usefixtures("clear")
+class TestMultiWorker:
+    """
+    Test cases for several worker processes sharing the database
+    """
+    @pytest.fixture(autouse=True)
+    def use_engine(self, monkeypatch, engine):
+        monkeypatch.setattr(config, 'storage_engine', engine)
+        monkeypatch.setattr(config, 'checkpoint_interval', 10)
+        clear_v1()
+
+    def test_no_lost_update(self, channel):
+        """Every message sent by concurrent workers is kept, with a unique id"""
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=send_messages, args=(channel['token'], channel['channel_id'], 15))
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert [worker.exitcode for worker in workers] == [0] * 4
+        with storage.lock:
+            data.load_db()
+        messages = data.db['channels'][0].messages
+        assert len(messages) == 60
+        assert len({message.id for message in messages}) == 60
+        assert data.db['dreams_stats']['messages_exist'][-1]['num_messages_exist'] == 60
+
+    def test_reload_on_generation(self, channel):
+        """A worker only reloads once another one has advanced the generation"""
+        resident_db = data.db
+        channels_listall_v2(channel['token'])
+        assert data.db is resident_db
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        assert data.db is resident_db
+        storage.DatabaseLock().advance()
+        channels_listall_v2(channel['token'])
+        assert data.db is not resident_db
+
+    def test_reads_share_lock(self, channel):
+        """A read runs while another worker reads, a write waits for it"""
+        other = storage.DatabaseLock()
+        with other.read():
+            read = threading.Thread(target=channels_listall_v2, args=(channel['token'],), daemon=True)
+            read.start()
+            read.join(timeout=5)
+            assert not read.is_alive()
+            write = threading.Thread(target=message_send_v2, args=(channel['token'], channel['channel_id'], "hello"),
+                                     daemon=True)
+            write.start()
+            write.join(timeout=0.5)
+            assert write.is_alive()
+        write.join(timeout=5)
+        assert not write.is_alive()
+        assert len(data.db['channels'][0].messages) == 1
+
+    def test_read_touch(self, channel, monkeypatch):
+        """A read which records the use of its session keeps the shared lock and reloads nothing"""
+        used = data.db['sessions'][channel['token']]['used'] + 120
+        monkeypatch.setattr(data, 'generate_timestamp', lambda: used)
+        resident_db = data.db
+        other = storage.DatabaseLock()
+        with other.read():
+            read = threading.Thread(target=channels_listall_v2, args=(channel['token'],), daemon=True)
+            read.start()
+            read.join(timeout=5)
+            assert not read.is_alive()
+        assert data.db is resident_db
+        assert not data.is_dirty()
+        assert data.touches == {channel['token']: used}
+        channels_listall_v2(channel['token'])
+        assert data.db is resident_db
+
+    def test_touch_saved_by_write(self, channel, monkeypatch):
+        """The use of a session recorded by a read is saved along with the next write"""
+        used = data.db['sessions'][channel['token']]['used'] + 120
+        monkeypatch.setattr(data, 'generate_timestamp', lambda: used)
+        channels_listall_v2(channel['token'])
+        message_send_v2(channel['token'], channel['channel_id'], "hello")
+        assert not data.touches
+        restart()
+        assert data.db['sessions'][channel['token']]['used'] == used
+
+    def test_touch_saved_by_reaper(self, channel, monkeypatch):
+        """The use of a session recorded by a read is saved by the reaper when nothing is written"""
+        used = data.db['sessions'][channel['token']]['used'] + 120
+        monkeypatch.setattr(data, 'generate_timestamp', lambda: used)
+        channels_listall_v2(channel['token'])
+        data.reap_sessions()
+        assert not data.touches
+        restart()
+        assert data.db['sessions'][channel['token']]['used'] == used
+
+    def test_touch_kept_on_reload(self, channel, monkeypatch):
+        """A reload caused by another worker keeps the unsaved uses of the sessions"""
+        used = data.db['sessions'][channel['token']]['used'] + 120
+        monkeypatch.setattr(data, 'generate_timestamp', lambda: used)
+        channels_listall_v2(channel['token'])
+        storage.DatabaseLock().advance()
+        resident_db = data.db
+        channels_listall_v2(channel['token'])
+        assert data.db is not resident_db
+        assert data.db['sessions'][channel['token']]['used'] == used
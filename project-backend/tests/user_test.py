@@ -1,6 +1,9 @@
 import pytest
 from src.user import user_profile_v2, user_profile_setname_v2, user_profile_setemail_v2, user_profile_sethandle_v1, users_all_v1
+from src.user import user_stats_v1
 from src.auth import auth_register_v2, auth_login_v2
+from src.channels import channels_create_v2
+from src.message import message_send_v2
 from src.error import InputError, AccessError
 from src.other import clear_v1
 
@@ -299,3 +302,36 @@ class TestUsersAll:
         # should raise InputError, because the token is invalid
         with pytest.raises(AccessError):
             assert users_all_v1(unuse_token)
+
+
+@pytest.mark.usefixtures("clear")
+class TestUserStats:
+    """
+
+    This class contains a series of tests
+    for the "user_stats" function.
+
+    """
+    def test_involvement_rate(self, user_list):
+        """
+
+        Test user/stats/v1 reports the involvement rate with the counters
+
+        """
+        channel_id = channels_create_v2(user_list[0]['token'], "channel", is_public=True)['channel_id']
+        message_send_v2(user_list[0]['token'], channel_id, "hello")
+        user_stats = user_stats_v1(user_list[0]['token'])['user_stats']
+        assert set(user_stats) == {'channels_joined', 'dms_joined', 'messages_sent', 'involvement_rate'}
+        assert user_stats['channels_joined'][-1]['num_channels_joined'] == 1
+        assert user_stats['messages_sent'][-1]['num_messages_sent'] == 1
+        assert user_stats['involvement_rate'] == 1
+        assert user_stats_v1(user_list[1]['token'])['user_stats']['involvement_rate'] == 0
+
+    def test_invalid_token(self, user_list):
+        """
+
+        Test user/stats/v1 when the token is invalid
+
+        """
+        with pytest.raises(AccessError):
+            user_stats_v1('invalid token')